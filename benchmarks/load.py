@@ -0,0 +1,343 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import platform
+import tempfile
+import threading
+import subprocess
+import numpy as np
+from collections import Counter
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import build_opener, HTTPCookieProcessor
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+
+from web.models import AtmosphericMeasurement, MeasurementRegion, Substance, HealthPoint, Users
+from .synthetic import scratch_database, generate, bench_user, BENCH_EMAIL, BENCH_PASSWORD
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, 'main.py')
+
+KINDS = ('acute', 'chronic', 'acute hi', 'chronic hi', 'risk')
+# доли маршрутов в смеси запросов: пользователь открывает панель, графики подгружаются через /api,
+# изредка график скачивается
+MIX = {'/monitoring': 2, '/api': 7, '/download': 1}
+LOAD_EMAIL = 'load{}@example.com'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def seed(path, regions, substances, years, gaps, seed=0, users=0):
+    '''
+    Заполняет бд синтетическими данными и пользователями (bench_user и users пользователей нагрузки
+    LOAD_EMAIL с паролем BENCH_PASSWORD)
+
+    Returns:
+        dict - start, end (последний год данных), ids регионов, веществ и органов для запросов
+    '''
+    with scratch_database(path):
+        generate(regions, substances, years, gaps, seed=seed)
+        bench_user()
+        # хеш пароля считается один раз, он медленный намеренно
+        password = generate_password_hash(BENCH_PASSWORD)
+        Users.insert_many([
+            {'first_name': 'Load', 'last_name': str(i), 'email': LOAD_EMAIL.format(i),
+             'verified': True, 'password': password}
+            for i in range(users)]).on_conflict_ignore().execute()
+        end = AtmosphericMeasurement.select(AtmosphericMeasurement.date).order_by(
+            AtmosphericMeasurement.date.desc()).scalar() + timedelta(days=1)
+        ids = {
+            'regions': [x.id for x in MeasurementRegion.all().order_by(MeasurementRegion.id)],
+            'substances': [x.id for x in Substance.all().order_by(Substance.id)][:3],
+            'points': [x.id for x in HealthPoint.possible_all().order_by(HealthPoint.id)][:3],
+        }
+    return dict(ids, start=end - timedelta(days=365), end=end)
+
+
+def api_urls(data, kinds=('acute', 'chronic', 'risk', 'acute hi')):
+    '''Адреса /api по всем регионам и опциям seed за последний год'''
+    urls = []
+    for region in data['regions']:
+        for kind in kinds:
+            for option in data['points'] if kind.endswith('hi') else data['substances']:
+                urls.append('/api?' + urlencode(dict(kind=kind, region_id=region, option=option,
+                                                     start=data['start'].isoformat(), end=data['end'].isoformat())))
+    return urls
+
+
+def traffic(data):
+    '''
+    Запросы для смеси MIX: /monitoring и /api всех видов графиков, /download
+
+    Returns:
+        list[tuple[str, str]] - (маршрут для отчета, адрес). Для /api маршрут включает вид графика
+    '''
+    result = [('/monitoring', '/monitoring?' + urlencode(dict(kind=kind))) for kind in KINDS]
+    for kind in KINDS:
+        result += [(f'/api {kind}', url) for url in api_urls(data, (kind, ))]
+    start, end = data['start'].isoformat(), data['end'].isoformat()
+    for region in data['regions']:
+        for kind in ('acute', 'chronic'):
+            for option in data['substances']:
+                result.append(('/download', f'/download/{kind}/{region}/{option}/{start}/{end}'))
+    return result
+
+
+def start_server(cwd, command, port, timeout=60):
+    '''
+    Запускает main.py с указанной командой в папке с бд и ждет, пока порт начнет принимать соединения
+
+    Returns:
+        subprocess.Popen
+    '''
+    process = subprocess.Popen([sys.executable, MAIN] + command, cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'сервер {command} завершился с кодом {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'сервер {command} не запустился за {timeout} с')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def client(base, email=BENCH_EMAIL):
+    '''Авторизованный клиент (urllib с куками)'''
+    opener = build_opener(HTTPCookieProcessor(CookieJar()))
+    opener.open(base + '/signin', urlencode({'email': email, 'pass': BENCH_PASSWORD}).encode()).read()
+    return opener
+
+
+def summarize(latencies, errors, duration):
+    '''Пропускная способность и перцентили задержки (мс) по списку задержек в секундах'''
+    latency = np.asarray(latencies) * 1000
+    result = {'requests': len(latency), 'errors': sum(errors.values()), 'rps': round(len(latency) / duration, 1)}
+    for q in (50, 95, 99):
+        result[f'p{q}_ms'] = round(float(np.percentile(latency, q)), 1) if len(latency) else None
+    if errors:
+        result['statuses'] = dict(sorted(errors.items()))
+    return result
+
+
+def hammer(base, urls, concurrency, duration, warmup=2.0, mix=None, users=None, seed=0):
+    '''
+    Нагружает сервер: concurrency клиентов запрашивают urls в течение duration секунд
+
+    Args:
+        base:        str                          - адрес сервера
+        urls:        list[str|tuple[str, str]]    - адреса или пары (маршрут, адрес)
+        concurrency: int                          - число одновременных клиентов
+        duration:    float                        - длительность замера в секундах (после warmup)
+        warmup:      float                        - сколько секунд запросы не учитываются
+        mix:         dict[str, float]             - веса маршрутов (по первому слову маршрута, см. MIX):
+                                                    клиент выбирает маршрут по весам, адрес в нем - случайно.
+                                                    Без mix клиенты идут по urls по кругу
+        users:       list[str]                    - почта пользователей, клиент n входит как users[n % len(users)]
+        seed:        int                          - зерно выбора запросов
+
+    Returns:
+        dict - rps, p50/p95/p99 в мс, число запросов и ошибок (statuses - ошибки по коду ответа)
+               и то же по маршрутам в routes
+    '''
+    urls = [x if isinstance(x, tuple) else (x.split('?')[0], x) for x in urls]
+    groups = {}
+    for route, url in urls:
+        groups.setdefault(route.split()[0], []).append((route, url))
+    if mix:
+        names = [x for x in mix if x in groups]
+        weights = np.asarray([mix[x] for x in names], dtype=float)
+        weights /= weights.sum()
+
+    latencies = [[] for _ in range(concurrency)]
+    errors = [Counter() for _ in range(concurrency)]
+    begin = time.monotonic() + warmup
+    stop = begin + duration
+
+    def worker(n):
+        opener = client(base, users[n % len(users)] if users else BENCH_EMAIL)
+        rng = np.random.default_rng((seed, n))
+        i = n
+        while (now := time.monotonic()) < stop:
+            if mix:
+                group = groups[names[rng.choice(len(names), p=weights)]]
+                route, url = group[rng.integers(len(group))]
+            else:
+                route, url = urls[i % len(urls)]
+                i += concurrency
+            t = time.perf_counter()
+            try:
+                opener.open(base + url, timeout=60).read()
+            except HTTPError as e:
+                if now >= begin:
+                    errors[n][(route, str(e.code))] += 1
+                continue
+            except OSError:
+                if now >= begin:
+                    errors[n][(route, 'connection')] += 1
+                continue
+            if now >= begin:
+                latencies[n].append((route, time.perf_counter() - t))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for x in threads:
+        x.start()
+    for x in threads:
+        x.join()
+
+    samples = [x for xs in latencies for x in xs]
+    failed = sum(errors, Counter())
+    result = summarize([t for _, t in samples], Counter({s: c for (_, s), c in failed.items()}), duration)
+    result['routes'] = {}
+    for route in sorted({r for r, _ in urls}):
+        route_errors = Counter()
+        for (r, status), count in failed.items():
+            if r == route:
+                route_errors[status] += count
+        result['routes'][route] = summarize([t for r, t in samples if r == route], route_errors, duration)
+    return result
+
+
+def commit():
+    '''Текущий коммит репозитория (с пометкой о незакоммиченных изменениях) или None'''
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return head + ('-dirty' if dirty else '')
+
+
+def run(regions=10, substances=None, years=2, gaps=0.1, concurrency=16, duration=30, users=16,
+        server='serve', workers=None, threads=4, mix=MIX, random_seed=0, out=None):
+    '''
+    Нагрузка на локально поднятое приложение: временная бд с синтетикой и пользователями, сервер на свободном
+    порту 127.0.0.1, смесь /monitoring, /api всех видов и /download от авторизованных клиентов.
+    Сеть не нужна (загрузка с сайта росгидромета по расписанию не успевает запуститься)
+
+    Args:
+        server:      str              - 'serve' (gunicorn) или 'dev' (app.run)
+        users:       int              - число разных пользователей, между которыми делятся клиенты
+        mix:         dict[str, float] - веса маршрутов
+        random_seed: int              - зерно синтетики и выбора запросов
+        out:         str              - json файл результата
+
+    Returns:
+        dict - meta (коммит, параметры, машина) и результат hammer
+    '''
+    cwd = tempfile.mkdtemp()
+    try:
+        users = max(users, 1)
+        data = seed(os.path.join(cwd, 'database.db'), regions, substances, years, gaps, random_seed, users)
+        command = ['serve', '--dev'] if server == 'dev' else \
+            ['serve', '--threads', str(threads)] + (['--workers', str(workers)] if workers else [])
+        port = free_port()
+        process = start_server(cwd, command + ['--port', str(port)], port)
+        try:
+            result = hammer(f'http://127.0.0.1:{port}', traffic(data), concurrency, duration, mix=mix,
+                            users=[LOAD_EMAIL.format(i) for i in range(users)], seed=random_seed)
+        finally:
+            stop_server(process)
+    finally:
+        shutil.rmtree(cwd, ignore_errors=True)
+
+    result = {
+        'meta': {
+            'commit': commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'server': server,
+            'workers': workers,
+            'threads': threads,
+            'regions': regions,
+            'substances': substances,
+            'years': years,
+            'gaps': gaps,
+            'concurrency': concurrency,
+            'duration': duration,
+            'users': users,
+            'mix': mix,
+            'seed': random_seed,
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+        },
+        **result,
+    }
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+    return result
+
+
+def table(result, previous=None):
+    '''
+    Таблица результата run по маршрутам, с previous (результат другого запуска) - с изменением p95
+
+    Returns:
+        str
+    '''
+    head = f"{'маршрут':<16}{'запросов':>10}{'ошибок':>8}{'rps':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}"
+    if previous:
+        head += f"{'p95 было':>10}{'Δ p95':>8}"
+    lines = [head]
+    rows = dict(result['routes'], всего=result)
+    for route, x in rows.items():
+        line = f"{route:<16}{x['requests']:>10}{x['errors']:>8}{x['rps']:>8}" + \
+            ''.join(f"{'-' if x[k] is None else x[k]:>10}" for k in ('p50_ms', 'p95_ms', 'p99_ms'))
+        if previous:
+            before = (previous if route == 'всего' else previous['routes'].get(route, {})).get('p95_ms')
+            change = f'{(x["p95_ms"] / before - 1) * 100:+.0f}%' if before and x['p95_ms'] else '-'
+            line += f"{'-' if before is None else before:>10}{change:>8}"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def compare(regions=20, substances=None, years=2, gaps=0.1, concurrency=16, duration=20, workers=None, threads=4):
+    '''
+    Сравнивает пропускную способность и задержки app.run() и main.py serve на одних и тех же данных
+
+    Returns:
+        dict[str, dict] - результат hammer для каждого сервера
+    '''
+    cwd = tempfile.mkdtemp()
+    try:
+        urls = api_urls(seed(os.path.join(cwd, 'database.db'), regions, substances, years, gaps))
+        servers = {
+            'app.run()': ['serve', '--dev'],
+            'serve': ['serve', '--threads', str(threads)] + (['--workers', str(workers)] if workers else []),
+        }
+        result = {}
+        for name, command in servers.items():
+            port = free_port()
+            process = start_server(cwd, command + ['--port', str(port)], port)
+            try:
+                result[name] = hammer(f'http://127.0.0.1:{port}', urls, concurrency, duration)
+            finally:
+                stop_server(process)
+            print(name, {k: v for k, v in result[name].items() if k != 'routes'})
+        return result
+    finally:
+        shutil.rmtree(cwd, ignore_errors=True)
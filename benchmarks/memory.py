@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import multiprocessing as mp
+from datetime import timedelta
+
+from config import STREAM_CHUNK
+from .synthetic import scratch_database, generate
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def reset_peak():
+    '''Сбрасывает пик памяти процесса до текущей (linux), иначе в пике останется память импорта'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    '''Пиковая память процесса в МБ'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # на linux ru_maxrss в КБ, на macos в байтах
+    scale = 1 if os.uname().sysname == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+def _evaluate(path, chunk, queue):
+    '''
+    Сводка острого и хронического HI всех органов по всем регионам за всю историю (как /api/impact?cube=0
+    и отчет) в отдельном процессе. Возвращает прирост пиковой памяти относительно состояния после импорта
+    '''
+    from web.models import AtmosphericMeasurement, Substance, HealthPoint
+    from web.impact import summarize
+
+    with scratch_database(path):
+        list(Substance.all()), list(HealthPoint.possible_all())
+        start, end = AtmosphericMeasurement.first_date(), AtmosphericMeasurement.max_date() + timedelta(days=1)
+        reset_peak()
+        before = peak_rss()
+        for type in ('acute', 'chronic'):
+            for _, _, hi in AtmosphericMeasurement.stream_HI(type, start, end, chunk=chunk):
+                summarize(hi)
+        queue.put(peak_rss() - before)
+
+
+def measure(path, chunk):
+    '''Прирост пиковой памяти (МБ) расчета по бд path в чистом процессе'''
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_evaluate, args=(path, chunk, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def run(counts=(10, 20, 40, 80), substances=None, years=2, gaps=0.1, seed=0, chunk=STREAM_CHUNK):
+    '''
+    Пиковая память расчета HI по всем регионам при росте числа регионов:
+    потоком по chunk регионов и всем кубом сразу
+
+    Returns:
+        list[dict] - regions, rows, streamed_mb, whole_mb
+    '''
+    if resource is None:
+        raise RuntimeError('замер памяти требует модуль resource (linux, macos)')
+
+    result = []
+    print(f"{'регионов':>10}{'измерений':>12}{'поток, МБ':>12}{'весь куб, МБ':>14}")
+    directory = tempfile.mkdtemp()
+    try:
+        for count in counts:
+            path = os.path.join(directory, f'memory-{count}.db')
+            with scratch_database(path):
+                rows = generate(count, substances, years, gaps, seed=seed)
+            row = {
+                'regions': count,
+                'rows': rows,
+                'streamed_mb': round(measure(path, chunk), 1),
+                'whole_mb': round(measure(path, None), 1),
+            }
+            print(f"{count:>10}{rows:>12}{row['streamed_mb']:>12}{row['whole_mb']:>14}")
+            result.append(row)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return result
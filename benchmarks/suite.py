@@ -0,0 +1,167 @@
+import os
+import json
+import tracemalloc
+import numpy as np
+from time import perf_counter
+from datetime import timedelta
+
+from web import app
+from web.views import make_chart, select_periods, reset_chart_cache
+from web.models import AtmosphericMeasurement, HealthPoint, MeasurementRegion, Substance, ACUTE_W, CHRONIC_W
+from .synthetic import scratch_database, generate, bench_user
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+KINDS = ('acute', 'chronic', 'acute hi', 'chronic hi', 'risk')
+
+
+def cases(client, start, end):
+    '''
+    Замеряемые функции
+
+    Returns:
+        list[tuple[str, callable]]
+    '''
+    am = AtmosphericMeasurement
+    region = MeasurementRegion.all().order_by(MeasurementRegion.id).first()
+    substance = Substance.all().order_by(Substance.id).first()
+    point = HealthPoint.possible_all().order_by(HealthPoint.id).first()
+    hi = am.HI('acute', start, end, None, region)[0, :, 1]
+
+    result = [
+        ('C all w=1', lambda: am.C(start, end, w=ACUTE_W)),
+        ('C one w=365', lambda: am.C(start, end, substance, region, w=CHRONIC_W)),
+        ('cubes all 4 windows', lambda: am.cubes(start, end, None, None, ('7d', '30d', '30d:ewma', '90d:max'))),
+        ('HQ acute all', lambda: am.HQ('acute', start, end)),
+        ('HI chronic one region', lambda: am.HI('chronic', start, end, None, region)),
+        ('prob acute all', lambda: am.prob('acute', start, end)),
+        ('risk chronic one', lambda: am.risk('chronic', start, end, substance, region)),
+        ('select_periods n=5', lambda: select_periods(hi, 5)),
+        ('select_periods n=90', lambda: select_periods(hi, 90)),
+    ]
+
+    for kind in KINDS:
+        option = point.id if kind.endswith('hi') else substance.id
+        args = (kind, str(region.id), str(option), start.isoformat(), end.isoformat())
+        query = dict(kind=args[0], region_id=args[1], option=args[2], start=args[3], end=args[4])
+        result += [
+            (f'make_chart {kind}', lambda args=args: make_chart(*args)),
+            (f'/api {kind}', lambda query=query: _get(client, '/api', query_string=query)),
+            (f'/download {kind}', lambda args=args: _get(client, '/download/%s/%s/%s/%s/%s' % args)),
+        ]
+        if kind == 'acute':
+            result.append(('/api acute cached', lambda query=query: _get(client, '/api', query_string=query, cold=False)))
+    return result
+
+
+def _get(client, *args, cold=True, **kwargs):
+    # без cold повторы замера попадали бы в кеш графиков
+    if cold:
+        reset_chart_cache()
+    res = client.get(*args, **kwargs)
+    if res.status_code != 200:
+        raise RuntimeError(f'{args[0]} ответил {res.status_code}')
+    return res.data
+
+
+def measure(func, database, repeat=5):
+    '''
+    Замеряет функцию
+
+    Returns:
+        dict - минимальное и медианное время (сек), число sql-запросов за вызов, пик памяти (КБ)
+    '''
+    queries = [0]
+
+    def hook(sql, params, duration):
+        queries[0] += 1
+
+    database.query_hooks.append(hook)
+    try:
+        times = []
+        for _ in range(repeat):
+            queries[0] = 0
+            t = perf_counter()
+            func()
+            times.append(perf_counter() - t)
+
+        # память меряем отдельным прогоном, т.к. tracemalloc замедляет код
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    finally:
+        database.query_hooks.remove(hook)
+
+    return {
+        'time': min(times),
+        'median': float(np.median(times)),
+        'queries': queries[0],
+        'peak_kb': peak // 1024,
+    }
+
+
+def load_baseline(path):
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    return {}
+
+
+def run(regions=10, substances=None, years=2, gaps=0.1, repeat=5, seed=0,
+        baseline=BASELINE_FILE, threshold=0.25, save=False, only=None):
+    '''
+    Прогоняет набор замеров на синтетической бд и сравнивает с сохраненными базовыми значениями
+
+    Args:
+        regions, substances, years, gaps, seed - параметры синтетических данных (см. synthetic.generate)
+        repeat:    int   - число повторов каждого замера
+        baseline:  str   - файл с базовыми значениями
+        threshold: float - допустимое замедление относительно базового значения (0.25 = 25%)
+        save:      bool  - сохранить результаты как новые базовые значения
+        only:      str   - запускать только замеры, в названии которых есть эта подстрока
+
+    Returns:
+        list[str] - названия замеров с регрессией
+    '''
+    shape = f'{regions}x{substances or "all"}x{years}y gaps={gaps}'
+    baselines = load_baseline(baseline)
+    base = baselines.get(shape, {})
+    results = {}
+    regressions = []
+
+    with scratch_database() as database:
+        rows = generate(regions, substances, years, gaps, seed=seed)
+        print(f'{shape}: {rows} измерений')
+
+        user = bench_user()
+        client = app.test_client()
+        with client.session_transaction() as session:
+            user.signin(session)
+
+        end = AtmosphericMeasurement.max_date()
+        start = min(AtmosphericMeasurement.min_date(), end - timedelta(days=30))
+
+        print(f'{"замер":<28}{"время, мс":>12}{"медиана, мс":>14}{"запросы":>10}{"память, КБ":>12}{"база, мс":>12}')
+        for name, func in cases(client, start, end):
+            if only and only not in name:
+                continue
+            r = results[name] = measure(func, database, repeat)
+            mark = ''
+            if name in base:
+                if r['time'] > base[name]['time'] * (1 + threshold):
+                    regressions.append(name)
+                    mark = '  РЕГРЕССИЯ'
+                b = f'{base[name]["time"] * 1000:>12.1f}'
+            else:
+                b = f'{"-":>12}'
+            print(f'{name:<28}{r["time"] * 1000:>12.1f}{r["median"] * 1000:>14.1f}{r["queries"]:>10}{r["peak_kb"]:>12}{b}{mark}')
+
+    if save:
+        baselines[shape] = {**base, **results}
+        with open(baseline, 'w', encoding='utf-8') as file:
+            json.dump(baselines, file, ensure_ascii=False, indent=2)
+
+    return regressions
@@ -0,0 +1,138 @@
+import os
+import tempfile
+import numpy as np
+import peewee as pw
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+from web.models import db, MODELS, SqliteDatabase, mk_database, \
+    Substance, MeasurementRegion, RegionGroup, DataSource, AtmosphericMeasurement, MeasurementRollup, DataGeneration, \
+    Users, reset_reference, ensure_partitions
+from werkzeug.security import generate_password_hash
+
+
+BENCH_EMAIL = 'bench@example.com'
+BENCH_PASSWORD = 'benchmark'
+
+
+@contextmanager
+def scratch_database(path=None):
+    '''
+    Временная sqlite бд, к которой на время контекста привязаны все модели
+
+    Args:
+        path: str - путь к файлу бд (по умолчанию временный файл, удаляется при выходе)
+
+    Returns:
+        SqliteDatabase
+    '''
+    remove = path is None
+    if remove:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+    database = SqliteDatabase(path, pragmas={'journal_mode': 'wal', 'synchronous': 'off'})
+    # замеры и профилирование, подключенные к основной бд, работают и для временной
+    database.query_hooks.extend(db.query_hooks)
+    try:
+        with database.bind_ctx(MODELS):
+            mk_database()
+            yield database
+    finally:
+        database.close()
+        if remove:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+
+def generate(regions=10, substances=None, years=2, gaps=0.1, end=None, seed=0, chunk=5000):
+    '''
+    Заполняет текущую бд синтетическими измерениями: regions регионов x substances веществ x years лет
+
+    Args:
+        regions:    int   - число регионов
+        substances: int   - число веществ (по умолчанию все справочные, недостающие создаются)
+        years:      int   - глубина истории в годах
+        gaps:       float - доля пропущенных дней [0, 1)
+        end:        date  - последняя дата (по умолчанию вчера)
+        seed:       int   - зерно генератора
+        chunk:      int   - размер пачки при вставке
+
+    Returns:
+        int - число вставленных измерений
+    '''
+    rng = np.random.default_rng(seed)
+
+    if end is None:
+        end = date.today() - timedelta(days=1)
+    start = end - timedelta(days=365 * years)
+    days = (end - start).days + 1
+
+    source = DataSource.get_or_create(name='Синтетика', address='synthetic://')[0]
+
+    known = list(Substance.all().order_by(Substance.id))
+    if substances is None:
+        substances = len(known)
+    for i in range(len(known), substances):
+        proto = known[i % len(known)]
+        known.append(Substance.create(
+            name=f'синтетика {i}', formula=f'SYN{i}', hazard_class=proto.hazard_class,
+            daily_pdk=proto.daily_pdk, yearly_pdk=proto.yearly_pdk,
+            chronic_rfc=proto.chronic_rfc, acute_rfc=proto.acute_rfc))
+    known = known[:substances]
+
+    stations = []
+    for i in range(regions):
+        stations.append(MeasurementRegion.get_or_create(
+            name=f'Синтетический город {i // 5},станция {i}',
+            defaults={
+                'address': f'synthetic station {i}',
+                'lat': 51.0 + rng.uniform(0, 2.5),
+                'lng': 103.0 + rng.uniform(0, 10.0),
+            })[0])
+
+    dates = np.asarray([start + timedelta(days=i) for i in range(days)])
+    total = 0
+    rows = []
+    with AtmosphericMeasurement._meta.database.atomic():
+        for region in stations:
+            for substance in known:
+                present = rng.random(days) >= gaps
+                # показания колеблются вокруг половины среднесуточного пдк
+                stats = rng.lognormal(np.log(substance.daily_pdk * 0.5), 0.6, days)
+                for d, stat in zip(dates[present], stats[present]):
+                    rows.append((d, substance.id, region.id, source.id, float(stat)))
+                if len(rows) >= chunk:
+                    total += _insert(rows)
+                    rows = []
+        total += _insert(rows)
+
+    MeasurementRollup.rebuild()
+    RegionGroup.sync_cities()
+    DataGeneration.bump()
+    reset_reference()
+    return total
+
+
+def _insert(rows):
+    if rows:
+        ensure_partitions(min(x[0] for x in rows), max(x[0] for x in rows))
+        fields = [AtmosphericMeasurement.date, AtmosphericMeasurement.substance,
+                  AtmosphericMeasurement.region, AtmosphericMeasurement.source, AtmosphericMeasurement.stat]
+        # пачки по 100 строк, чтобы не упереться в лимит переменных sqlite
+        for batch in pw.chunked(rows, 100):
+            AtmosphericMeasurement.insert_many(batch, fields=fields).on_conflict_ignore().execute()
+    return len(rows)
+
+
+def bench_user():
+    '''Пользователь для запросов через тестовый клиент'''
+    return Users.get_or_create(
+        email=BENCH_EMAIL,
+        defaults={
+            'first_name': 'Bench',
+            'last_name': 'Bench',
+            'verified': True,
+            'password': generate_password_hash(BENCH_PASSWORD)
+        })[0]
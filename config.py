@@ -17,6 +17,75 @@ MAIL_PASSWORD = 'zgjsjlptrnopyyzo'
 MAIL_DEFAULT_SENDER = 'maximpavlyutenkov@yandex.ru'
 MAIL_MAX_EMAILS = None
 MAIL_ASCII_ATTACHMENTS = False
+MAIL_SENDING_INTENSITY = 10
+MAIL_BATCH_SIZE = 50
+MAIL_MAX_ATTEMPTS = 8
+MAIL_RETRY_DELAY = 30
+
+SQL_PROFILING = False
+SQL_PROFILE_FILE = 'sql_profile.json'
+SQL_SLOW_THRESHOLD = 0.1
+SQL_SLOW_LOG = 'slow_queries.log'
+SQL_N_PLUS_ONE = 20
+
+POINT_NEIGHBOURS = 3
+POINT_IDW_POWER = 2
+POINT_CELL = 0.01
+POINT_CACHE_SIZE = 1024
+POINT_CACHE_TTL = 3600
+
+CHART_CACHE_SIZE = 256
+CHART_WARM_LIMIT = 50
+CHART_STATS_FLUSH = 60
+
+CORRELATION_CACHE_SIZE = 64
+CORRELATION_MIN_PERIODS = 30
+
+IMPACT_CACHE_SIZE = 32
+
+ADMISSION_CAPACITY = 400
+ADMISSION_FREE = 20
+ADMISSION_QUEUE = 8
+ADMISSION_TIMEOUT = 10
+ADMISSION_PER_USER = 2
+
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+
+ASSETS_DIR = 'dist'
+ASSETS_MAX_AGE = 31536000
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 5000
+SERVER_WORKERS = None
+SERVER_THREADS = 4
+SERVER_TIMEOUT = 60
+# как часто (сек) процесс проверяет поколение данных, чтобы перечитать справочники и индекс станций
+# (под serve данные загружает главный процесс, воркеры узнают о новых станциях только так)
+REFERENCE_CHECK_INTERVAL = 10
+
+SOURCES = ['feerc']
+
+# папка архивов старых лет измерений (None - рядом с файлом sqlite бд: <имя бд>-archive)
+ARCHIVE_DIR = None
+ARCHIVE_KEEP_YEARS = 5
+ARCHIVE_CACHE_SIZE = 4
+
+# регионов в порции потокового расчета (AtmosphericMeasurement.stream)
+STREAM_CHUNK = 16
+
+# фоновые выгрузки: папка файлов, потоков расчета в каждом процессе, сколько секунд хранится результат,
+# через сколько секунд незавершенное задание считается потерянным и как часто чистить выгрузки
+EXPORT_DIR = 'exports'
+EXPORT_WORKERS = 2
+EXPORT_TTL = 3600
+EXPORT_TIMEOUT = 1800
+# через сколько секунд ждущее задание можно передать пулу другого процесса (поставивший процесс мог завершиться)
+EXPORT_GRACE = 30
+EXPORT_CLEARING_INTENSITY = 300
+# /download дороже этого (тысяч ячеек куба, см. admission.estimate) считается фоновой выгрузкой
+EXPORT_SYNC_LIMIT = 100
 
 SCRAPING_INTENSITY = 86400
 CLEARING_INTENSITY = 86400
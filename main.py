@@ -1,12 +1,110 @@
+import sys
 import argparse
 from datetime import date
-from web import app
+from web import app, SERVER_HOST, SERVER_PORT, SERVER_WORKERS, SERVER_THREADS, ARCHIVE_KEEP_YEARS, STREAM_CHUNK
 from myparser import load_data
 
 
+def bench(args):
+    from benchmarks.suite import run
+    regressions = run(args.regions, args.substances, args.years, args.gaps, args.repeat, args.seed,
+                      args.baseline, args.threshold, args.save, args.only)
+    if regressions:
+        print('Регрессии: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+def generate(args):
+    from benchmarks.synthetic import scratch_database, generate, bench_user
+    with scratch_database(args.path):
+        print(generate(args.regions, args.substances, args.years, args.gaps, seed=args.seed))
+        bench_user()
+
+
+def report(args):
+    from web.report import build
+    summary = build(args.out, args.start, args.end, args.workers, tuple(args.format.split(',')))
+    print(f"{summary['charts']} графиков за {summary['total_seconds']} с "
+          f"(загрузка данных {summary['load_seconds']} с, {summary['charts_per_second']} графиков/с)")
+    if summary['peak_memory_mb']:
+        print('Пиковая память: %.1f МБ главный процесс, %.1f МБ дочерние' % summary['peak_memory_mb'])
+
+
+def serve(args):
+    if args.dev:
+        app.run(args.host, args.port)
+    else:
+        from web.server import serve
+        serve(args.host, args.port, args.workers, args.threads)
+
+
+def bench_serve(args):
+    from benchmarks.load import compare
+    compare(args.regions, args.substances, args.years, args.gaps, args.concurrency, args.duration,
+            args.workers, args.threads)
+
+
+def bench_load(args):
+    import json
+    from benchmarks.load import run, table, commit
+    mix = {'/' + k.strip().lstrip('/'): float(v) for k, v in (x.split('=') for x in args.mix.split(','))}
+    out = args.out.format(commit=commit() or 'unknown')
+    result = run(args.regions, args.substances, args.years, args.gaps, args.concurrency, args.duration,
+                 args.users, 'dev' if args.dev else 'serve', args.workers, args.threads, mix, args.seed, out)
+    previous = None
+    if args.previous:
+        with open(args.previous, encoding='utf-8') as f:
+            previous = json.load(f)
+    print(table(result, previous))
+    print(f'Результат сохранен в {out}')
+
+
+def bench_memory(args):
+    from benchmarks.memory import run
+    run(tuple(int(x) for x in args.counts.split(',')), args.substances, args.years, args.gaps, args.seed, args.chunk)
+
+
+def build_assets(args):
+    from web.assets import build
+    report = build(app.static_folder)
+    print(f"{'файл':<32}{'размер':>10}{'мин.':>10}{'br':>10}{'gzip':>10}")
+    for name, x in report.items():
+        print(f"{name:<32}{x['size']:>10}{x['minified']:>10}{x['variants'].get('br', '-'):>10}{x['variants'].get('gzip', '-'):>10}")
+
+
+def archive(args):
+    from web.models import AtmosphericMeasurement, archive_dir
+    before = args.before
+    if before is None:
+        last = AtmosphericMeasurement.select(AtmosphericMeasurement.date).order_by(
+            AtmosphericMeasurement.date.desc()).scalar()
+        if last is None:
+            print('В бд нет измерений')
+            return
+        before = last.year - args.keep + 1
+    moved = AtmosphericMeasurement.archive_years(before, args.vacuum)
+    for year, count in moved.items():
+        print(f'{year}: {count} измерений')
+    print(f'Перенесено {sum(moved.values())} измерений в {archive_dir()}' if moved else 'Нечего архивировать')
+
+
+def sql_report(args):
+    from web.profiler import report
+    print(report(args.path, args.top))
+
+
+def add_synthetic_arguments(parser):
+    parser.add_argument('--regions', type=int, default=10, help='Число регионов')
+    parser.add_argument('--substances', type=int, default=None, help='Число веществ (по умолчанию все)')
+    parser.add_argument('--years', type=int, default=2, help='Глубина истории в годах')
+    parser.add_argument('--gaps', type=float, default=0.1, help='Доля пропущенных дней')
+    parser.add_argument('--seed', type=int, default=0, help='Зерно генератора')
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.set_defaults(func=lambda x: app.run())
+    parser.add_argument('--profile-sql', metavar='FILE', help='Профилировать sql-запросы команды и сохранить сессию в файл')
     subparsers = parser.add_subparsers()
 
     parser_migrate = subparsers.add_parser('migrate', help='Создает бд')
@@ -17,8 +115,93 @@ def main():
     parser_load.add_argument('start', type=date.fromisoformat, help='Дата начала')
     parser_load.add_argument('end', type=date.fromisoformat, nargs='?', help='Дата конца')
 
+    parser_report = subparsers.add_parser('report', help='Строит отчет по всем регионам, органам и веществам')
+    parser_report.set_defaults(func=report)
+    parser_report.add_argument('out', help='Папка отчета')
+    parser_report.add_argument('--start', type=date.fromisoformat, help='Дата начала')
+    parser_report.add_argument('--end', type=date.fromisoformat, help='Дата конца')
+    parser_report.add_argument('--workers', type=int, help='Число процессов (по умолчанию число ядер)')
+    parser_report.add_argument('--format', default='csv,json', help='Форматы файлов через запятую (csv, json)')
+
+    parser_serve = subparsers.add_parser('serve', help='Запускает приложение под gunicorn с несколькими процессами')
+    parser_serve.set_defaults(func=serve)
+    parser_serve.add_argument('--host', default=SERVER_HOST, help='Адрес')
+    parser_serve.add_argument('--port', type=int, default=SERVER_PORT, help='Порт')
+    parser_serve.add_argument('--workers', type=int, default=SERVER_WORKERS, help='Число процессов (по умолчанию 2 * ядра + 1)')
+    parser_serve.add_argument('--threads', type=int, default=SERVER_THREADS, help='Число потоков в процессе')
+    parser_serve.add_argument('--dev', action='store_true', help='Встроенный сервер flask (app.run) вместо gunicorn')
+
+    parser_rollup = subparsers.add_parser('rollup', help='Пересчитывает месячные и годовые сводки измерений')
+    parser_rollup.set_defaults(func=lambda args: __import__('web.models').models.MeasurementRollup.rebuild())
+
+    parser_generate = subparsers.add_parser('generate', help='Заполняет отдельную бд синтетическими измерениями')
+    parser_generate.set_defaults(func=generate)
+    parser_generate.add_argument('path', help='Файл sqlite бд')
+    add_synthetic_arguments(parser_generate)
+
+    parser_bench = subparsers.add_parser('bench', help='Замеры производительности на синтетических данных')
+    parser_bench.set_defaults(func=bench)
+    add_synthetic_arguments(parser_bench)
+    parser_bench.add_argument('--repeat', type=int, default=5, help='Число повторов каждого замера')
+    parser_bench.add_argument('--baseline', default='benchmarks/baseline.json', help='Файл с базовыми значениями')
+    parser_bench.add_argument('--threshold', type=float, default=0.25, help='Допустимое замедление (0.25 = 25%%)')
+    parser_bench.add_argument('--save', action='store_true', help='Сохранить результаты как базовые')
+    parser_bench.add_argument('--only', help='Запускать только замеры с этой подстрокой в названии')
+
+    parser_bench_serve = subparsers.add_parser('bench-serve', help='Сравнивает rps и задержки app.run() и serve')
+    parser_bench_serve.set_defaults(func=bench_serve)
+    add_synthetic_arguments(parser_bench_serve)
+    parser_bench_serve.add_argument('--concurrency', type=int, default=16, help='Число одновременных клиентов')
+    parser_bench_serve.add_argument('--duration', type=float, default=20, help='Длительность замера в секундах')
+    parser_bench_serve.add_argument('--workers', type=int, default=None, help='Число процессов serve')
+    parser_bench_serve.add_argument('--threads', type=int, default=SERVER_THREADS, help='Число потоков в процессе serve')
+
+    parser_bench_load = subparsers.add_parser('bench-load', help='Нагрузка на локальный сервер смесью запросов панели')
+    parser_bench_load.set_defaults(func=bench_load)
+    add_synthetic_arguments(parser_bench_load)
+    parser_bench_load.add_argument('--concurrency', type=int, default=16, help='Число одновременных клиентов')
+    parser_bench_load.add_argument('--duration', type=float, default=30, help='Длительность замера в секундах')
+    parser_bench_load.add_argument('--users', type=int, default=16, help='Число разных пользователей')
+    parser_bench_load.add_argument('--mix', default='monitoring=2,api=7,download=1', help='Веса маршрутов')
+    parser_bench_load.add_argument('--dev', action='store_true', help='Нагружать app.run() вместо serve')
+    parser_bench_load.add_argument('--workers', type=int, default=None, help='Число процессов serve')
+    parser_bench_load.add_argument('--threads', type=int, default=SERVER_THREADS, help='Число потоков в процессе serve')
+    parser_bench_load.add_argument('--out', default='load-{commit}.json', help='Файл результата ({commit} - текущий коммит)')
+    parser_bench_load.add_argument('--previous', help='Результат другого запуска для сравнения')
+
+    parser_archive = subparsers.add_parser('archive', help='Переносит старые годы измерений из бд в сжатые архивы')
+    parser_archive.set_defaults(func=archive)
+    parser_archive.add_argument('--keep', type=int, default=ARCHIVE_KEEP_YEARS, help='Сколько последних лет оставить в бд')
+    parser_archive.add_argument('--before', type=int, help='Архивировать годы до этого (вместо --keep)')
+    parser_archive.add_argument('--vacuum', action='store_true', help='Сжать файл sqlite после переноса')
+
+    parser_bench_memory = subparsers.add_parser('bench-memory', help='Пиковая память потокового расчета при росте числа регионов')
+    parser_bench_memory.set_defaults(func=bench_memory)
+    parser_bench_memory.add_argument('--counts', default='10,20,40,80', help='Числа регионов через запятую')
+    parser_bench_memory.add_argument('--substances', type=int, default=None, help='Число веществ (по умолчанию все)')
+    parser_bench_memory.add_argument('--years', type=int, default=2, help='Глубина истории в годах')
+    parser_bench_memory.add_argument('--gaps', type=float, default=0.1, help='Доля пропущенных дней')
+    parser_bench_memory.add_argument('--seed', type=int, default=0, help='Зерно генератора')
+    parser_bench_memory.add_argument('--chunk', type=int, default=STREAM_CHUNK, help='Регионов в порции')
+
+    parser_build_assets = subparsers.add_parser('build-assets', help='Собирает статику: минификация, хеши в именах, сжатые копии')
+    parser_build_assets.set_defaults(func=build_assets)
+
+    parser_sql_report = subparsers.add_parser('sql-report', help='Сводка по сохраненной сессии профилирования sql')
+    parser_sql_report.set_defaults(func=sql_report)
+    parser_sql_report.add_argument('path', help='Файл сессии')
+    parser_sql_report.add_argument('--top', type=int, default=15, help='Сколько строк в каждом разделе')
+
     args = parser.parse_args()
-    args.func(args)
+    if args.profile_sql:
+        from config import SQL_SLOW_THRESHOLD, SQL_SLOW_LOG, SQL_N_PLUS_ONE
+        from web.models import db
+        from web.profiler import profiling
+        with profiling(db, args.profile_sql, slow_threshold=SQL_SLOW_THRESHOLD,
+                       slow_log=SQL_SLOW_LOG, n_plus_one=SQL_N_PLUS_ONE):
+            args.func(args)
+    else:
+        args.func(args)
 
 
 if __name__ == '__main__':
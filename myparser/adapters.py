@@ -0,0 +1,154 @@
+import os
+import json
+import requests
+from abc import ABC, abstractmethod
+from time import perf_counter
+from collections import namedtuple
+from datetime import date, timedelta
+from geopy.geocoders import Nominatim
+
+from web.models import MeasurementRegion
+from web.metrics import SCRAPER_LATENCY, SCRAPER_ERRORS
+
+
+SOURCES_DIR = os.path.join(os.path.dirname(__file__), 'sources')
+
+# измерение в общем для всех источников виде: вещество по формуле, регион по названию
+Record = namedtuple('Record', ('date', 'substance', 'region', 'stat'))
+
+
+def fetch(url, payload, source='feerc'):
+    '''GET запрос к источнику с замером длительности и подсчетом ошибок'''
+    t = perf_counter()
+    try:
+        res = requests.get(url, payload)
+        res.raise_for_status()
+        return json.loads(res.content).get('data', [])
+    except requests.RequestException as e:
+        SCRAPER_ERRORS.inc(source=source, reason=type(e).__name__)
+        raise
+    except ValueError:
+        SCRAPER_ERRORS.inc(source=source, reason='InvalidJSON')
+        raise
+    finally:
+        SCRAPER_LATENCY.observe(perf_counter() - t, source=source)
+
+
+class Adapter(ABC):
+    '''
+    Источник данных: разбивает загрузку на задачи, скачивает и разбирает их в Record
+
+    Args:
+        name:        str   - имя адаптера (в метриках и в SOURCES)
+        title:       str   - название источника (DataSource.name)
+        address:     str   - адрес источника (DataSource.address)
+        concurrency: int   - сколько задач источника выполнять одновременно
+        rate:        float - не больше стольких запросов в секунду (None - без ограничения)
+    '''
+    def __init__(self, name, title, address, concurrency=1, rate=None):
+        self.name = name
+        self.title = title
+        self.address = address
+        self.concurrency = concurrency
+        self.rate = rate
+
+    def preload(self, start):
+        '''Создает регионы источника, которых еще нет в бд'''
+
+    @abstractmethod
+    def tasks(self, start, end):
+        '''
+        Задачи загрузки за даты [start, end]
+
+        Returns:
+            iterable - значения, которые передаются в fetch и parse
+        '''
+
+    @abstractmethod
+    def fetch(self, task):
+        '''Скачивает данные задачи (вызывается из потоков планировщика)'''
+
+    @abstractmethod
+    def parse(self, task, raw):
+        '''
+        Разбирает скачанные данные
+
+        Returns:
+            iterable[Record]
+        '''
+
+
+class FeercAdapter(Adapter):
+    '''
+    Росгидромет (feerc.ru): одна задача - одно вещество на одной станции за день.
+    Адреса, станции и номера веществ берутся из sources/feerc.json
+    '''
+    def __init__(self, path=os.path.join(SOURCES_DIR, 'feerc.json')):
+        with open(path, encoding='utf-8') as file:
+            spec = json.load(file)
+        super().__init__('feerc', spec['name'], spec['address'], spec.get('concurrency', 1), spec.get('rate'))
+        self.regions_url = spec['regions_url']
+        self.data_url = spec['data_url']
+        self.substances = spec['substances']
+        self.stations = spec['stations']
+
+    def preload(self, start):
+        geolocator = Nominatim(user_agent="geoapiExercises")
+
+        for formula, index in self.substances.items():
+            payload = {
+                'lang': 'ru',
+                'date': start.strftime('%d.%m.%Y'),
+                'type': formula,
+                'index': index,
+            }
+            for x in fetch(self.regions_url, payload, self.name):
+                location = geolocator.reverse(f"{x['lat']}, {x['lng']}")
+                attrs = {
+                    'name': x['name'],
+                    'address': location.raw['display_name'],
+                    'lat': location.raw['lat'],
+                    'lng': location.raw['lon'],
+                    'postcode': location.raw['address'].get('postcode')
+                }
+                MeasurementRegion.get_or_create(**attrs)
+
+    def tasks(self, start, end):
+        while start <= end:
+            for formula in self.substances:
+                for ind, name in self.stations.items():
+                    yield start, formula, ind, name
+            start += timedelta(days=1)
+
+    def fetch(self, task):
+        day, formula, ind, _ = task
+        payload = {
+            'date': day.strftime('%d.%m.%Y'),
+            'type': formula,
+            'ind': ind
+        }
+        return fetch(self.data_url, payload, self.name)
+
+    def parse(self, task, raw):
+        _, formula, _, name = task
+        for x in raw:
+            day = date(day=int(x.get('day')), month=int(x.get('month')), year=int(x.get('year')))
+            yield Record(day, formula, name, x.get('y'))
+
+
+ADAPTERS = {
+    'feerc': FeercAdapter,
+}
+
+
+def load_adapters(names):
+    '''
+    Адаптеры по именам
+
+    Raises:
+        ValueError - неизвестное имя
+    '''
+    try:
+        return [ADAPTERS[name]() for name in names]
+    except KeyError as e:
+        raise ValueError(f'Неизвестный источник данных {e}') from None
@@ -0,0 +1,159 @@
+import logging
+import threading
+import peewee as pw
+from time import monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from web.models import Substance, MeasurementRegion, AtmosphericMeasurement, DataSource, ensure_partitions
+from web.metrics import SCRAPER_ERRORS
+
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    '''
+    Ограничение частоты запросов (token bucket), общее для всех потоков источника
+
+    Args:
+        rate:  float - запросов в секунду (None - без ограничения)
+        burst: int   - сколько запросов можно сделать подряд без ожидания
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        '''Ждет, пока можно будет сделать следующий запрос'''
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            sleep(delay)
+
+
+class BulkWriter:
+    '''
+    Пишет измерения всех источников в бд пачками. Уже существующие (дата, вещество, регион) не перезаписываются
+
+    Args:
+        chunk: int - размер пачки
+    '''
+    FIELDS = [AtmosphericMeasurement.date, AtmosphericMeasurement.substance,
+              AtmosphericMeasurement.region, AtmosphericMeasurement.source, AtmosphericMeasurement.stat]
+
+    def __init__(self, chunk=500):
+        self.chunk = chunk
+        self.rows = {}
+        self.touched = set()
+        self.sources = {}
+        self.substances = {x.formula: x.id for x in Substance.all()}
+        self.regions = {x.name: x.id for x in MeasurementRegion.all()}
+
+    def source(self, adapter):
+        if adapter.name not in self.sources:
+            self.sources[adapter.name] = DataSource.get_or_create(name=adapter.title, address=adapter.address)[0].id
+        return self.sources[adapter.name]
+
+    def add(self, adapter, records):
+        '''Добавляет разобранные измерения источника adapter'''
+        source = self.source(adapter)
+        for x in records:
+            substance = self.substances.get(x.substance)
+            region = self.regions.get(x.region)
+            if substance is None or region is None:
+                SCRAPER_ERRORS.inc(source=adapter.name, reason='UnknownSubstance' if substance is None else 'UnknownRegion')
+                continue
+            # первое показание за день побеждает, как и при записи в бд
+            self.rows.setdefault((region, substance, x.date), (x.date, substance, region, source, x.stat))
+        if len(self.rows) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        '''Записывает накопленную пачку, новые ключи попадают в touched'''
+        if not self.rows:
+            return
+        am = AtmosphericMeasurement
+        keys = set(self.rows)
+        regions = sorted({x[0] for x in keys})
+        substances = sorted({x[1] for x in keys})
+        dates = [x[2] for x in keys]
+        # уже загруженные, в том числе перенесенные в архив
+        rows = am.measurements(min(dates), max(dates), regions, substances, valid=False)
+        existing = set(zip(rows['region'].tolist(), rows['substance'].tolist(), rows['date'].tolist()))
+        new = [self.rows[x] for x in keys - existing]
+
+        ensure_partitions(min(dates), max(dates))
+        with am._meta.database.atomic():
+            # пачки по 100 строк, чтобы не упереться в лимит переменных sqlite
+            for batch in pw.chunked(new, 100):
+                am.insert_many(batch, fields=self.FIELDS).on_conflict_ignore().execute()
+        self.touched |= keys - existing
+        self.rows = {}
+
+
+def run(adapters, start, end, writer):
+    '''
+    Загружает данные всех источников за даты [start, end].
+    У каждого источника свой пул потоков (adapter.concurrency) и ограничение частоты (adapter.rate),
+    все разобранные измерения пишет writer в вызывающем потоке
+
+    Args:
+        adapters: list[Adapter]
+        start:    date
+        end:      date
+        writer:   BulkWriter
+
+    Returns:
+        list[Exception] - ошибки задач (остальные задачи при этом загружаются)
+    '''
+    limiters = {x.name: RateLimiter(x.rate) for x in adapters}
+    pools = {x.name: ThreadPoolExecutor(x.concurrency, thread_name_prefix=f'source-{x.name}') for x in adapters}
+
+    def job(adapter, task):
+        limiters[adapter.name].wait()
+        return list(adapter.parse(task, adapter.fetch(task)))
+
+    # задачи отдаем пулам порциями, чтобы не держать в памяти результаты всего периода
+    queues = {x.name: iter(x.tasks(start, end)) for x in adapters}
+    pending = {}
+    errors = []
+
+    def submit(adapter):
+        for task in queues[adapter.name]:
+            pending[pools[adapter.name].submit(job, adapter, task)] = (adapter, task)
+            return True
+        return False
+
+    try:
+        for adapter in adapters:
+            for _ in range(adapter.concurrency * 2):
+                submit(adapter)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                adapter, task = pending.pop(future)
+                try:
+                    records = future.result()
+                except Exception as e:
+                    log.warning('%s: задача %s не загрузилась: %r', adapter.name, task, e)
+                    errors.append(e)
+                else:
+                    writer.add(adapter, records)
+                submit(adapter)
+        writer.flush()
+    finally:
+        for pool in pools.values():
+            pool.shutdown(cancel_futures=True)
+    return errors
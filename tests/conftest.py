@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import socketserver
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    '''
+    Локальный smtp-сервер для тестов
+
+    Args:
+        delay:  float - задержка перед приветствием (медленный сервер)
+        refuse: bool  - отклонять получателей (550 на RCPT TO)
+
+    Fields:
+        connections: int             - число подключений
+        messages:    list[tuple]     - принятые письма (получатели, текст)
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay=0, refuse=False):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.delay = delay
+        self.refuse = refuse
+        self.connections = 0
+        self.messages = []
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        time.sleep(self.server.delay)
+        self.reply('220 stub ESMTP')
+        recipients = []
+        while line := self.rfile.readline():
+            command = line.decode().strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 stub')
+            elif command.startswith('MAIL FROM'):
+                recipients = []
+                self.reply('250 OK')
+            elif command.startswith('RCPT TO'):
+                if self.server.refuse:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(line.decode().strip()[8:])
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                body = []
+                while (data := self.rfile.readline()) not in (b'.\r\n', b''):
+                    body.append(data)
+                self.server.messages.append((recipients, b''.join(body).decode()))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+@pytest.fixture
+def database():
+    '''Временная бд, к которой привязаны модели; фоновые задачи на время теста остановлены'''
+    from web import scheduler
+    from benchmarks.synthetic import scratch_database
+
+    scheduler.pause()
+    try:
+        with scratch_database() as database:
+            yield database
+    finally:
+        scheduler.resume()
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    '''
+    Возвращает функцию, которая запускает SMTPStub и направляет на него почту приложения
+    '''
+    from web import app
+
+    servers = []
+    state = app.extensions['mail']
+
+    def start(**kwargs):
+        server = SMTPStub(**kwargs).__enter__()
+        servers.append(server)
+        for name, value in (('server', '127.0.0.1'), ('port', server.port), ('use_ssl', False),
+                            ('use_tls', False), ('username', None), ('password', None), ('suppress', False)):
+            monkeypatch.setattr(state, name, value)
+        return server
+
+    yield start
+    for server in servers:
+        server.__exit__()
@@ -0,0 +1,23 @@
+import pytest
+
+import web  # noqa: F401 (myparser импортируется после web)
+from myparser import adapters
+from myparser.adapters import Adapter
+
+
+class NoParse(Adapter):
+    '''Адаптер, в котором забыли parse'''
+    def __init__(self):
+        super().__init__('noparse', 'Без разбора', 'test://')
+
+    def tasks(self, start, end):
+        return []
+
+    def fetch(self, task):
+        return []
+
+
+def test_incomplete_adapter_fails_on_construction(monkeypatch):
+    monkeypatch.setitem(adapters.ADAPTERS, 'noparse', NoParse)
+    with pytest.raises(TypeError, match='parse'):
+        adapters.load_adapters(['noparse'])
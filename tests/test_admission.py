@@ -0,0 +1,46 @@
+import threading
+from time import sleep, monotonic
+
+from web.admission import AdmissionControl
+
+
+class OneByOneCondition(threading.Condition):
+    '''Будит только самого давнего ожидающего: очередь должна будить следующих сама'''
+    def notify_all(self):
+        self.notify(1)
+
+
+def test_queued_requests_admitted_together():
+    control = AdmissionControl(capacity=10, queue=8, timeout=5, per_user=10, free=0)
+    control._cond = OneByOneCondition()
+    admitted = []
+    release = threading.Event()
+
+    def heavy():
+        with control.admit(10):
+            release.wait()
+
+    def light(i):
+        with control.admit(3):
+            admitted.append(i)
+            # держат место, пока не войдут все трое
+            while len(admitted) < 3:
+                sleep(0.01)
+
+    holder = threading.Thread(target=heavy)
+    holder.start()
+    sleep(0.05)
+    waiters = [threading.Thread(target=light, args=(i, )) for i in range(3)]
+    for waiter in waiters:
+        waiter.start()
+        sleep(0.05)
+
+    # освободившегося места хватает на троих сразу: войти должны все, а не только первый
+    t = monotonic()
+    release.set()
+    holder.join()
+    for waiter in waiters:
+        waiter.join(10)
+    assert sorted(admitted) == [0, 1, 2]
+    # без пробуждения следующих в очереди они дождались бы своего таймаута
+    assert monotonic() - t < 1
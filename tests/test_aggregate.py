@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from web.models import RunningAggregate, aggregate
+
+
+@pytest.mark.parametrize('agg', ['mean', 'min', 'max', 'median', 'p95'])
+def test_running_aggregate_matches_aggregate(agg):
+    rng = np.random.default_rng(0)
+    values = rng.random((23, 40))
+    values[rng.random(values.shape) < 0.3] = np.nan
+    # дни без показаний ни у одного региона
+    values[:, 5] = np.nan
+
+    folded = RunningAggregate(agg)
+    for i in range(0, len(values), 4):
+        folded.add(values[i:i + 4])
+
+    np.testing.assert_allclose(folded.result(values.shape[1]), aggregate(values, agg), equal_nan=True)
+
+
+def test_running_aggregate_without_regions():
+    folded = RunningAggregate('max')
+    folded.add(np.empty((0, 3)))
+    assert np.isnan(folded.result(3)).all()
+
+
+def test_running_aggregate_rejects_unknown():
+    with pytest.raises(ValueError):
+        RunningAggregate('mode')
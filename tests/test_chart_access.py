@@ -0,0 +1,39 @@
+import threading
+import peewee as pw
+
+from web import views
+from web.models import ChartAccess
+
+
+def test_record_upserts_concurrently(database):
+    ChartAccess.record({('acute', '1', '2', 'mean'): 1})
+    barrier = threading.Barrier(4)
+
+    def flush():
+        barrier.wait()
+        ChartAccess.record({('acute', '1', '2', 'mean'): 2, ('risk', '3', '4', 'mean'): 1})
+
+    threads = [threading.Thread(target=flush) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    hits = {(x.kind, x.region): x.hits for x in ChartAccess.all()}
+    assert hits == {('acute', '1'): 9, ('risk', '3'): 4}
+
+
+def test_failed_flush_keeps_counts(database, monkeypatch):
+    def locked(counts):
+        raise pw.OperationalError('database is locked')
+
+    monkeypatch.setattr(ChartAccess, 'record', locked)
+    views._access.clear()
+    views._access[('acute', '1', '2', 'mean')] = 3
+    views.flush_access()
+    assert views._access[('acute', '1', '2', 'mean')] == 3
+
+    monkeypatch.undo()
+    views.flush_access()
+    assert not views._access
+    assert ChartAccess.get(kind='acute').hits == 3
@@ -0,0 +1,64 @@
+import time
+from datetime import datetime, timedelta
+
+from web import exports
+from web.models import ExportJob
+
+
+PARAMS = ('acute', '1', '2', '', '', 'mean', '', 0)
+
+
+def render(job, progress):
+    progress(0.5)
+    return 'export.csv', b'date,value\n'
+
+
+def wait(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while (job := ExportJob.get_by_id(job.id)).status in ('pending', 'running') and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return job
+
+
+def orphan(age):
+    '''Ждущее задание, поставленное воркером, который завершился, не передав его пулу'''
+    job, created = ExportJob.enqueue(None, *PARAMS)
+    assert created
+    ExportJob.update(created_on=datetime.now() - timedelta(seconds=age)).where(ExportJob.id == job.id).execute()
+    return ExportJob.get_by_id(job.id)
+
+
+def test_stale_pending_job_is_redispatched(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(exports, 'EXPORT_DIR', str(tmp_path))
+    job = orphan(exports.EXPORT_GRACE + 1)
+
+    same, created = exports.submit(render, None, *PARAMS)
+    assert not created and same.id == job.id
+    job = wait(job)
+    assert job.status == 'done'
+    assert (tmp_path / f'{job.id}.csv').read_bytes() == b'date,value\n'
+
+
+def test_fresh_pending_job_is_left_to_its_worker(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(exports, 'EXPORT_DIR', str(tmp_path))
+    job = orphan(0)
+
+    exports.submit(render, None, *PARAMS)
+    time.sleep(0.2)
+    assert ExportJob.get_by_id(job.id).status == 'pending'
+
+
+def test_redispatched_job_runs_once(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(exports, 'EXPORT_DIR', str(tmp_path))
+    job = orphan(exports.EXPORT_GRACE + 1)
+    calls = []
+
+    def counting(job, progress):
+        calls.append(job.id)
+        return render(job, progress)
+
+    # задание уже передано пулу другого процесса: повторная передача его не пересчитывает
+    exports._run(job.id, counting)
+    assert exports.revive(ExportJob.get_by_id(job.id), counting) is False
+    exports._run(job.id, counting)
+    assert calls == [job.id]
@@ -0,0 +1,40 @@
+from datetime import date
+
+import web  # noqa: F401 (myparser импортируется после web)
+from myparser import load_data
+from myparser.adapters import Adapter, Record
+from web.models import MeasurementRegion, RegionGroup, Substance
+
+
+class NewStationAdapter(Adapter):
+    '''Источник, у которого появилась новая станция'''
+    def __init__(self):
+        super().__init__('test', 'Тестовый источник', 'test://')
+
+    def preload(self, start):
+        MeasurementRegion.get_or_create(name='Тестоград,станция 1', address='test', lat=52.0, lng=104.0)
+
+    def tasks(self, start, end):
+        yield start
+
+    def fetch(self, task):
+        return [1.0]
+
+    def parse(self, task, raw):
+        for stat in raw:
+            yield Record(task, Substance.select().first().formula, 'Тестоград,станция 1', stat)
+
+
+def test_loaded_station_gets_city_group(database):
+    assert RegionGroup.get_or_none(name='Тестоград') is None
+    load_data(date(2024, 1, 1), _preload_regions=True, sources=[NewStationAdapter()])
+
+    group = RegionGroup.get(name='Тестоград')
+    assert [x.name for x in group.members()] == ['Тестоград,станция 1']
+
+
+def test_generated_stations_get_city_groups(database):
+    from benchmarks.synthetic import generate
+
+    generate(regions=6, years=1)
+    assert {x.name for x in RegionGroup.all()} >= {'Синтетический город 0', 'Синтетический город 1'}
@@ -0,0 +1,115 @@
+import socket
+from time import perf_counter
+from datetime import datetime, timedelta
+
+from web import app, MAIL_MAX_ATTEMPTS, MAIL_RETRY_DELAY
+from web.models import MailOutbox, Users
+from web.tasks import sending_mail
+
+
+SIGNUP = {'fname': 'Иван', 'lname': 'Иванов', 'email': 'ivan@example.com', 'pass': 'password1', 'rpass': 'password1'}
+
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_signup_does_not_wait_for_smtp(database, smtp):
+    server = smtp(delay=3)
+
+    t = perf_counter()
+    response = app.test_client().post('/signup', data=SIGNUP)
+    elapsed = perf_counter() - t
+
+    assert response.status_code == 200
+    assert elapsed < 1
+    assert server.connections == 0
+    assert Users.exists(SIGNUP['email'])
+    letter = MailOutbox.get(recipient=SIGNUP['email'])
+    assert letter.sent_on is None and letter.attempts == 0
+    assert '/verify/' in letter.html
+
+
+def test_sending_mail_delivers_outbox(database, smtp):
+    server = smtp()
+    app.test_client().post('/signup', data=SIGNUP)
+    MailOutbox.enqueue('petr@example.com', '<p>second</p>')
+
+    sending_mail()
+
+    # все письма ушли через одно соединение
+    assert server.connections == 1
+    assert sorted(x for recipients, _ in server.messages for x in recipients) == \
+        ['<ivan@example.com>', '<petr@example.com>']
+    assert not list(MailOutbox.pending(10, MAIL_MAX_ATTEMPTS))
+    assert all(x.sent_on is not None and x.error is None for x in MailOutbox.all())
+
+
+def test_slow_smtp_only_delays_background_job(database, smtp):
+    server = smtp(delay=0.5)
+    MailOutbox.enqueue('ivan@example.com', '<p>hello</p>')
+
+    sending_mail()
+
+    assert len(server.messages) == 1
+    assert MailOutbox.get().sent_on is not None
+
+
+def test_refused_letter_is_retried_with_backoff(database, smtp):
+    server = smtp(refuse=True)
+    letter = MailOutbox.enqueue('ivan@example.com', '<p>hello</p>')
+
+    t = datetime.now()
+    sending_mail()
+    letter = MailOutbox.get_by_id(letter.id)
+    assert letter.sent_on is None and letter.attempts == 1 and letter.error
+    assert letter.next_try_on >= t + timedelta(seconds=MAIL_RETRY_DELAY)
+
+    # до next_try_on письмо не отправляется повторно
+    sending_mail()
+    assert server.connections == 1
+    assert MailOutbox.get_by_id(letter.id).attempts == 1
+
+    # задержка растет вдвое с каждой попыткой
+    MailOutbox.update(next_try_on=datetime.now()).execute()
+    t = datetime.now()
+    sending_mail()
+    letter = MailOutbox.get_by_id(letter.id)
+    assert server.connections == 2 and letter.attempts == 2
+    assert letter.next_try_on >= t + timedelta(seconds=2 * MAIL_RETRY_DELAY)
+
+    # после исправления сервера письмо уходит
+    server.refuse = False
+    MailOutbox.update(next_try_on=datetime.now()).execute()
+    sending_mail()
+    assert MailOutbox.get_by_id(letter.id).sent_on is not None
+    assert len(server.messages) == 1
+
+
+def test_unreachable_smtp_postpones_whole_batch(database, smtp):
+    smtp()
+    app.extensions['mail'].port = unused_port()
+    for i in range(3):
+        MailOutbox.enqueue(f'user{i}@example.com', '<p>hello</p>')
+
+    sending_mail()
+
+    letters = list(MailOutbox.all())
+    assert all(x.attempts == 1 and x.sent_on is None and x.next_try_on > datetime.now() for x in letters)
+
+
+def test_max_attempts_stops_retries(database, smtp):
+    server = smtp(refuse=True)
+    letter = MailOutbox.enqueue('ivan@example.com', '<p>hello</p>')
+    MailOutbox.update(attempts=MAIL_MAX_ATTEMPTS - 1, next_try_on=datetime.now()).execute()
+
+    sending_mail()
+    assert MailOutbox.get_by_id(letter.id).attempts == MAIL_MAX_ATTEMPTS
+
+    MailOutbox.update(next_try_on=datetime.now()).execute()
+    sending_mail()
+    assert server.connections == 1
+    assert MailOutbox.get_by_id(letter.id).attempts == MAIL_MAX_ATTEMPTS
+    assert not list(MailOutbox.pending(10, MAIL_MAX_ATTEMPTS))
@@ -0,0 +1,31 @@
+import peewee as pw
+
+from web import models
+from web.models import MODELS, AtmosphericMeasurement
+
+
+def test_mk_database_creates_partitioned_table(tmp_path, monkeypatch):
+    database = pw.SqliteDatabase(str(tmp_path / 'partitioned.db'))
+    issued = []
+    execute_sql = database.execute_sql
+
+    def record(sql, *args, **kwargs):
+        # ddl секционирования sqlite не выполнит: записываем, остальное выполняем
+        if 'PARTITION' in sql:
+            issued.append(' '.join(sql.split()))
+            return None
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(database, 'execute_sql', record)
+    monkeypatch.setattr(models, 'partitioned', lambda: True)
+    with database.bind_ctx(MODELS):
+        models.mk_database()
+        table = AtmosphericMeasurement._meta.table_name
+        assert len(issued) == 2
+        assert issued[0].startswith(f'CREATE TABLE "{table}" (')
+        assert 'PRIMARY KEY ("id", "date")' in issued[0]
+        assert issued[0].endswith('PARTITION BY RANGE ("date")')
+        assert issued[1] == f'CREATE TABLE IF NOT EXISTS "{table}_default" PARTITION OF "{table}" DEFAULT'
+        # справочники созданы и заполнены
+        assert models.Substance.select().count()
+    database.close()
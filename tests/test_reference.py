@@ -0,0 +1,33 @@
+from web import models
+from web.models import MeasurementRegion, DataGeneration, _lookup
+from web.spatial import station_index
+
+
+def add_station(name, lat, lng):
+    '''Станция, добавленная загрузкой в другом процессе: без сброса справочников в этом'''
+    region = MeasurementRegion.create(name=name, address=name, lat=lat, lng=lng)
+    DataGeneration.bump()
+    return region
+
+
+def test_new_station_visible_after_generation_change(database, monkeypatch):
+    monkeypatch.setattr(models, 'REFERENCE_CHECK_INTERVAL', 0)
+    first = add_station('first', 52.0, 104.0)
+    assert _lookup('regions', first.id)
+    assert [x.id for x, _ in station_index().nearest(52.0, 104.0, 5)] == [first.id]
+
+    second = add_station('second', 52.1, 104.1)
+    assert _lookup('regions', second.id).name == 'second'
+    assert {x.id for x, _ in station_index().nearest(52.0, 104.0, 5)} == {first.id, second.id}
+
+
+def test_generation_is_rechecked_after_interval(database, monkeypatch):
+    monkeypatch.setattr(models, 'REFERENCE_CHECK_INTERVAL', 3600)
+    models.reset_reference()
+    models.reference()
+    region = add_station('late', 52.0, 104.0)
+    # в пределах интервала поколение не перечитывается
+    assert _lookup('regions', region.id) is None
+
+    monkeypatch.setattr(models, 'REFERENCE_CHECK_INTERVAL', 0)
+    assert _lookup('regions', region.id).name == 'late'
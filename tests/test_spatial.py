@@ -0,0 +1,24 @@
+from benchmarks.synthetic import generate
+from web import models
+from web.models import AtmosphericMeasurement, MeasurementRegion, MeasurementRollup, DataGeneration, Substance
+from web.spatial import point_chart, reset_station_index
+
+
+def test_point_chart_follows_new_data(database, monkeypatch):
+    monkeypatch.setattr(models, 'REFERENCE_CHECK_INTERVAL', 0)
+    generate(regions=2, years=2, gaps=0)
+    reset_station_index()
+    station = MeasurementRegion.select().first()
+    substance = Substance.select().first()
+
+    before = point_chart('acute', station.lat, station.lng, substance.id)
+    assert point_chart('acute', station.lat, station.lng, substance.id) == before
+
+    # загрузка в другом процессе: данные изменились, поколение сменилось
+    AtmosphericMeasurement.update(stat=AtmosphericMeasurement.stat * 2).execute()
+    MeasurementRollup.rebuild()
+    DataGeneration.bump()
+
+    after = point_chart('acute', station.lat, station.lng, substance.id)
+    assert before['datasets'][0]['data']
+    assert after['datasets'] != before['datasets']
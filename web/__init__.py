@@ -24,6 +24,27 @@ app.config['MAIL_MAX_EMAILS'] = MAIL_MAX_EMAILS
 app.config['MAIL_ASCII_ATTACHMENTS'] = MAIL_ASCII_ATTACHMENTS
 mail = Mail(app)
 
+# -----------------metrics-------------- 
+from web import metrics
+metrics.init_app(app, models.db)
+
+# -----------------compression---------- 
+from web import compression
+compression.init_app(app)
+
+# -----------------assets--------------- 
+from web import assets
+assets.init_app(app)
+
+# -----------------sql profiling-------- 
+if SQL_PROFILING:
+    import atexit
+    from web.profiler import QueryProfiler
+    profiler = QueryProfiler(models.db, SQL_SLOW_THRESHOLD, SQL_SLOW_LOG, SQL_N_PLUS_ONE)
+    profiler.init_app(app)
+    profiler.start()
+    atexit.register(profiler.save, SQL_PROFILE_FILE)
+
 # -----------------views---------------- 
 from web import views
 
@@ -0,0 +1,164 @@
+import math
+import threading
+from time import monotonic, perf_counter
+from collections import deque, Counter
+from contextlib import contextmanager
+
+from .metrics import REGISTRY, Gauge, Counter as CounterMetric, Histogram
+from .models import ACUTE_W, CHRONIC_W
+
+
+ADMISSION_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'admission_queue_depth', 'Тяжелые запросы, ожидающие вычисления'))
+ADMISSION_IN_FLIGHT = REGISTRY.register(Gauge(
+    'admission_in_flight_cost', 'Суммарная стоимость выполняющихся тяжелых запросов'))
+ADMISSION_REJECTED = REGISTRY.register(CounterMetric(
+    'admission_rejected_total', 'Отклоненные тяжелые запросы', ('route', 'reason')))
+ADMISSION_WAIT = REGISTRY.register(Histogram(
+    'admission_wait_seconds', 'Ожидание в очереди тяжелых запросов', ('route',)))
+
+# сколько расчетов C по всему окну делает график каждого вида (риск считает острый и хронический)
+WINDOWS = {
+    'acute': (ACUTE_W, ),
+    'chronic': (CHRONIC_W, ),
+    'acute hi': (ACUTE_W, ),
+    'chronic hi': (CHRONIC_W, ),
+    'risk': (ACUTE_W, CHRONIC_W),
+}
+
+
+def estimate(kind, substances=1, regions=1, days=1, window=None):
+    '''
+    Стоимость расчета графика в тысячах ячеек куба (регион x вещество x день, с учетом окна усреднения)
+
+    Args:
+        kind:       str    - вид графика
+        substances: int    - число веществ
+        regions:    int    - число регионов
+        days:       int    - длина периода в днях
+        window:     Window - окно вместо стандартного для вида графика
+
+    Returns:
+        float
+    '''
+    windows = WINDOWS.get(kind, (ACUTE_W, ))
+    if window:
+        windows = (window.lookback, ) * len(windows)
+    return substances * regions * sum(max(days, 0) + w for w in windows) / 1000
+
+
+class Rejected(Exception):
+    '''
+    Запрос не допущен к вычислению
+
+    Fields:
+        status:      int - 429 (у пользователя слишком много тяжелых запросов) или 503 (сервер перегружен)
+        retry_after: int - через сколько секунд повторить
+        reason:      str - 'per_user', 'queue_full' или 'timeout'
+    '''
+    def __init__(self, status, retry_after, reason):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionControl:
+    '''
+    Допуск тяжелых запросов к вычислению: суммарная стоимость выполняющихся не больше capacity,
+    остальные ждут в очереди (в порядке прихода) не дольше timeout. Когда очередь заполнена,
+    запрос сразу отклоняется. Запросы дешевле free выполняются без очереди
+
+    Args:
+        capacity: float - сколько единиц стоимости можно считать одновременно
+        queue:    int   - сколько запросов может ждать
+        timeout:  float - сколько секунд запрос может ждать в очереди
+        per_user: int   - сколько тяжелых запросов может выполняться и ждать у одного пользователя
+        free:     float - запросы с меньшей стоимостью не ограничиваются
+    '''
+    def __init__(self, capacity, queue, timeout, per_user, free):
+        self.capacity = capacity
+        self.queue = queue
+        self.timeout = timeout
+        self.per_user = per_user
+        self.free = free
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._in_flight = 0.0
+        self._users = Counter()
+        # секунд вычисления на единицу стоимости (скользящее среднее), для Retry-After
+        self._speed = 0.005
+        ADMISSION_QUEUE_DEPTH.set(0)
+        ADMISSION_IN_FLIGHT.set(0)
+
+    def retry_after(self):
+        '''Примерное время, за которое освободится место для запроса'''
+        backlog = self._in_flight + sum(cost for cost, _ in self._waiting)
+        return max(1, min(60, math.ceil(backlog * self._speed)))
+
+    def _release_user(self, user):
+        self._users[user] -= 1
+        if not self._users[user]:
+            del self._users[user]
+
+    def _reject(self, route, status, reason):
+        ADMISSION_REJECTED.inc(route=route, reason=reason)
+        raise Rejected(status, self.retry_after(), reason)
+
+    @contextmanager
+    def admit(self, cost, user=None, route=''):
+        '''
+        Контекст вычисления тяжелого запроса
+
+        Args:
+            cost:  float - стоимость (см. estimate)
+            user:  int   - id пользователя
+            route: str   - маршрут для метрик
+
+        Raises:
+            Rejected
+        '''
+        if cost < self.free:
+            yield
+            return
+
+        # запрос дороже всего бюджета выполняется один
+        cost = min(cost, self.capacity)
+        ticket = (cost, object())
+        t = monotonic()
+        with self._cond:
+            if user is not None and self._users[user] >= self.per_user:
+                self._reject(route, 429, 'per_user')
+            if self._waiting or self._in_flight + cost > self.capacity:
+                if len(self._waiting) >= self.queue:
+                    self._reject(route, 503, 'queue_full')
+                self._waiting.append(ticket)
+                self._users[user] += 1
+                ADMISSION_QUEUE_DEPTH.set(len(self._waiting))
+                admitted = self._cond.wait_for(
+                    lambda: self._waiting[0] is ticket and self._in_flight + cost <= self.capacity,
+                    self.timeout)
+                self._waiting.remove(ticket)
+                ADMISSION_QUEUE_DEPTH.set(len(self._waiting))
+                # следующий в очереди мог ждать только этот запрос (места может хватить и ему)
+                self._cond.notify_all()
+                if not admitted:
+                    self._release_user(user)
+                    self._reject(route, 503, 'timeout')
+            else:
+                self._users[user] += 1
+            self._in_flight += cost
+            ADMISSION_IN_FLIGHT.set(self._in_flight)
+        ADMISSION_WAIT.observe(monotonic() - t, route=route)
+
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - started
+            with self._cond:
+                self._in_flight -= cost
+                self._release_user(user)
+                self._speed = 0.8 * self._speed + 0.2 * elapsed / cost
+                ADMISSION_IN_FLIGHT.set(self._in_flight)
+                self._cond.notify_all()
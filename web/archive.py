@@ -0,0 +1,145 @@
+import os
+import re
+import numpy as np
+
+from config import ARCHIVE_CACHE_SIZE
+from .cache import LRUCache
+
+
+# столбцы архива: дата (datetime64[D]), id вещества, региона и источника, показание
+COLUMNS = ('date', 'substance', 'region', 'source', 'stat')
+DTYPES = {'date': 'datetime64[D]', 'substance': np.int32, 'region': np.int32, 'source': np.int32, 'stat': np.float64}
+
+_name = re.compile(r'^measurements-(\d{4})\.npz$')
+# прочитанные архивы по (файл, время изменения): перезаписанный архив читается заново
+_cache = LRUCache('archive', ARCHIVE_CACHE_SIZE)
+_bounds = {}
+
+
+def path(directory, year):
+    return os.path.join(directory, f'measurements-{year}.npz')
+
+
+def years(directory):
+    '''Заархивированные годы по возрастанию'''
+    if not directory or not os.path.isdir(directory):
+        return []
+    return sorted(int(m[1]) for x in os.listdir(directory) if (m := _name.match(x)))
+
+
+def empty():
+    return {x: np.empty(0, dtype=DTYPES[x]) for x in COLUMNS}
+
+
+def columns(rows):
+    '''Строки (дата, вещество, регион, источник, показание) -> столбцы архива'''
+    if not rows:
+        return empty()
+    result = {}
+    for name, values in zip(COLUMNS, zip(*rows)):
+        if name == 'stat':
+            values = [np.nan if x is None else x for x in values]
+        result[name] = np.asarray(values, dtype=DTYPES[name])
+    return result
+
+
+def concat(parts):
+    parts = list(parts)
+    if not parts:
+        return empty()
+    return {x: np.concatenate([p[x] for p in parts]) for x in COLUMNS}
+
+
+def read(directory, year):
+    '''
+    Столбцы архива за год (кешируются в памяти)
+
+    Returns:
+        dict[str, np.ndarray]
+    '''
+    file = path(directory, year)
+    key = (os.path.abspath(file), os.stat(file).st_mtime_ns)
+
+    def load():
+        with np.load(file) as f:
+            return {x: f[x] for x in COLUMNS}
+
+    return _cache.get_or_compute(key, load)
+
+
+def write(directory, year, data):
+    '''
+    Записывает измерения за год в архив. Если архив за год уже есть, измерения добавляются к нему,
+    при совпадении (дата, вещество, регион) остается уже заархивированное (первое показание побеждает, как в бд)
+
+    Args:
+        directory: str
+        year:      int
+        data:      dict[str, np.ndarray] - столбцы COLUMNS
+
+    Returns:
+        int - число измерений в архиве
+    '''
+    os.makedirs(directory, exist_ok=True)
+    if year in years(directory):
+        data = concat([read(directory, year), data])
+
+    # сортировка по региону, веществу и дате: соседние значения похожи и лучше сжимаются
+    order = np.lexsort((data['date'], data['substance'], data['region']))
+    data = {x: data[x][order] for x in COLUMNS}
+    keys = np.stack([data['region'], data['substance'], data['date'].astype(np.int64)], axis=1)
+    _, first = np.unique(keys, axis=0, return_index=True)
+    # lexsort устойчивый, поэтому первым среди одинаковых ключей остается заархивированное ранее
+    data = {x: data[x][np.sort(first)] for x in COLUMNS}
+
+    file = path(directory, year)
+    tmp = file + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, **data)
+    # читатели видят либо старый, либо новый архив целиком
+    os.replace(tmp, file)
+    return len(data['date'])
+
+
+def select(directory, start, end, regions=None, substances=None):
+    '''
+    Измерения из архивов за даты [start, end]
+
+    Args:
+        directory:  str
+        start:      date
+        end:        date
+        regions:    list[int] - id регионов (по умолчанию все)
+        substances: list[int] - id веществ (по умолчанию все)
+
+    Returns:
+        dict[str, np.ndarray] - столбцы COLUMNS
+    '''
+    parts = []
+    for year in years(directory):
+        if not start.year <= year <= end.year:
+            continue
+        data = read(directory, year)
+        mask = (data['date'] >= np.datetime64(start, 'D')) & (data['date'] <= np.datetime64(end, 'D'))
+        if regions is not None:
+            mask &= np.isin(data['region'], regions)
+        if substances is not None:
+            mask &= np.isin(data['substance'], substances)
+        parts.append({x: data[x][mask] for x in COLUMNS})
+    return concat(parts)
+
+
+def bounds(directory):
+    '''
+    Первая и последняя дата в архивах (запоминается, пока не изменился набор файлов)
+
+    Returns:
+        tuple[date, date]|None
+    '''
+    archived = years(directory)
+    key = (os.path.abspath(directory), tuple((x, os.stat(path(directory, x)).st_mtime_ns) for x in archived))
+    if key not in _bounds:
+        dates = [d for d in (read(directory, x)['date'] for x in archived) if len(d)]
+        _bounds.clear()
+        _bounds[key] = (dates[0].min().item(), dates[-1].max().item()) if dates else None
+    return _bounds[key]
@@ -0,0 +1,135 @@
+import os
+import json
+import shutil
+import hashlib
+import mimetypes
+from flask import url_for, send_from_directory
+
+from config import ASSETS_DIR, ASSETS_MAX_AGE
+from .compression import ENCODINGS, compress, negotiate
+
+try:
+    import rjsmin
+    import rcssmin
+except ImportError:  # без минификаторов файлы только получают хеш и сжимаются
+    rjsmin = rcssmin = None
+
+
+MANIFEST = 'manifest.json'
+# расширения сжатых вариантов файлов
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+TEXT_EXTENSIONS = ('.js', '.css', '.svg', '.json', '.txt', '.html')
+
+# исходное имя файла -> имя собранного файла (относительно папки static)
+_manifest = {}
+# собранный файл -> кодировки, для которых есть сжатый вариант
+_variants = {}
+
+
+def minify(path, data):
+    '''Минифицирует js и css (уже минифицированные *.min.* не трогает)'''
+    name = os.path.basename(path)
+    if '.min.' in name or rjsmin is None:
+        return data
+    if name.endswith('.js'):
+        return rjsmin.jsmin(data.decode('utf-8')).encode('utf-8')
+    if name.endswith('.css'):
+        return rcssmin.cssmin(data.decode('utf-8')).encode('utf-8')
+    return data
+
+
+def build(static_folder, out=ASSETS_DIR):
+    '''
+    Собирает статику: минифицирует, добавляет в имя хеш содержимого и пишет сжатые варианты
+
+    Args:
+        static_folder: str - папка статики приложения
+        out:           str - папка сборки внутри static_folder (пересоздается)
+
+    Returns:
+        dict - исходное имя -> {file, size, minified, variants: {кодировка: размер}}
+    '''
+    target = os.path.join(static_folder, out)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+
+    manifest = {}
+    report = {}
+    for root, dirs, files in os.walk(static_folder):
+        # сборку предыдущего запуска не собираем
+        dirs[:] = [x for x in dirs if os.path.join(root, x) != target]
+        for file in sorted(files):
+            source = os.path.join(root, file)
+            name = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            small = minify(name, data)
+            stem, ext = os.path.splitext(name)
+            built = f'{out}/{stem}.{hashlib.sha256(small).hexdigest()[:12]}{ext}'
+            path = os.path.join(static_folder, built)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(small)
+
+            variants = {}
+            if ext in TEXT_EXTENSIONS:
+                for encoding in ENCODINGS:
+                    packed = compress(small, encoding)
+                    # сжатие, которое не уменьшило файл, не сохраняем
+                    if len(packed) < len(small):
+                        with open(path + SUFFIXES[encoding], 'wb') as f:
+                            f.write(packed)
+                        variants[encoding] = len(packed)
+
+            manifest[name] = built
+            report[name] = {'file': built, 'size': len(data), 'minified': len(small), 'variants': variants}
+
+    with open(os.path.join(target, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+    return report
+
+
+def load(static_folder, out=ASSETS_DIR):
+    '''Загружает манифест сборки (если сборки нет, статика отдается как есть)'''
+    _manifest.clear()
+    _variants.clear()
+    path = os.path.join(static_folder, out, MANIFEST)
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as f:
+        _manifest.update(json.load(f))
+    for built in _manifest.values():
+        _variants[built] = [x for x in ENCODINGS if os.path.exists(os.path.join(static_folder, built + SUFFIXES[x]))]
+
+
+def asset(filename):
+    '''url_for статического файла: собранная версия с хешем, если есть сборка'''
+    return url_for('static', filename=_manifest.get(filename, filename))
+
+
+def init_app(app):
+    '''Подключает asset() к шаблонам и отдачу собранных файлов со сжатием и долгим кешированием'''
+    load(app.static_folder)
+    app.jinja_env.globals['asset'] = asset
+    default = app.view_functions['static']
+
+    def static(filename):
+        if filename not in _variants:
+            return default(filename=filename)
+
+        encoding = negotiate()
+        if encoding not in _variants[filename]:
+            encoding = None
+        mimetype = mimetypes.guess_type(filename)[0]
+        response = send_from_directory(app.static_folder, filename + SUFFIXES.get(encoding, ''),
+                                       mimetype=mimetype, max_age=ASSETS_MAX_AGE)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        # имя меняется вместе с содержимым - файл можно кешировать навсегда
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    app.view_functions['static'] = static
@@ -0,0 +1,98 @@
+import threading
+from time import monotonic
+from collections import OrderedDict
+
+from .metrics import cache_hit, CACHE_COALESCED
+
+
+_MISSING = object()
+
+
+class _Flight:
+    '''Вычисление значения, которое ждут остальные запросы с тем же ключом'''
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LRUCache:
+    '''
+    Потокобезопасный LRU кеш с временем жизни записей.
+    Одновременные промахи по одному ключу вычисляются один раз (single-flight)
+
+    Args:
+        name:    str   - имя кеша в метриках
+        maxsize: int   - максимальное число записей
+        ttl:     float - время жизни записи в секундах (None - бессрочно)
+    '''
+    def __init__(self, name, maxsize=1024, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and self.ttl is not None and monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                item = _MISSING
+            if item is not _MISSING:
+                self._data.move_to_end(key)
+        cache_hit(self.name, item is not _MISSING)
+        return default if item is _MISSING else item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def get_or_compute(self, key, func):
+        '''
+        Значение из кеша или результат func() (который сохраняется в кеш).
+        Если тот же ключ уже вычисляется в другом потоке, ждет его результат
+        '''
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING:
+                # успели посчитать между get и блокировкой
+                return item[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            CACHE_COALESCED.inc(cache=self.name)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self.set(key, func())
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
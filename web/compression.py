@@ -0,0 +1,106 @@
+import gzip
+import threading
+import unicodedata
+from urllib.parse import quote
+from flask import request, Response
+
+from config import COMPRESSION_MIN_SIZE, COMPRESSION_GZIP_LEVEL, COMPRESSION_BROTLI_QUALITY
+
+try:
+    import brotli
+except ImportError:  # brotli не установлен - отдаем только gzip
+    brotli = None
+
+
+# в порядке предпочтения при равных весах в Accept-Encoding
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip', )
+COMPRESSIBLE = ('application/json', 'text/csv', 'text/html', 'text/plain', 'text/css',
+                'application/javascript', 'text/javascript', 'image/svg+xml')
+
+
+def compress(body, encoding):
+    '''Сжимает байты в кодировке 'br' или 'gzip' '''
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, COMPRESSION_GZIP_LEVEL, mtime=0)
+    raise ValueError(f'unexpected encoding "{encoding}"')
+
+
+def negotiate(size=None):
+    '''
+    Кодировка ответа текущему запросу по Accept-Encoding
+
+    Args:
+        size: int - размер тела, меньше COMPRESSION_MIN_SIZE не сжимаем
+
+    Returns:
+        str|None - 'br', 'gzip' или None (без сжатия)
+    '''
+    if size is not None and size < COMPRESSION_MIN_SIZE:
+        return None
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def attachment(name):
+    '''Заголовок Content-Disposition для скачивания файла name (в том числе с не-ascii именем)'''
+    try:
+        name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+        return f"attachment; filename=\"{simple}\"; filename*=UTF-8''{quote(name, safe='!#$&+-.^_`|~')}"
+    return f'attachment; filename="{name}"'
+
+
+class Payload:
+    '''
+    Готовое тело ответа и его сжатые варианты (считаются при первом запросе с такой кодировкой)
+
+    Args:
+        body:     bytes - тело без сжатия
+        mimetype: str
+        headers:  dict  - дополнительные заголовки ответа
+    '''
+    def __init__(self, body, mimetype, headers=None):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers or {}
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.body)
+
+    def encoded(self, encoding):
+        '''Тело в кодировке encoding (None - без сжатия)'''
+        if encoding is None:
+            return self.body
+        with self._lock:
+            if encoding not in self._encoded:
+                self._encoded[encoding] = compress(self.body, encoding)
+            return self._encoded[encoding]
+
+    def response(self):
+        '''Ответ на текущий запрос с подходящим сжатием'''
+        encoding = negotiate(len(self.body))
+        response = Response(self.encoded(encoding), mimetype=self.mimetype, headers=self.headers)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+def init_app(app):
+    '''Сжимает остальные текстовые ответы приложения на лету'''
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE):
+            return response
+        encoding = negotiate(response.content_length)
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            response.set_data(compress(response.get_data(), encoding))
+            response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,168 @@
+import numpy as np
+from contextlib import nullcontext
+
+from config import CORRELATION_CACHE_SIZE, CORRELATION_MIN_PERIODS
+from .cache import LRUCache
+from .models import AtmosphericMeasurement, DataGeneration, aggregate, ACUTE_W, CHRONIC_W
+
+
+_cache = LRUCache('correlation', CORRELATION_CACHE_SIZE)
+
+
+def pearson(values, min_periods=CORRELATION_MIN_PERIODS):
+    '''
+    Попарная корреляция Пирсона строк по общим дням без пропусков (nan) - матричными произведениями,
+    без перебора пар
+
+    Args:
+        values:      np.ndarray[ряд][дата] - показания (nan где нет показаний)
+        min_periods: int                   - минимум общих дней, иначе nan
+
+    Returns:
+        tuple[np.ndarray[ряд][ряд], np.ndarray[ряд][ряд]] - коэффициенты и число общих дней
+    '''
+    values = np.asarray(values, dtype=float)
+    present = ~np.isnan(values)
+    m = present.astype(float)
+    # сдвиг к среднему не меняет коэффициенты, но уменьшает потерю точности в суммах квадратов
+    with np.errstate(invalid='ignore', divide='ignore'):
+        center = np.nansum(values, axis=1) / m.sum(axis=1)
+    x = np.where(present, values - np.nan_to_num(center)[:, None], 0.0)
+    x2 = x * x
+
+    # суммы по дням, где есть показания у обоих рядов пары
+    n = m @ m.T
+    sx = x @ m.T
+    sy = sx.T
+    sxx = x2 @ m.T
+    syy = sxx.T
+    sxy = x @ x.T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy - sx * sy / n
+        var = (sxx - sx * sx / n) * (syy - sy * sy / n)
+        r = cov / np.sqrt(var)
+    r[(n < max(min_periods, 2)) | ~(var > 0)] = np.nan
+    return np.clip(r, -1, 1), n.astype(int)
+
+
+def rank(values):
+    '''
+    Ранги показаний каждой строки среди ее собственных дней без пропусков (одинаковым значениям - средний ранг)
+
+    Args:
+        values: np.ndarray[ряд][дата]
+
+    Returns:
+        np.ndarray[ряд][дата] - ранги с 1 (nan там, где были пропуски)
+    '''
+    values = np.asarray(values, dtype=float)
+    result = np.full(values.shape, np.nan)
+    for i, row in enumerate(values):
+        present = ~np.isnan(row)
+        if present.any():
+            _, inverse, counts = np.unique(row[present], return_inverse=True, return_counts=True)
+            # средний ранг группы одинаковых значений
+            result[i, present] = (np.cumsum(counts) - (counts - 1) / 2)[inverse]
+    return result
+
+
+def spearman(values, min_periods=CORRELATION_MIN_PERIODS):
+    '''
+    Корреляция Спирмена: Пирсон по рангам. Ранги считаются по всем дням ряда, а не заново для каждой пары,
+    поэтому при разных пропусках у рядов это приближение
+
+    Returns:
+        tuple[np.ndarray[ряд][ряд], np.ndarray[ряд][ряд]] - коэффициенты и число общих дней
+    '''
+    return pearson(rank(values), min_periods)
+
+
+def co_exceedance(values, limits):
+    '''
+    Число дней, в которые оба ряда пары превышали свой предел
+
+    Args:
+        values: np.ndarray[ряд][дата] - показания (nan не считается превышением)
+        limits: np.ndarray[ряд]       - предел для каждого ряда
+
+    Returns:
+        np.ndarray[ряд][ряд] - на диагонали число дней превышения самого ряда
+    '''
+    with np.errstate(invalid='ignore'):
+        exceed = (np.asarray(values, dtype=float) > np.asarray(limits, dtype=float)[:, None]).astype(float)
+    return (exceed @ exceed.T).astype(int)
+
+
+METHODS = {
+    'pearson': pearson,
+    'spearman': spearman,
+}
+
+
+def correlation(axis, kind, start, end, regions, substances, method='pearson', agg='mean',
+                min_periods=CORRELATION_MIN_PERIODS, guard=None):
+    '''
+    Корреляции и совместные превышения пдк между регионами (для одного вещества) или между веществами
+    (для одного региона или свертки группы регионов) по кубу показаний. Кешируется по поколению данных
+
+    Args:
+        axis:        str                      - 'regions' или 'substances'
+        kind:        str                      - 'acute' (среднесуточные, пдк с.с.) или 'chronic' (среднегодовые, пдк с.г.)
+        start:       date                     - дата начала
+        end:         date                     - дата конца
+        regions:     list[MeasurementRegion]  - регионы
+        substances:  list[Substance]          - вещества (для axis='regions' - одно)
+        method:      str                      - 'pearson' или 'spearman'
+        agg:         str                      - свертка регионов для axis='substances'
+        min_periods: int                      - минимум общих дней для коэффициента
+        guard:       callable                 - контекст, в котором выполняется расчет при промахе кеша
+
+    Returns:
+        dict - ids, labels, correlation, observations, co_exceedance (матрицы списками, None вместо nan)
+
+    Raises:
+        ValueError - неизвестные axis, kind, method или agg
+    '''
+    if axis not in ('regions', 'substances'):
+        raise ValueError(f'unexpected axis "{axis}", use "regions" or "substances"')
+    if kind not in ('acute', 'chronic'):
+        raise ValueError(f'unexpected kind "{kind}", use "acute" or "chronic"')
+    if method not in METHODS:
+        raise ValueError(f'unexpected method "{method}", use {", ".join(METHODS)}')
+    if axis == 'regions' and len(substances) != 1:
+        raise ValueError('correlation between regions needs exactly one substance')
+
+    key = (DataGeneration.current(), axis, kind, start, end, tuple(x.id for x in regions),
+           tuple(x.id for x in substances), method, agg, min_periods)
+
+    def evaluate():
+        w = ACUTE_W if kind == 'acute' else CHRONIC_W
+        _, values = AtmosphericMeasurement.cube(start, end, substances, regions, w)
+        if axis == 'regions':
+            series, items = values[:, 0, :], regions
+            limit = substances[0].daily_pdk if kind == 'acute' else substances[0].yearly_pdk
+            limits = np.full(len(regions), limit, dtype=float)
+        else:
+            series, items = aggregate(values, agg).reshape(len(substances), -1), substances
+            limits = np.asarray([x.daily_pdk if kind == 'acute' else x.yearly_pdk for x in substances], dtype=float)
+
+        r, n = METHODS[method](series, min_periods)
+        return {
+            'axis': axis,
+            'kind': kind,
+            'method': method,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'ids': [x.id for x in items],
+            'labels': [x.name if axis == 'regions' else x.formula for x in items],
+            'correlation': [[None if np.isnan(v) else round(float(v), 6) for v in row] for row in r],
+            'observations': n.tolist(),
+            'co_exceedance': co_exceedance(series, limits).tolist(),
+        }
+
+    def compute():
+        with guard() if guard else nullcontext():
+            return evaluate()
+
+    return _cache.get_or_compute(key, compute)
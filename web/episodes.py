@@ -0,0 +1,142 @@
+import numpy as np
+
+
+def _rows(a):
+    '''Массив [..., дата] -> [строка][дата]'''
+    return a.reshape(int(np.prod(a.shape[:-1], dtype=int)), a.shape[-1])
+
+
+def runs(mask):
+    '''
+    Кодирование длин серий: непрерывные отрезки True вдоль последней оси
+
+    Args:
+        mask: np.ndarray[..., дата] - булев массив
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray] - номер строки (в mask.reshape(-1, дни)), начало и конец (не включая) каждого отрезка
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    flat = _rows(mask)
+    padded = np.zeros((flat.shape[0], flat.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = flat
+    d = np.diff(padded, axis=1)
+    # argwhere обходит массив построчно, поэтому начала и концы отрезков идут парами
+    starts = np.argwhere(d == 1)
+    ends = np.argwhere(d == -1)
+    return starts[:, 0], starts[:, 1], ends[:, 1]
+
+
+def find_episodes(values, threshold=1, min_length=1):
+    '''
+    Эпизоды превышения: отрезки не короче min_length дней, в которые values >= threshold
+
+    Args:
+        values:     np.ndarray[..., дата] - показания (nan не считается превышением)
+        threshold:  float                 - пороговое значение
+        min_length: int                   - минимальная длительность эпизода в днях
+
+    Returns:
+        dict[str, np.ndarray] - index (индексы по ведущим осям), start, end (не включая), duration, peak, area (площадь над порогом)
+    '''
+    values = np.asarray(values, dtype=float)
+    with np.errstate(invalid='ignore'):
+        mask = values >= threshold
+    row, start, end = runs(mask)
+
+    keep = end - start >= min_length
+    row, start, end = row[keep], start[keep], end[keep]
+
+    n = values.shape[-1]
+    flat = np.nan_to_num(_rows(values)).ravel()
+    begin = row * n + start
+    finish = row * n + end
+
+    if len(begin):
+        # максимум на отрезке [begin, finish): reduceat по парам границ, берем только четные результаты
+        bounds = np.stack([begin, finish], axis=1).ravel()
+        peak = np.maximum.reduceat(np.append(flat, 0), bounds)[::2]
+        excess = np.concatenate([[0], np.cumsum(flat - threshold)])
+        area = excess[finish] - excess[begin]
+    else:
+        peak = area = np.zeros(0)
+
+    return {
+        'index': np.unravel_index(row, values.shape[:-1]) if values.ndim > 1 else (),
+        'start': start,
+        'end': end,
+        'duration': end - start,
+        'peak': peak,
+        'area': area,
+    }
+
+
+def episode_mask(values, min_length, threshold=1):
+    '''
+    Маска дней, попадающих в эпизоды превышения не короче min_length
+
+    Returns:
+        np.ndarray[bool] - той же формы, что и values
+    '''
+    values = np.asarray(values, dtype=float)
+    with np.errstate(invalid='ignore'):
+        mask = values >= threshold
+    row, start, end = runs(mask)
+    keep = end - start >= min_length
+    row, start, end = row[keep], start[keep], end[keep]
+
+    # разметка границ отрезков +1/-1 и кумулятивная сумма дают маску без цикла по эпизодам
+    n = values.shape[-1]
+    marks = np.zeros((_rows(values).shape[0], n + 1), dtype=np.int32)
+    np.add.at(marks, (row, start), 1)
+    np.add.at(marks, (row, end), -1)
+    return (np.cumsum(marks, axis=1)[:, :n] > 0).reshape(values.shape)
+
+
+def health_episodes(start, end, regions=None, points=None, kinds=('acute hi', 'chronic hi'), threshold=1, min_length=None):
+    '''
+    Эпизоды превышения HI для всех регионов x органов x видов влияния одним пакетом
+
+    Args:
+        start:      date                                      - дата начала
+        end:        date                                      - дата конца
+        regions:    MeasurementRegion|list[MeasurementRegion] - регионы (по умолчанию все)
+        points:     HealthPoint|list[HealthPoint]             - органы (по умолчанию все, у которых есть вещества)
+        kinds:      tuple[str]                                - 'acute hi' и/или 'chronic hi'
+        threshold:  float                                     - пороговое значение HI
+        min_length: int                                       - минимальная длительность (по умолчанию ACUTE_EPISODE/CHRONIC_EPISODE)
+
+    Returns:
+        list[dict] - эпизоды, отсортированные по региону, органу, виду и началу
+    '''
+    from .models import AtmosphericMeasurement, HealthPoint, ACUTE_EPISODE, CHRONIC_EPISODE
+
+    regions = AtmosphericMeasurement.validate_regions(regions)
+    if points is None:
+        points = list(HealthPoint.possible_all())
+    elif not hasattr(points, '__iter__'):
+        points = [points, ]
+
+    result = []
+    for kind in kinds:
+        type = kind.split()[0]
+        length = min_length or (ACUTE_EPISODE if type == 'acute' else CHRONIC_EPISODE)
+        # по порциям регионов, в памяти HI одной порции
+        for part, x, hi in AtmosphericMeasurement.stream_HI(type, start, end, points, regions):
+            e = find_episodes(hi, threshold, length)
+            for r, p, s, t, peak, area in zip(*e['index'], e['start'], e['end'], e['peak'], e['area']):
+                result.append({
+                    'region_id': part[r].id,
+                    'region': part[r].name,
+                    'health_point_id': points[p].id,
+                    'health_point': points[p].name,
+                    'kind': kind,
+                    'start': x[s].isoformat(),
+                    'end': x[t - 1].isoformat(),
+                    'duration': int(t - s),
+                    'peak': float(peak),
+                    'area': float(area),
+                })
+
+    result.sort(key=lambda x: (x['region_id'], x['health_point_id'], x['kind'], x['start']))
+    return result
@@ -0,0 +1,127 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from config import EXPORT_DIR, EXPORT_WORKERS, EXPORT_TTL, EXPORT_TIMEOUT, EXPORT_GRACE
+from .models import db, ExportJob
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# одинаковые задания, поставленные одновременно из разных потоков процесса, не должны создаться дважды
+_enqueue_lock = threading.Lock()
+# задания, уже переданные пулу этого процесса
+_submitted = set()
+
+
+def path(id):
+    '''Файл готовой выгрузки'''
+    return os.path.join(EXPORT_DIR, f'{id}.csv')
+
+
+def pool():
+    '''
+    Пул потоков выгрузок текущего процесса. Создается при первой выгрузке:
+    под serve это происходит уже в воркере, потоки главного процесса форк не переживают
+    '''
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(EXPORT_WORKERS, thread_name_prefix='export')
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def submit(render, user, kind, region, option, start, end, agg, window, generation):
+    '''
+    Ставит выгрузку в очередь. Одинаковая ждущая, считающаяся или готовая выгрузка не дублируется
+
+    Args:
+        render: callable(ExportJob, progress) -> tuple[str, bytes] - имя файла и содержимое выгрузки,
+                progress(float) отмечает долю выполненной работы
+
+    Returns:
+        tuple[ExportJob, bool] - задание и создано ли оно сейчас
+    '''
+    with _enqueue_lock:
+        job, created = ExportJob.enqueue(user, kind, region, option, start, end, agg, window, generation)
+    if created:
+        _dispatch(job.id, render)
+    else:
+        revive(job, render)
+    return job, created
+
+
+def revive(job, render):
+    '''
+    Передает пулу этого процесса задание, которое ждет дольше EXPORT_GRACE секунд: процесс, который его поставил,
+    мог завершиться или перезапуститься. Дважды задание не посчитается (см. ExportJob.claim)
+
+    Returns:
+        bool - передано ли задание
+    '''
+    if job.status != 'pending' or job.id in _submitted:
+        return False
+    if job.created_on > datetime.now() - timedelta(seconds=EXPORT_GRACE):
+        return False
+    _dispatch(job.id, render)
+    return True
+
+
+def _dispatch(id, render):
+    with _pool_lock:
+        if id in _submitted:
+            return
+        _submitted.add(id)
+    pool().submit(_run, id, render)
+
+
+def _run(id, render):
+    '''Считает выгрузку id в потоке пула и кладет результат в EXPORT_DIR'''
+    try:
+        if not ExportJob.claim(id):
+            return
+        job = ExportJob.get_by_id(id)
+        try:
+            name, body = render(job, job.report)
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            file = path(id)
+            tmp = file + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(body)
+            # скачивающие видят файл только целиком
+            os.replace(tmp, file)
+            job.finish(name, len(body), EXPORT_TTL)
+        except Exception as e:
+            job.fail(e, EXPORT_TTL)
+    finally:
+        with _pool_lock:
+            _submitted.discard(id)
+        # соединения sqlite у каждого потока свои, поток пула может долго простаивать
+        if not db.is_closed():
+            db.close()
+
+
+def clear():
+    '''
+    Удаляет истекшие и потерянные задания и их файлы, а также файлы без заданий
+
+    Returns:
+        int - число удаленных заданий
+    '''
+    removed = 0
+    for job in ExportJob.expired(EXPORT_TIMEOUT):
+        job.delete_instance()
+        removed += 1
+
+    if os.path.isdir(EXPORT_DIR):
+        known = {x for x, in ExportJob.select(ExportJob.id).tuples()}
+        for name in os.listdir(EXPORT_DIR):
+            if name.split('.')[0] not in known:
+                try:
+                    os.remove(os.path.join(EXPORT_DIR, name))
+                except OSError:
+                    pass
+    return removed
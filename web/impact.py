@@ -0,0 +1,85 @@
+import numpy as np
+from contextlib import nullcontext
+
+from config import IMPACT_CACHE_SIZE
+from .cache import LRUCache
+from .models import AtmosphericMeasurement, DataGeneration
+
+
+_cache = LRUCache('impact', IMPACT_CACHE_SIZE)
+
+
+def summarize(hi, threshold=1):
+    '''
+    Сводка куба HI для тепловой карты регион x орган
+
+    Args:
+        hi:        np.ndarray[регион][орган][дата]
+        threshold: float - пороговое значение HI
+
+    Returns:
+        dict[str, np.ndarray[регион][орган]] - max, mean, last (последнее значение), days_above, share_above
+    '''
+    days = hi.shape[-1]
+    with np.errstate(invalid='ignore'):
+        above = (hi > threshold).sum(axis=-1)
+    return {
+        'max': hi.max(axis=-1) if days else np.zeros(hi.shape[:-1]),
+        'mean': hi.mean(axis=-1) if days else np.zeros(hi.shape[:-1]),
+        'last': hi[..., -1] if days else np.zeros(hi.shape[:-1]),
+        'days_above': above,
+        'share_above': above / days if days else np.zeros(hi.shape[:-1]),
+    }
+
+
+def _round(a, digits=4):
+    return np.round(a.astype(float), digits).tolist()
+
+
+def impact(type, start, end, regions, points, threshold=1, cube=True, guard=None):
+    '''
+    Влияние на все органы во всех регионах: HQ считается один раз для всех веществ, HI всех органов -
+    одним матричным умножением на матрицу вхождения веществ в органы (см. AtmosphericMeasurement.stream_HI).
+    Кешируется по поколению данных
+
+    Args:
+        type:      str                     - 'acute' или 'chronic'
+        start:     date                    - дата начала
+        end:       date                    - дата конца
+        regions:   list[MeasurementRegion] - регионы
+        points:    list[HealthPoint]       - органы
+        threshold: float                   - пороговое значение HI для сводки
+        cube:      bool                    - включать ли в ответ весь куб [регион][орган][дата]
+        guard:     callable                - контекст, в котором выполняется расчет при промахе кеша
+
+    Returns:
+        dict - regions, health_points, labels, summary (матрицы регион x орган) и cube
+    '''
+    key = (DataGeneration.current(), type, start, end, tuple(x.id for x in regions), tuple(x.id for x in points),
+           threshold, cube)
+
+    def evaluate():
+        # по порциям регионов: в памяти куб одной порции, сводки порций склеиваются
+        summaries, cubes = [], []
+        for _, x, hi in AtmosphericMeasurement.stream_HI(type, start, end, points, regions):
+            summaries.append(summarize(hi, threshold))
+            if cube:
+                cubes += _round(hi)
+        summary = {k: np.concatenate([x[k] for x in summaries]) for k in summaries[0]}
+        data = {
+            'kind': f'{type} hi',
+            'threshold': threshold,
+            'regions': [{'id': x.id, 'name': x.name} for x in regions],
+            'health_points': [{'id': x.id, 'name': x.name} for x in points],
+            'labels': list(map(str, x)),
+            'summary': {k: v.tolist() if v.dtype.kind == 'i' else _round(v) for k, v in summary.items()},
+        }
+        if cube:
+            data['cube'] = cubes
+        return data
+
+    def compute():
+        with guard() if guard else nullcontext():
+            return evaluate()
+
+    return _cache.get_or_compute(key, compute)
@@ -0,0 +1,214 @@
+import threading
+from time import perf_counter
+from functools import wraps
+from contextlib import contextmanager
+from collections import defaultdict
+from flask import g, request, has_request_context
+
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+KINDS = ('acute', 'chronic', 'acute hi', 'chronic hi', 'risk')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class Metric:
+    '''
+    Базовая метрика в формате prometheus
+
+    Fields:
+        name:   str        - имя метрики
+        help:   str        - описание
+        labels: tuple[str] - имена меток
+    '''
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, n in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{_labels(self.labels, key, [("le", bound)])} {n}')
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, [("le", "+Inf")])} {count}')
+                lines.append(f'{self.name}_sum{_labels(self.labels, key)} {total}')
+                lines.append(f'{self.name}_count{_labels(self.labels, key)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'Длительность обработки запроса', ('route', 'kind')))
+REQUEST_QUERIES = REGISTRY.register(Histogram(
+    'http_request_db_queries', 'Число sql-запросов за один http-запрос', ('route',),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    'cache_requests_total', 'Обращения к кешам', ('cache', 'result')))
+CACHE_COALESCED = REGISTRY.register(Counter(
+    'cache_coalesced_total', 'Запросы, дождавшиеся чужого вычисления того же значения', ('cache',)))
+JOB_DURATION = REGISTRY.register(Histogram(
+    'scheduler_job_duration_seconds', 'Длительность фоновых задач', ('job',),
+    buckets=(.1, 1, 10, 60, 300, 900, 3600)))
+JOB_ERRORS = REGISTRY.register(Counter(
+    'scheduler_job_errors_total', 'Фоновые задачи, завершившиеся ошибкой', ('job',)))
+SCRAPER_LATENCY = REGISTRY.register(Histogram(
+    'scraper_request_duration_seconds', 'Длительность запросов парсера к источникам', ('source',)))
+SCRAPER_ERRORS = REGISTRY.register(Counter(
+    'scraper_errors_total', 'Ошибки запросов парсера к источникам', ('source', 'reason')))
+
+
+@contextmanager
+def span(name, db=False):
+    '''
+    Замер участка обработки запроса для заголовка Server-Timing
+
+    Args:
+        name: str  - название участка
+        db:   bool - включать ли sql-запросы внутри участка в его время.
+                     Если False, их время уходит в участок "db"
+    '''
+    if not has_request_context() or 'timings' not in g:
+        yield
+        return
+
+    own_db, g.own_db = g.own_db, db
+    db_before = g.timings['db']
+    t = perf_counter()
+    try:
+        yield
+    finally:
+        g.own_db = own_db
+        g.timings[name] += perf_counter() - t - (g.timings['db'] - db_before)
+
+
+def cache_hit(cache, hit):
+    '''Учитывает обращение к кешу cache'''
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def timed_job(func):
+    '''Декоратор фоновых задач: замеряет длительность и считает ошибки'''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        t = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            JOB_ERRORS.inc(job=func.__name__)
+            raise
+        finally:
+            JOB_DURATION.observe(perf_counter() - t, job=func.__name__)
+    return wrapper
+
+
+def _query_hook(sql, params, duration):
+    if has_request_context() and 'timings' in g:
+        g.queries += 1
+        if not g.own_db:
+            g.timings['db'] += duration
+
+
+def init_app(app, database):
+    '''Подключает замеры запросов к приложению и бд'''
+    database.query_hooks.append(_query_hook)
+
+    @app.before_request
+    def start_timing():
+        g.timings = defaultdict(float)
+        g.queries = 0
+        g.own_db = False
+        g.started = perf_counter()
+
+    @app.after_request
+    def finish_timing(response):
+        if 'timings' not in g:
+            return response
+        total = perf_counter() - g.started
+        g.timings['total'] = total
+
+        response.headers['Server-Timing'] = ', '.join(
+            f'{name};dur={value * 1000:.1f}' for name, value in g.timings.items())
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        kind = request.args.get('kind') or (request.view_args or {}).get('kind', '')
+        REQUEST_LATENCY.observe(total, route=route, kind=kind if kind in KINDS else '')
+        REQUEST_QUERIES.observe(g.queries, route=route)
+        return response
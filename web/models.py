@@ -1,20 +1,180 @@
+import os
+import re
+import warnings
+import threading
 import numpy as np
 import peewee as pw
 from peewee import fn
 from uuid import uuid4
+from time import perf_counter, monotonic
 from datetime import datetime, timedelta, date
-from config import DB_DBMS, DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
+from config import DB_DBMS, DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, ARCHIVE_DIR, STREAM_CHUNK, \
+    REFERENCE_CHECK_INTERVAL
+from . import archive
+from .windows import Window, parse_window, rolling
 
 
 ACUTE_W = 1
 CHRONIC_W = 365
 
+# минимальная длительность (дней) эпизода превышения HI для острого и хронического влияния
+ACUTE_EPISODE = 5
+CHRONIC_EPISODE = 90
+
+# таблица значений функции распределения для рисков (prob, risk)
+# не удалось найти уравнение функции распределения
+RISK_TABLE = np.asarray((
+    (-3.0, 0.001), (-2.5, 0.006), (-2.0, 0.023), (-1.9, 0.029),
+    (-1.8, 0.036), (-1.7, 0.045), (-1.6, 0.055), (-1.5, 0.067),
+    (-1.4, 0.081), (-1.3, 0.097), (-1.2, 0.115), (-1.1, 0.136),
+    (-1.0, 0.157), (-0.9, 0.184), (-0.8, 0.212), (-0.7, 0.242),
+    (-0.6, 0.274), (-0.5, 0.309), (-0.4, 0.345), (-0.3, 0.382),
+    (-0.2, 0.421), (-0.1, 0.460), (0.0,  0.500),  (0.1, 0.540),
+    (0.2,  0.579), (0.3,  0.618), (0.4,  0.655),  (0.5, 0.692),
+    (0.6,  0.726), (0.7,  0.758), (0.8,  0.788),  (0.9, 0.816),
+    (1.0,  0.841), (1.1,  0.864), (1.2,  0.885),  (1.3, 0.903),
+    (1.4,  0.919), (1.5,  0.933), (1.6,  0.945),  (1.7, 0.955),
+    (1.8,  0.964), (1.9,  0.971), (2.0,  0.977),  (2.5, 0.994)))
+
+
+def aggregate(values, agg='mean', axis=0):
+    '''
+    Свертка показаний нескольких регионов без учета пропусков
+
+    Args:
+        values: np.ndarray[float] - показания (nan где нет показаний)
+        agg:    str               - 'mean', 'min', 'max', 'median' или перцентиль 'p0'..'p100' (например 'p95')
+        axis:   int               - ось свертки (по умолчанию ось регионов)
+
+    Returns:
+        np.ndarray[float] - nan там, где ни у одного региона нет показаний
+    '''
+    values = np.asarray(values, dtype=float)
+    with warnings.catch_warnings():
+        # срезы из одних пропусков дают nan, это ожидаемо
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if agg == 'mean':
+            return np.nanmean(values, axis=axis)
+        if agg == 'min':
+            return np.nanmin(values, axis=axis)
+        if agg == 'max':
+            return np.nanmax(values, axis=axis)
+        if agg == 'median':
+            return np.nanmedian(values, axis=axis)
+        if re.fullmatch(r'p\d{1,3}(\.\d+)?', agg or '') and 0 <= float(agg[1:]) <= 100:
+            return np.nanpercentile(values, float(agg[1:]), axis=axis)
+    raise ValueError(f'unexpected aggregation "{agg}", use "mean", "min", "max", "median" or "p<0..100>"')
+
+
+class RunningAggregate:
+    '''
+    Свертка показаний регионов (см. aggregate), которые приходят порциями (см. AtmosphericMeasurement.stream).
+    mean, min и max накапливаются по ходу, для медианы и перцентилей хранятся только ряды регионов
+    (без кубов веществ и запаса под окна)
+
+    Args:
+        agg: str - как в aggregate
+
+    Raises:
+        ValueError - неизвестная свертка
+    '''
+    def __init__(self, agg='mean'):
+        aggregate(np.zeros((1, 1)), agg)
+        self.agg = agg
+        self._total = self._count = self._extreme = None
+        self._parts = []
+
+    def add(self, values):
+        '''
+        Args:
+            values: np.ndarray[регион][дата] - показания порции регионов (nan где нет показаний)
+        '''
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return
+        if self.agg == 'mean':
+            total, count = np.nansum(values, axis=0), np.sum(~np.isnan(values), axis=0)
+            self._total = total if self._total is None else self._total + total
+            self._count = count if self._count is None else self._count + count
+        elif self.agg in ('min', 'max'):
+            # fmin/fmax пропускают nan, если у другого региона показание есть
+            f = np.fmin if self.agg == 'min' else np.fmax
+            extreme = f.reduce(values, axis=0)
+            self._extreme = extreme if self._extreme is None else f(self._extreme, extreme)
+        else:
+            self._parts.append(values)
+
+    def result(self, n):
+        '''
+        Args:
+            n: int - число дат (если порций не было)
+
+        Returns:
+            np.ndarray[float] - nan там, где ни у одного региона нет показаний
+        '''
+        if self.agg == 'mean' and self._total is not None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(self._count > 0, self._total / np.maximum(self._count, 1), np.nan)
+        if self.agg in ('min', 'max') and self._extreme is not None:
+            return self._extreme
+        if self._parts:
+            return aggregate(np.concatenate(self._parts), self.agg)
+        return np.full(n, np.nan)
+
+
+def risk_distribution(prob):
+    '''
+    Риск по значению prob: первое значение таблицы, для которого prob <= порога, иначе 1
+
+    Args:
+        prob: np.ndarray[float] - величина связанная с риском
+
+    Returns:
+        np.ndarray[float]
+    '''
+    prob = np.asarray(prob, dtype=float)
+    values = np.append(RISK_TABLE[:, 1], 1.0)
+    return values[np.searchsorted(RISK_TABLE[:, 0], prob, side='left')]
+
+
+class QueryHooksMixin:
+    '''
+    Вызывает хуки hook(sql, params, duration) после каждого sql-запроса.
+    Пока хуков нет, запросы выполняются без замеров.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.query_hooks = []
+        super().__init__(*args, **kwargs)
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        if not self.query_hooks:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        t = perf_counter()
+        try:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        finally:
+            duration = perf_counter() - t
+            for hook in list(self.query_hooks):
+                hook(sql, params, duration)
+
+
+class SqliteDatabase(QueryHooksMixin, pw.SqliteDatabase):
+    pass
+
+
+class MySQLDatabase(QueryHooksMixin, pw.MySQLDatabase):
+    pass
+
+
+class PostgresqlDatabase(QueryHooksMixin, pw.PostgresqlDatabase):
+    pass
+
 
 if DB_DBMS == 'sqlite':
-    db = pw.SqliteDatabase(DB_NAME)
+    db = SqliteDatabase(DB_NAME)
 
 elif DB_DBMS == 'mysql':
-    db = pw.MySQLDatabase(
+    db = MySQLDatabase(
         database=DB_NAME,
         user=DB_USER,
         passwd=DB_PASSWORD,
@@ -23,7 +183,7 @@ elif DB_DBMS == 'mysql':
     )
 
 elif DB_DBMS == 'postgresql':
-    db = pw.PostgresqlDatabase(
+    db = PostgresqlDatabase(
         database=DB_NAME,
         user=DB_USER,
         passwd=DB_PASSWORD,
@@ -149,6 +309,60 @@ class Tokens(BaseModel):
         return t
 
 
+class MailOutbox(BaseModel):
+    '''
+    Исходящие письма (отправляются фоновой задачей)
+
+    Fields:
+        id:          int      - pk
+        recipient:   str      - почта получателя
+        subject:     str      - тема письма
+        html:        str      - тело письма
+        attempts:    int      - число неудачных попыток отправки
+        next_try_on: datetime - не раньше какого времени пробовать отправить
+        sent_on:     datetime - когда отправлено (None если еще не отправлено)
+        error:       str      - последняя ошибка отправки
+    '''
+    recipient: str = pw.CharField(255)
+    subject: str = pw.CharField(255, default='')
+    html: str = pw.TextField()
+    attempts: int = pw.IntegerField(default=0)
+    next_try_on: datetime = pw.DateTimeField(default=datetime.now, index=True)
+    sent_on: datetime = pw.DateTimeField(null=True, index=True)
+    error: str = pw.TextField(null=True)
+
+    @classmethod
+    def enqueue(cls, recipient, html, subject=''):
+        '''Ставит письмо в очередь на отправку'''
+        return cls.create(recipient=recipient, html=html, subject=subject)
+
+    @classmethod
+    def pending(cls, limit, max_attempts):
+        '''Письма, которые пора отправить (старые первыми)'''
+        return (
+            cls
+            .select()
+            .where(
+                cls.sent_on.is_null() &
+                (cls.attempts < max_attempts) &
+                (cls.next_try_on <= datetime.now()))
+            .order_by(cls.next_try_on, cls.id)
+            .limit(limit)
+        )
+
+    def mark_sent(self):
+        self.sent_on = datetime.now()
+        self.error = None
+        self.save()
+
+    def mark_failed(self, error, delay):
+        '''Откладывает письмо с экспоненциальной задержкой delay * 2^attempts секунд'''
+        self.next_try_on = datetime.now() + timedelta(seconds=delay * 2 ** self.attempts)
+        self.attempts += 1
+        self.error = str(error)
+        self.save()
+
+
 class HazardClass(BaseModel):
     '''
     Класс опасности
@@ -222,6 +436,58 @@ class MeasurementRegion(BaseModel):
     postcode = pw.IntegerField(null=True)
 
 
+class RegionGroup(BaseModel):
+    '''
+    Группы регионов (город или сеть станций)
+
+    Fields:
+        id:     int - pk
+        name:   str - название группы
+        prefix: str - если указан, в группу входят все регионы, название которых начинается с prefix
+    '''
+    name = pw.CharField(255, unique=True)
+    prefix = pw.CharField(255, null=True)
+
+    def __str__(self):
+        return self.name
+
+    def members(self):
+        '''Регионы группы: по префиксу названия и добавленные вручную'''
+        q = MeasurementRegion.select().join(RegionGroupMember, pw.JOIN.LEFT_OUTER, on=(
+            (RegionGroupMember.region == MeasurementRegion.id) & (RegionGroupMember.group == self.id)))
+        if self.prefix:
+            q = q.where(RegionGroupMember.id.is_null(False) | MeasurementRegion.name.startswith(self.prefix))
+        else:
+            q = q.where(RegionGroupMember.id.is_null(False))
+        return q.distinct().order_by(MeasurementRegion.id)
+
+    @classmethod
+    def sync_cities(cls):
+        '''Создает группы-города по названиям регионов ("Иркутск,ул.Мира, д.101" -> "Иркутск")'''
+        for region in MeasurementRegion.all():
+            city = region.name.split(',', 1)[0].strip()
+            if city and city != region.name:
+                cls.get_or_create(name=city, defaults={'prefix': city + ','})
+
+
+class RegionGroupMember(BaseModel):
+    '''
+    Регионы, добавленные в группу вручную
+
+    Fields:
+        id:     int               - pk
+        group:  RegionGroup       - группа
+        region: MeasurementRegion - регион
+    '''
+    group = pw.ForeignKeyField(RegionGroup, backref='extra_members')
+    region = pw.ForeignKeyField(MeasurementRegion)
+
+    class Meta:
+        indexes = (
+            (('group', 'region'), True),
+        )
+
+
 class DataSource(BaseModel):
     '''
     Источники данных
@@ -265,15 +531,23 @@ class AtmosphericMeasurement(BaseModel):
     def y(self):
         return self.stat
     
+    @classmethod
+    def first_date(cls):
+        '''Первая дата измерений в бд и архивах'''
+        dates = [cls.select(fn.MIN(cls.date)).scalar(), (archive.bounds(archive_dir()) or (None, ))[0]]
+        return min((x for x in dates if x is not None), default=None)
+
     @classmethod
     def min_date(cls, w=CHRONIC_W):
         if not w:
             w = 0
-        return cls.select(fn.MIN(cls.date)).scalar() + timedelta(days=w)
+        return cls.first_date() + timedelta(days=w)
 
     @classmethod
     def max_date(cls):
         a = cls.select(fn.MAX(cls.date)).scalar()
+        if a is None:
+            a = archive.bounds(archive_dir())[1]
         b = datetime.now().date()
         return min(a, b)
     
@@ -294,81 +568,147 @@ class AtmosphericMeasurement(BaseModel):
         return regions
 
     @classmethod
-    def C(cls, start, end, substances=None, regions=None, w=None):
+    def measurements(cls, start, end, regions=None, substances=None, valid=True):
         '''
-        Скользящее среднее измерений
+        Измерения за даты [start, end] из бд и из архивов старых лет (см. archive_years) вместе
+
+        Args:
+            start:      date
+            end:        date
+            regions:    list[int] - id регионов (по умолчанию все)
+            substances: list[int] - id веществ (по умолчанию все)
+            valid:      bool      - только с показанием (не пустым и не нулевым)
+
+        Returns:
+            dict[str, np.ndarray] - столбцы archive.COLUMNS, сначала из архивов, потом из бд
+        '''
+        q = (
+            cls
+            .select(cls.date, cls.substance, cls.region, cls.source, cls.stat)
+            .where(cls.date.between(start, end))
+            .tuples()
+        )
+        if regions is not None:
+            q = q.where(cls.region.in_(regions))
+        if substances is not None:
+            q = q.where(cls.substance.in_(substances))
+        if valid:
+            q = q.where(cls.stat.is_null(False) & (cls.stat != 0))
+
+        # в архив попадают все показания, недействительные отсекаются при чтении
+        old = archive.select(archive_dir(), start, end, regions, substances)
+        if valid:
+            old = {k: v[~np.isnan(old['stat']) & (old['stat'] != 0)] for k, v in old.items()}
+        return archive.concat([old, archive.columns(list(q))])
+
+    @classmethod
+    def cubes(cls, start, end, substances=None, regions=None, windows=(ACUTE_W, )):
+        '''
+        Несколько окон усреднения по одной выборке измерений: ряд загружается один раз
+        с запасом под самое длинное окно, окна считаются потоковыми ядрами за O(дней) (см. windows.rolling)
 
         Args:
             start:      datetime|str                              - дата начала
             end:        datetime|str                              - дата конца 
             substances: Substance|list[Substance]                 - вещества (по умолчанию все)
             regions:    MeasurementRegion|list[MeasurementRegion] - регионы (по умолчанию все)
-            w:          int                                       - длина окна (по умолчанию 1)
+            windows:    list[Window|int|str]                      - окна (см. windows.parse_window)
 
         Returns:
-            np.ndarray[регион][вещество][измерение][дата/показание]
+            tuple[np.ndarray[дата], list[np.ndarray[регион][вещество][дата]]] - даты и показания по каждому окну
+            (nan в дни без показаний)
+
+        Raises:
+            ValueError - неверное окно
         '''
-        if not w:
-            w = 1
+        windows = [parse_window(w, Window(ACUTE_W, 'mean')) for w in windows]
 
         if isinstance(start, str):
             start = date.fromisoformat(start)
-        
+
         if isinstance(end, str):
             end = date.fromisoformat(end)
 
-        # левая дата выборки с учетом длины выборки
-        wstart = start - timedelta(days=w)
-        # даты дней в выборке. нужно для создания маски (массив X есть массив дат)
-        x = np.asarray([wstart + timedelta(days=i) for i in range((end-wstart).days + 1)])
-        # переменная под показания
-        c = []
-        # проходимся по каждому региону
-        for region in cls.validate_regions(regions):
-            c.append([])
-            # проходимся по каждому веществу
-            for substance in cls.validate_substances(substances):
-                c[-1].append([])
-                
-                # вытаскиваем из бд показания с конкретным регионом и вещество и датой в промежуткке между [wstart, end]
-                q = np.asarray(
-                    cls.
-                    select(cls.date, cls.stat)
-                    .where(
-                        (cls.region == region) &
-                        (cls.substance == substance) &
-                        (cls.date.between(wstart, end)))
-                    .order_by(cls.date)
-                    .tuples()
-                )
-
-                # создаем пустой массив показаний то же длинны, что и X (массив Y есть массив показаний)
-                y = np.zeros(len(x), dtype=object)
-
-                # если выборка не пустая
-                if q.size:
-                    # берем непустые показания из выборки
-                    data = q[np.nonzero(q[:, 1])]
-                    # сопоставляем их по датам с массивом X (нужно создать ассоциацию дату и индекса - маску)
-                    mask = np.isin(x, data[:, 0], assume_unique=False, invert=False)
-                    # сопоставляем показания из выборки с массивом Y
-                    y[np.nonzero(mask)] = data[:, 1]
-                    # считаем скользящее среднее
-                    _y = np.convolve(y, np.ones(w) / w, mode='valid')
-                    y[y.size - _y.size:] = _y
-                    # помещаем None в дни когда показаний нет 
-                    y[np.nonzero(~mask)] = None
-
-                # берем показания в промежутке [start, end]
-                select = np.where((start <= x) & (x < end))
-                # упаковываем их в пары дата+показание и помещаем в переменную
-                c[-1][-1] = np.column_stack((x[select], y[select]))
-
-
-        return np.asarray(c)
-
-    @classmethod
-    def HQ(cls, type, start, end, substances=None, regions=None):
+        substances = [getattr(x, 'id', x) for x in cls.validate_substances(substances)]
+        regions = [getattr(x, 'id', x) for x in cls.validate_regions(regions)]
+
+        # левая дата выборки с учетом длины самого длинного окна
+        lookback = max(w.lookback for w in windows)
+        wstart = start - timedelta(days=lookback)
+        n = max((end - wstart).days + 1, 0)
+        x = np.asarray([wstart + timedelta(days=i) for i in range(n)])
+
+        values = np.zeros((len(regions), len(substances), n))
+        mask = np.zeros(values.shape, dtype=bool)
+
+        rows = cls.measurements(wstart, end, regions, substances)
+        if len(rows['date']):
+            # id -> индекс через отсортированные id (searchsorted), без словарей по строкам
+            r_order, s_order = np.argsort(regions), np.argsort(substances)
+            r_sorted, s_sorted = np.asarray(regions)[r_order], np.asarray(substances)[s_order]
+            idx = (
+                r_order[np.searchsorted(r_sorted, rows['region'])],
+                s_order[np.searchsorted(s_sorted, rows['substance'])],
+                (rows['date'] - np.datetime64(wstart, 'D')).astype(int),
+            )
+            # при повторе измерения в бд и архиве побеждает бд (оно записано позже)
+            values[idx] = rows['stat']
+            mask[idx] = True
+
+        # берем показания в промежутке [start, end), дни без собственного показания остаются пустыми
+        select = slice(lookback, max(n - 1, lookback))
+        result = []
+        for y in rolling(values, mask, windows):
+            y[~mask] = np.nan
+            result.append(y[:, :, select])
+        return x[select], result
+
+    @classmethod
+    def cube(cls, start, end, substances=None, regions=None, w=None):
+        '''
+        Скользящее среднее измерений одним запросом в виде плотного массива (те же значения, что и C)
+
+        Args:
+            start:      datetime|str                              - дата начала
+            end:        datetime|str                              - дата конца 
+            substances: Substance|list[Substance]                 - вещества (по умолчанию все)
+            regions:    MeasurementRegion|list[MeasurementRegion] - регионы (по умолчанию все)
+            w:          Window|int|str                            - окно (по умолчанию среднесуточное)
+
+        Returns:
+            tuple[np.ndarray[дата], np.ndarray[регион][вещество][дата]] - даты и показания (nan если показаний нет)
+        '''
+        x, (values, ) = cls.cubes(start, end, substances, regions, (w or ACUTE_W, ))
+        return x, values
+
+    @classmethod
+    def C(cls, start, end, substances=None, regions=None, w=None):
+        '''
+        Скользящее среднее измерений
+
+        Args:
+            start:      datetime|str                              - дата начала
+            end:        datetime|str                              - дата конца 
+            substances: Substance|list[Substance]                 - вещества (по умолчанию все)
+            regions:    MeasurementRegion|list[MeasurementRegion] - регионы (по умолчанию все)
+            w:          Window|int|str                            - окно (по умолчанию среднесуточное)
+
+        Returns:
+            np.ndarray[регион][вещество][измерение][дата/показание]
+        '''
+        # все показания выбираются одним запросом, см. cube
+        x, values = cls.cube(start, end, substances, regions, w)
+
+        # упаковываем их в пары дата+показание (None в дни когда показаний нет)
+        c = np.empty(values.shape + (2,), dtype=object)
+        c[..., 0] = x
+        y = values.astype(object)
+        y[np.isnan(values)] = None
+        c[..., 1] = y
+        return c
+
+    @classmethod
+    def HQ(cls, type, start, end, substances=None, regions=None, w=None):
         '''
         Коэффициент опасности
 
@@ -378,6 +718,7 @@ class AtmosphericMeasurement(BaseModel):
             end:        datetime|str                              - дата конца 
             substances: Substance|list[Substance]                 - вещества (по умолчанию все)
             regions:    MeasurementRegion|list[MeasurementRegion] - регионы (по умолчанию все)
+            w:          Window|int|str                            - окно усреднения C (по умолчанию ACUTE_W или CHRONIC_W по типу)
 
         Returns:
             np.ndarray[регион][вещество][измерение][дата/показание]
@@ -387,10 +728,10 @@ class AtmosphericMeasurement(BaseModel):
         
         # получаем нужно значение C
         if type == 'acute':
-            c = cls.C(start, end, substances, regions, ACUTE_W)
+            c = cls.C(start, end, substances, regions, w or ACUTE_W)
             rfc = np.reshape([x.acute_rfc for x in substances], (1, -1, 1))
         elif type == 'chronic':
-            c = cls.C(start, end, substances, regions, CHRONIC_W)
+            c = cls.C(start, end, substances, regions, w or CHRONIC_W)
             rfc = np.reshape([x.chronic_rfc for x in substances], (1, -1, 1))
         else:
             raise ValueError('unexpected type, use "acute" or "chronic"')
@@ -403,7 +744,7 @@ class AtmosphericMeasurement(BaseModel):
         return c
 
     @classmethod
-    def HI(cls, type, start, end, substances=None, regions=None):
+    def HI(cls, type, start, end, substances=None, regions=None, w=None):
         '''
         Индекс опасности
 
@@ -413,18 +754,111 @@ class AtmosphericMeasurement(BaseModel):
             end:        datetime|str                              - дата конца 
             substances: Substance|list[Substance]                 - вещества (по умолчанию все)
             regions:    MeasurementRegion|list[MeasurementRegion] - регионы (по умолчанию все)
+            w:          Window|int|str                            - окно усреднения C (по умолчанию по типу)
 
         Returns:
             np.ndarray[регион][измерение][дата/показание]
         '''
         # получаем нужное значение HQ
-        hq = cls.HQ(type, start, end, substances, regions)
+        hq = cls.HQ(type, start, end, substances, regions, w)
         # считаем сумму вдоль показаний (вдоль оси показаний)
         sum = np.sum(hq[:, :, :, 1], axis=1)
         # избавляемся от оси веществ
         hi = np.stack([hq[:, 0, :, 0], sum], axis=2)
         return hi
 
+    @classmethod
+    def stream(cls, start, end, substances=None, regions=None, windows=(ACUTE_W, ), chunk=STREAM_CHUNK):
+        '''
+        Потоковый cubes: регионы обрабатываются порциями по chunk, каждая порция - один запрос к бд.
+        В памяти одновременно только одна порция, первые результаты готовы до конца всего расчета
+
+        Args:
+            start:      datetime|str                              - дата начала
+            end:        datetime|str                              - дата конца
+            substances: Substance|list[Substance]                 - вещества (по умолчанию все)
+            regions:    MeasurementRegion|list[MeasurementRegion] - регионы (по умолчанию все)
+            windows:    list[Window|int|str]                      - окна (см. cubes)
+            chunk:      int                                       - регионов в порции (None - все сразу)
+
+        Yields:
+            tuple[list[MeasurementRegion], np.ndarray[дата], list[np.ndarray[регион][вещество][дата]]] -
+            регионы порции, даты и показания по каждому окну
+        '''
+        regions = cls.validate_regions(regions)
+        substances = cls.validate_substances(substances)
+        chunk = chunk or max(len(regions), 1)
+        # без регионов одна пустая порция: потребителю все равно нужны даты
+        for i in range(0, max(len(regions), 1), chunk):
+            part = regions[i:i + chunk]
+            x, values = cls.cubes(start, end, substances, part, windows)
+            yield part, x, values
+
+    @classmethod
+    def stream_HI(cls, type, start, end, points=None, regions=None, w=None, chunk=STREAM_CHUNK):
+        '''
+        Потоковый HI_matrix: индекс опасности всех органов по порциям регионов
+
+        Args:
+            type:       str                                       - тип хронический или острый 'acute'/'chronic'
+            start:      datetime|str                              - дата начала
+            end:        datetime|str                              - дата конца
+            points:     HealthPoint|list[HealthPoint]             - органы (по умолчанию все, у которых есть вещества)
+            regions:    MeasurementRegion|list[MeasurementRegion] - регионы (по умолчанию все)
+            w:          Window|int|str                            - окно усреднения C (по умолчанию по типу)
+            chunk:      int                                       - регионов в порции (None - все сразу)
+
+        Yields:
+            tuple[list[MeasurementRegion], np.ndarray[дата], np.ndarray[регион][орган][дата]]
+        '''
+        if points is None:
+            points = list(HealthPoint.possible_all())
+        elif not hasattr(points, '__iter__'):
+            points = [points, ]
+        substances = list(Substance.all())
+        incidence = SubstancesInclusionInHealthPoints.matrix(substances, points)
+
+        # вещества, которые не входят ни в один орган, не загружаются
+        used = incidence.any(axis=1)
+        substances = [x for x, u in zip(substances, used) if u]
+        incidence = incidence[used]
+
+        if type == 'acute':
+            w = w or ACUTE_W
+            rfc = np.asarray([x.acute_rfc for x in substances])
+        elif type == 'chronic':
+            w = w or CHRONIC_W
+            rfc = np.asarray([x.chronic_rfc for x in substances])
+        else:
+            raise ValueError('unexpected type, use "acute" or "chronic"')
+
+        for part, x, (c, ) in cls.stream(start, end, substances, regions, (w, ), chunk):
+            # HQ = C / RfC (пустые значения нули), HI органа = сумма HQ входящих в него веществ:
+            # одно матричное умножение [орган][вещество] x [регион][вещество][дата] -> [регион][орган][дата].
+            # Куб порции переиспользуется под HQ, чтобы не держать две копии
+            np.nan_to_num(c, copy=False)
+            c /= rfc[None, :, None]
+            yield part, x, np.matmul(incidence.T, c)
+
+    @classmethod
+    def HI_matrix(cls, type, start, end, points=None, regions=None, w=None):
+        '''
+        Индекс опасности сразу для нескольких органов: HQ считается один раз для всех нужных веществ
+
+        Args:
+            type:       str                                       - тип хронический или острый 'acute'/'chronic'
+            start:      datetime|str                              - дата начала
+            end:        datetime|str                              - дата конца 
+            points:     HealthPoint|list[HealthPoint]             - органы (по умолчанию все, у которых есть вещества)
+            regions:    MeasurementRegion|list[MeasurementRegion] - регионы (по умолчанию все)
+            w:          Window|int|str                            - окно усреднения C (по умолчанию по типу)
+
+        Returns:
+            tuple[np.ndarray[дата], np.ndarray[регион][орган][дата]]
+        '''
+        (_, x, hi), = cls.stream_HI(type, start, end, points, regions, w, chunk=None)
+        return x, hi
+
     @classmethod
     def prob(cls, type, start, end, substances=None, regions=None):
         '''
@@ -477,35 +911,383 @@ class AtmosphericMeasurement(BaseModel):
         Returns:
             np.ndarray[регион][вещество][измерение][риски]
         '''
-        # не удалось найти уравнение функции распределения
-        table = ((-3.0, 0.001), (-2.5, 0.006), (-2.0, 0.023), (-1.9, 0.029),
-                 (-1.8, 0.036), (-1.7, 0.045), (-1.6, 0.055), (-1.5, 0.067),
-                 (-1.4, 0.081), (-1.3, 0.097), (-1.2, 0.115), (-1.1, 0.136),
-                 (-1.0, 0.157), (-0.9, 0.184), (-0.8, 0.212), (-0.7, 0.242),
-                 (-0.6, 0.274), (-0.5, 0.309), (-0.4, 0.345), (-0.3, 0.382),
-                 (-0.2, 0.421), (-0.1, 0.460), (0.0,  0.500),  (0.1, 0.540),
-                 (0.2,  0.579), (0.3,  0.618), (0.4,  0.655),  (0.5, 0.692),
-                 (0.6,  0.726), (0.7,  0.758), (0.8,  0.788),  (0.9, 0.816),
-                 (1.0,  0.841), (1.1,  0.864), (1.2,  0.885),  (1.3, 0.903),
-                 (1.4,  0.919), (1.5,  0.933), (1.6,  0.945),  (1.7, 0.955),
-                 (1.8,  0.964), (1.9,  0.971), (2.0,  0.977),  (2.5, 0.994))
-        
-        # потому используем "таблицу значений функции"
-        @np.vectorize
-        def distribution(prob):
-            if prob is None:
-                return 0.0
-            for a, b in table:
-                if prob <= a:
-                    return b
-            return 1.0
-        
-        # применяем эту таблицу для каждого значения prob
+        # применяем таблицу значений функции распределения для каждого значения prob
         risk = cls.prob(type, start, end, substances, regions)
-        risk[:,:,:,1] = distribution(risk[:,:,:,1])
+        risk[:,:,:,1] = risk_distribution(risk[:,:,:,1])
 
         return risk
 
+    @classmethod
+    def archive_years(cls, before, vacuum=False):
+        '''
+        Переносит измерения лет до before из бд в сжатые архивы по годам (см. web/archive.py).
+        Запросы (cube, C и все, что на них построено) читают архивы сами, сводки за эти годы сохраняются
+
+        Args:
+            before: int  - первый год, который остается в бд
+            vacuum: bool - сжать файл sqlite после удаления (VACUUM)
+
+        Returns:
+            dict[int, int] - год -> число перенесенных измерений
+        '''
+        database = cls._meta.database
+        directory = archive_dir()
+        first = cls.select(fn.MIN(cls.date)).scalar()
+        result = {}
+        if first is None:
+            return result
+        for year in range(first.year, before):
+            start, end = date(year, 1, 1), date(year, 12, 31)
+            rows = list(
+                cls
+                .select(cls.date, cls.substance, cls.region, cls.source, cls.stat)
+                .where(cls.date.between(start, end))
+                .tuples())
+            if not rows:
+                continue
+            # сначала архив, потом удаление: в промежутке запросы видят одни и те же значения дважды
+            archive.write(directory, year, archive.columns(rows))
+            with database.atomic():
+                # в postgresql год целиком - партиция, ее дешевле удалить, чем чистить построчно
+                drop_partition(year)
+                cls.delete().where(cls.date.between(start, end)).execute()
+            result[year] = len(rows)
+        if vacuum and result and isinstance(database, pw.SqliteDatabase):
+            database.execute_sql('VACUUM')
+        return result
+
+
+class DataGeneration(BaseModel):
+    '''
+    Поколения данных: новая запись при каждом изменении измерений
+
+    Fields:
+        id:         int      - pk (номер поколения)
+        created_on: datetime - когда данные изменились
+        since:      date     - самая ранняя измененная дата (None - могли измениться любые даты)
+    '''
+    created_on = pw.DateTimeField(default=datetime.now)
+    since = pw.DateField(null=True)
+
+    @classmethod
+    def current(cls):
+        '''Номер текущего поколения (0 если данные не менялись)'''
+        return cls.select(fn.MAX(cls.id)).scalar() or 0
+
+    @classmethod
+    def bump(cls, since=None):
+        '''Отмечает изменение измерений начиная с даты since, возвращает номер нового поколения'''
+        return cls.create(since=since).id
+
+    @classmethod
+    def changed_since(cls, generation):
+        '''
+        Самая ранняя дата, измененная после поколения generation
+
+        Returns:
+            date|None - None если данные не менялись, date.min если могли измениться любые даты
+        '''
+        q = cls.select(cls.since).where(cls.id > generation).tuples()
+        dates = [x for x, in q]
+        if not dates:
+            return None
+        if None in dates:
+            return date.min
+        return min(dates)
+
+
+class ChartAccess(BaseModel):
+    '''
+    Статистика запросов графиков (по ней прогреваются кеши после загрузки данных)
+
+    Fields:
+        id:          int      - pk
+        kind:        str      - тип графика
+        region:      str      - id региона или "g<id>" группы
+        option:      str      - id вещества или органа
+        agg:         str      - свертка по регионам группы
+        hits:        int      - число запросов
+        last_access: datetime - время последнего запроса
+    '''
+    kind: str = pw.CharField(16)
+    region: str = pw.CharField(16)
+    option: str = pw.CharField(16)
+    agg: str = pw.CharField(8)
+    hits: int = pw.IntegerField(default=0)
+    last_access: datetime = pw.DateTimeField(default=datetime.now)
+
+    class Meta:
+        indexes = (
+            (('kind', 'region', 'option', 'agg'), True),
+        )
+
+    @classmethod
+    def record(cls, counts):
+        '''
+        Добавляет накопленные обращения
+
+        Args:
+            counts: dict[tuple[str, str, str, str], int] - (kind, region, option, agg) -> число запросов
+        '''
+        now = datetime.now()
+        rows = [{'kind': kind, 'region': region, 'option': option, 'agg': agg, 'hits': hits, 'last_access': now}
+                for (kind, region, option, agg), hits in counts.items()]
+        # одним upsert: воркеры, одновременно добавляющие новый график, не упираются в уникальный индекс
+        if isinstance(cls._meta.database, pw.MySQLDatabase):
+            conflict = {'update': {cls.hits: cls.hits + fn.VALUES(cls.hits)}}
+        else:
+            conflict = {'conflict_target': (cls.kind, cls.region, cls.option, cls.agg),
+                        'update': {cls.hits: cls.hits + pw.EXCLUDED.hits}}
+        with cls._meta.database.atomic():
+            for batch in pw.chunked(rows, 100):
+                cls.insert_many(batch).on_conflict(preserve=(cls.last_access, ), **conflict).execute()
+
+    @classmethod
+    def top(cls, limit):
+        '''Самые запрашиваемые графики'''
+        return cls.select().order_by(cls.hits.desc(), cls.last_access.desc()).limit(limit)
+
+
+class ExportJob(BaseModel):
+    '''
+    Фоновые выгрузки графиков в csv (файл готовой выгрузки лежит на диске до expires_on)
+
+    Fields:
+        id:          str      - pk (случайный, по нему клиент опрашивает статус и скачивает файл)
+        key:         str      - параметры выгрузки и поколение данных, одинаковые задания не дублируются
+        user:        Users    - кто поставил выгрузку
+        kind:        str      - тип графика
+        region:      str      - id региона или "g<id>" группы
+        option:      str      - id вещества или органа
+        start:       str      - начало периода (пустая строка - с начала данных)
+        end:         str      - конец периода (пустая строка - до конца данных)
+        agg:         str      - свертка по регионам группы
+        window:      str      - окно усреднения (пустая строка - стандартное)
+        generation:  int      - поколение данных, по которому считается выгрузка
+        status:      str      - 'pending', 'running', 'done' или 'failed'
+        progress:    float    - доля выполненной работы от 0 до 1
+        name:        str      - имя файла для скачивания
+        size:        int      - размер файла в байтах
+        error:       str      - почему выгрузка не удалась
+        created_on:  datetime - когда поставлена
+        started_on:  datetime - когда начала считаться
+        finished_on: datetime - когда завершилась
+        expires_on:  datetime - до какого времени хранится результат
+    '''
+    id: str = pw.CharField(32, primary_key=True)
+    key: str = pw.CharField(255, index=True)
+    user: Users = pw.ForeignKeyField(Users, null=True, on_delete='SET NULL')
+    kind: str = pw.CharField(16)
+    region: str = pw.CharField(16)
+    option: str = pw.CharField(16)
+    start: str = pw.CharField(10, default='')
+    end: str = pw.CharField(10, default='')
+    agg: str = pw.CharField(8, default='mean')
+    window: str = pw.CharField(16, default='')
+    generation: int = pw.IntegerField(default=0)
+    status: str = pw.CharField(8, default='pending', index=True)
+    progress: float = pw.FloatField(default=0)
+    name: str = pw.CharField(255, null=True)
+    size: int = pw.IntegerField(null=True)
+    error: str = pw.TextField(null=True)
+    created_on: datetime = pw.DateTimeField(default=datetime.now)
+    started_on: datetime = pw.DateTimeField(null=True)
+    finished_on: datetime = pw.DateTimeField(null=True)
+    expires_on: datetime = pw.DateTimeField(null=True, index=True)
+
+    @staticmethod
+    def make_key(kind, region, option, start, end, agg, window, generation):
+        return '|'.join(map(str, (generation, kind, region, option, start, end, agg, window)))
+
+    @classmethod
+    def enqueue(cls, user, kind, region, option, start, end, agg, window, generation):
+        '''
+        Ставит выгрузку в очередь. Если такая же выгрузка уже ждет, считается или готова и не истекла,
+        возвращается она
+
+        Returns:
+            tuple[ExportJob, bool] - задание и создано ли оно сейчас
+        '''
+        key = cls.make_key(kind, region, option, start, end, agg, window, generation)
+        with cls._meta.database.atomic():
+            job = (
+                cls
+                .select()
+                .where(
+                    (cls.key == key) &
+                    (cls.status.in_(('pending', 'running')) |
+                     ((cls.status == 'done') & (cls.expires_on > datetime.now()))))
+                .order_by(cls.created_on.desc())
+                .first())
+            if job:
+                return job, False
+            return cls.create(id=uuid4().hex, key=key, user=user, kind=kind, region=region, option=option,
+                              start=start, end=end, agg=agg, window=window, generation=generation), True
+
+    @classmethod
+    def claim(cls, id):
+        '''Переводит ждущее задание в работу, False если его уже взяли или удалили'''
+        return cls.update(status='running', started_on=datetime.now()).where(
+            (cls.id == id) & (cls.status == 'pending')).execute() == 1
+
+    @classmethod
+    def expired(cls, timeout):
+        '''
+        Задания, которые пора удалить: истекшие и зависшие дольше timeout секунд
+        (процесс, который их считал, завершился)
+        '''
+        now = datetime.now()
+        lost = now - timedelta(seconds=timeout)
+        return cls.select().where(
+            (cls.expires_on < now) |
+            ((cls.status == 'pending') & (cls.created_on < lost)) |
+            ((cls.status == 'running') & (cls.started_on < lost)))
+
+    def position(self):
+        '''Сколько ждущих заданий впереди'''
+        if self.status != 'pending':
+            return 0
+        return type(self).select().where(
+            (type(self).status == 'pending') & (type(self).created_on < self.created_on)).count()
+
+    def report(self, progress):
+        '''Отмечает долю выполненной работы'''
+        self.progress = progress
+        type(self).update(progress=progress).where(type(self).id == self.id).execute()
+
+    def finish(self, name, size, ttl):
+        '''Отмечает готовую выгрузку, файл хранится ttl секунд'''
+        self.status, self.progress, self.name, self.size = 'done', 1, name, size
+        self.finished_on = datetime.now()
+        self.expires_on = self.finished_on + timedelta(seconds=ttl)
+        self.save()
+
+    def fail(self, error, ttl):
+        '''Отмечает неудачную выгрузку, статус хранится ttl секунд'''
+        self.status, self.error = 'failed', str(error) or type(error).__name__
+        self.finished_on = datetime.now()
+        self.expires_on = self.finished_on + timedelta(seconds=ttl)
+        self.save()
+
+
+class MeasurementRollup(BaseModel):
+    '''
+    Сводка измерений за месяц или год (поддерживается при загрузке данных)
+
+    Fields:
+        id:             int               - pk
+        region:         MeasurementRegion - регион
+        substance:      Substance         - вещество
+        period:         str               - 'month' или 'year'
+        period_start:   date              - первый день периода
+        count:          int               - число дней с показаниями
+        mean:           float             - среднее
+        p95:            float             - 95-й перцентиль
+        max:            float             - максимум
+        days_above_pdk: int               - число дней выше среднесуточного пдк
+    '''
+    PERIODS = ('month', 'year')
+
+    region = pw.ForeignKeyField(MeasurementRegion)
+    substance = pw.ForeignKeyField(Substance)
+    period = pw.CharField(5)
+    period_start = pw.DateField()
+    count = pw.IntegerField()
+    mean = pw.FloatField()
+    p95 = pw.FloatField()
+    max = pw.FloatField()
+    days_above_pdk = pw.IntegerField()
+
+    class Meta:
+        indexes = (
+            (('region', 'substance', 'period', 'period_start'), True),
+        )
+
+    @staticmethod
+    def bounds(period, day):
+        '''Первый день периода, в который попадает day, и первый день следующего периода'''
+        if period == 'month':
+            first = day.replace(day=1)
+            return first, (first + timedelta(days=32)).replace(day=1)
+        if period == 'year':
+            return day.replace(month=1, day=1), day.replace(year=day.year + 1, month=1, day=1)
+        raise ValueError('unexpected period, use "month" or "year"')
+
+    @classmethod
+    def refresh(cls, touched):
+        '''
+        Пересчитывает сводки периодов, в которые попали новые измерения
+
+        Args:
+            touched: iterable[tuple[int, int, date]] - (id региона, id вещества, дата) новых измерений
+        '''
+        groups = {}
+        for region, substance, day in touched:
+            for period in cls.PERIODS:
+                groups.setdefault((period, cls.bounds(period, day)[0]), set()).add((region, substance))
+        for (period, start), pairs in groups.items():
+            cls._recompute(period, start, pairs)
+
+    @classmethod
+    def rebuild(cls):
+        '''Пересчитывает все сводки по таблице измерений'''
+        first = AtmosphericMeasurement.select(fn.MIN(AtmosphericMeasurement.date)).scalar()
+        last = AtmosphericMeasurement.select(fn.MAX(AtmosphericMeasurement.date)).scalar()
+        archived = archive.years(archive_dir())
+        with cls._meta.database.atomic():
+            # сводки заархивированных лет пересчитывать не из чего, они остаются
+            d = cls.delete()
+            if archived:
+                d = d.where(cls.period_start > date(archived[-1], 12, 31))
+            d.execute()
+            if first is None:
+                return
+            for period in cls.PERIODS:
+                start = cls.bounds(period, first)[0]
+                while start <= last:
+                    cls._recompute(period, start)
+                    start = cls.bounds(period, start)[1]
+
+    @classmethod
+    def _recompute(cls, period, start, pairs=None):
+        '''Сводки за период с началом start для пар (регион, вещество) (по умолчанию для всех)'''
+        end = cls.bounds(period, start)[1]
+        # пересчитываются все сочетания затронутых регионов и веществ, чтобы удаление по IN было корректным
+        regions = substances = None
+        if pairs is not None:
+            regions = sorted({r for r, _ in pairs})
+            substances = sorted({s for _, s in pairs})
+        # в том числе измерения из архивов (догрузка дней заархивированного года)
+        rows = AtmosphericMeasurement.measurements(start, end - timedelta(days=1), regions, substances)
+
+        stats = {}
+        for region, substance, stat in zip(rows['region'].tolist(), rows['substance'].tolist(), rows['stat'].tolist()):
+            stats.setdefault((region, substance), []).append(stat)
+
+        pdk = dict(Substance.select(Substance.id, Substance.daily_pdk).tuples())
+        rows = []
+        for (region, substance), values in stats.items():
+            values = np.asarray(values)
+            rows.append({
+                'region': region,
+                'substance': substance,
+                'period': period,
+                'period_start': start,
+                'count': len(values),
+                'mean': float(values.mean()),
+                'p95': float(np.percentile(values, 95)),
+                'max': float(values.max()),
+                'days_above_pdk': int((values > pdk[substance]).sum()),
+            })
+
+        with cls._meta.database.atomic():
+            d = cls.delete().where((cls.period == period) & (cls.period_start == start))
+            if pairs is not None:
+                d = d.where(cls.region.in_(regions) & cls.substance.in_(substances))
+            d.execute()
+            for batch in pw.chunked(rows, 100):
+                cls.insert_many(batch).execute()
+
 
 class HealthPoint(BaseModel):
     name = pw.CharField(255, unique=True)
@@ -533,20 +1315,224 @@ class SubstancesInclusionInHealthPoints(BaseModel):
     def all_for_health_point(cls, health_point):
         return cls.select().where(cls.point == health_point)
 
+    @classmethod
+    def matrix(cls, substances, points):
+        '''
+        Матрица вхождения веществ в органы
+
+        Returns:
+            np.ndarray[вещество][орган] - 1.0 если вещество влияет на орган, иначе 0.0
+        '''
+        s_idx = {getattr(x, 'id', x): i for i, x in enumerate(substances)}
+        p_idx = {getattr(x, 'id', x): i for i, x in enumerate(points)}
+        m = np.zeros((len(s_idx), len(p_idx)))
+        q = cls.select(cls.substance, cls.point).where(cls.point.in_(list(p_idx))).tuples()
+        for substance, point in q:
+            if substance in s_idx:
+                m[s_idx[substance], p_idx[point]] = 1.0
+        return m
+
+
+_reference = {}
+# бд -> (когда проверено, поколение данных)
+_generation = {}
+_reference_lock = threading.Lock()
+
+
+def data_generation():
+    '''
+    Поколение данных текущей бд (DataGeneration.current), перечитывается не чаще раза в REFERENCE_CHECK_INTERVAL секунд.
+    По нему процессы замечают загрузку данных в другом процессе (под serve загружает главный процесс)
+    '''
+    database = DataGeneration._meta.database
+    now = monotonic()
+    with _reference_lock:
+        checked = _generation.get(database)
+        if checked and now - checked[0] < REFERENCE_CHECK_INTERVAL:
+            return checked[1]
+    generation = DataGeneration.current()
+    with _reference_lock:
+        _generation[database] = (now, generation)
+    return generation
+
+
+def reference():
+    '''
+    Справочные данные, загружаются из бд один раз для каждой бд, к которой привязаны модели,
+    и перечитываются при смене поколения данных (новые станции после загрузки)
+
+    Returns:
+        dict - substances: {id: Substance}, points: {id: HealthPoint}, regions: {id: MeasurementRegion},
+               point_substances: {id органа: list[Substance]}
+    '''
+    database = Substance._meta.database
+    generation = data_generation()
+    with _reference_lock:
+        cached = _reference.get(database)
+        if cached is None or cached[0] != generation:
+            substances = {x.id: x for x in Substance.select(Substance, HazardClass).join(HazardClass, pw.JOIN.LEFT_OUTER)}
+            points = {x.id: x for x in HealthPoint.all()}
+            point_substances = {x: [] for x in points}
+            q = SubstancesInclusionInHealthPoints.select(
+                SubstancesInclusionInHealthPoints.point, SubstancesInclusionInHealthPoints.substance).tuples()
+            for point, substance in q:
+                point_substances[point].append(substances[substance])
+            _reference[database] = (generation, {
+                'substances': substances,
+                'points': points,
+                'regions': {x.id: x for x in MeasurementRegion.all()},
+                'point_substances': point_substances,
+            })
+        return _reference[database][1]
+
+
+def reset_reference():
+    '''Сбрасывает справочные данные (после изменения веществ, органов или регионов)'''
+    with _reference_lock:
+        _reference.clear()
+        _generation.clear()
+
+
+def _lookup(table, id):
+    '''Запись справочника по id из запроса (None если такой нет)'''
+    try:
+        return reference()[table].get(int(id))
+    except (TypeError, ValueError):
+        return None
+
+
+def archive_dir():
+    '''Папка архивов измерений текущей бд (ARCHIVE_DIR или <файл sqlite>-archive рядом с бд)'''
+    if ARCHIVE_DIR:
+        return ARCHIVE_DIR
+    database = AtmosphericMeasurement._meta.database
+    if isinstance(database, pw.SqliteDatabase) and database.database != ':memory:':
+        return os.path.splitext(os.path.abspath(database.database))[0] + '-archive'
+    return 'archive'
+
+
+def partitioned():
+    '''Таблица измерений разбита на партиции по годам (postgresql)'''
+    return isinstance(AtmosphericMeasurement._meta.database, pw.PostgresqlDatabase)
+
+
+def partition_name(year):
+    return f'{AtmosphericMeasurement._meta.table_name}_y{year}'
+
+
+# годы, для которых партиция точно есть (кеш процесса, источник правды - pg_inherits)
+_partitions = set()
+
+
+def create_partitioned():
+    '''
+    Создает таблицу измерений в postgresql как секционированную по дате (PARTITION BY RANGE) с партицией
+    по умолчанию. Первичный ключ партиционированной таблицы должен включать ключ секционирования, поэтому (id, date)
+    '''
+    am = AtmosphericMeasurement
+    database = am._meta.database
+    table = am._meta.table_name
+    if database.table_exists(table):
+        return
+    database.execute_sql(f'''
+        CREATE TABLE "{table}" (
+            "id" SERIAL NOT NULL,
+            "date" DATE NOT NULL,
+            "substance_id" INTEGER NOT NULL REFERENCES "{Substance._meta.table_name}" ("id"),
+            "region_id" INTEGER NOT NULL REFERENCES "{MeasurementRegion._meta.table_name}" ("id"),
+            "source_id" INTEGER NOT NULL REFERENCES "{DataSource._meta.table_name}" ("id"),
+            "stat" REAL,
+            PRIMARY KEY ("id", "date")
+        ) PARTITION BY RANGE ("date")''')
+    database.execute_sql(f'CREATE TABLE IF NOT EXISTS "{table}_default" PARTITION OF "{table}" DEFAULT')
+
+
+def existing_partitions():
+    '''Годы, для которых в бд есть партиции (по pg_inherits: видны партиции, созданные другими процессами)'''
+    table = AtmosphericMeasurement._meta.table_name
+    q = AtmosphericMeasurement._meta.database.execute_sql('''
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = %s''', (table, ))
+    name = re.compile(rf'^{re.escape(table)}_y(\d{{4}})$')
+    return {int(m[1]) for x, in q if (m := name.match(x))}
+
+
+def create_partition(year):
+    '''
+    Создает партицию года. Строки этого года, уже попавшие в партицию по умолчанию (вставленные без
+    ensure_partitions), переносятся в новую партицию: иначе postgresql не даст ее создать
+    '''
+    database = AtmosphericMeasurement._meta.database
+    table = AtmosphericMeasurement._meta.table_name
+    default = f'{table}_default'
+    start, end = f'{year}-01-01', f'{year + 1}-01-01'
+    with database.atomic():
+        # одновременно партицию создает только один процесс, остальные ждут и видят ее готовой
+        database.execute_sql(f'LOCK TABLE "{table}" IN ACCESS EXCLUSIVE MODE')
+        if year in existing_partitions():
+            return
+        database.execute_sql(f'ALTER TABLE "{table}" DETACH PARTITION "{default}"')
+        database.execute_sql(
+            f'CREATE TABLE "{partition_name(year)}" PARTITION OF "{table}" '
+            f"FOR VALUES FROM ('{start}') TO ('{end}')")
+        database.execute_sql(
+            f'INSERT INTO "{partition_name(year)}" SELECT * FROM "{default}" WHERE "date" >= %s AND "date" < %s',
+            (start, end))
+        database.execute_sql(f'DELETE FROM "{default}" WHERE "date" >= %s AND "date" < %s', (start, end))
+        database.execute_sql(f'ALTER TABLE "{table}" ATTACH PARTITION "{default}" DEFAULT')
+
+
+def ensure_partitions(first, last):
+    '''Создает недостающие партиции лет с first по last (вне postgresql ничего не делает)'''
+    if not partitioned():
+        return
+    missing = [x for x in range(first.year, last.year + 1) if x not in _partitions]
+    if not missing:
+        return
+    _partitions.update(existing_partitions())
+    for year in missing:
+        if year not in _partitions:
+            create_partition(year)
+            _partitions.add(year)
+
+
+def drop_partition(year):
+    '''Удаляет (уже пустую) партицию года после архивации'''
+    if not partitioned():
+        return
+    AtmosphericMeasurement._meta.database.execute_sql(f'DROP TABLE IF EXISTS "{partition_name(year)}"')
+    _partitions.discard(year)
+
+
+MODELS = [
+    Users,
+    Tokens,
+    MailOutbox,
+    HazardClass,
+    Substance,
+    ReferenceConcentration,
+    MeasurementRegion,
+    RegionGroup,
+    RegionGroupMember,
+    DataSource,
+    AtmosphericMeasurement,
+    DataGeneration,
+    ChartAccess,
+    ExportJob,
+    MeasurementRollup,
+    HealthPoint,
+    SubstancesInclusionInHealthPoints,
+]
+
 
 def mk_database():
-    db.create_tables([
-        Users,
-        Tokens,
-        HazardClass,
-        Substance,
-        ReferenceConcentration,
-        MeasurementRegion,
-        DataSource,
-        AtmosphericMeasurement,
-        HealthPoint,
-        SubstancesInclusionInHealthPoints,
-    ])
+    if partitioned():
+        # таблицы, на которые ссылаются измерения, нужны до секционированной таблицы
+        db.create_tables(MODELS[:MODELS.index(AtmosphericMeasurement)])
+        create_partitioned()
+    db.create_tables(MODELS)
 
     _HC1 = HazardClass.get_or_create(id=1, a=-9.15, b=11.66)[0]
     _HC2 = HazardClass.get_or_create(id=2, a=-5.51, b=7.49)[0]
@@ -610,4 +1596,6 @@ def mk_database():
 
     SubstancesInclusionInHealthPoints.get_or_create(point=p10, substance=s11)
     SubstancesInclusionInHealthPoints.get_or_create(point=p10, substance=s12)
-    SubstancesInclusionInHealthPoints.get_or_create(point=p10, substance=s13)
\ No newline at end of file
+    SubstancesInclusionInHealthPoints.get_or_create(point=p10, substance=s13)
+
+    RegionGroup.sync_cities()
\ No newline at end of file
@@ -0,0 +1,238 @@
+import re
+import os
+import json
+import logging
+import threading
+import traceback
+import peewee as pw
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from flask import request, has_request_context
+
+
+_PEEWEE_FILE = os.path.normcase(pw.__file__)
+_THIS_FILE = os.path.normcase(__file__)
+
+
+def shape(sql):
+    '''Форма запроса: sql без литералов и с одинаковыми списками IN (?, ?, ...)'''
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\((\s*(\?|%s)\s*,)+\s*(\?|%s)\s*\)', '(?...)', sql)
+    sql = re.sub(r'(\(\?\.\.\.\)\s*,\s*)+\(\?\.\.\.\)', '(?...), ...', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def call_site():
+    '''Ближайшая к запросу строка кода вне peewee и профилировщика'''
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.normcase(frame.filename)
+        if filename in (_PEEWEE_FILE, _THIS_FILE) or frame.name == 'execute_sql':
+            continue
+        return f'{os.path.relpath(frame.filename)}:{frame.lineno} ({frame.name})'
+    return None
+
+
+class QueryProfiler:
+    '''
+    Профилировщик sql-запросов, подключается к бд через query_hooks
+
+    Args:
+        database:       Database - бд с QueryHooksMixin
+        slow_threshold: float    - порог медленного запроса в секундах
+        slow_log:       str      - файл журнала медленных запросов (None - только logging)
+        n_plus_one:     int      - сколько одинаковых по форме запросов за один http-запрос считать N+1
+        explain:        bool     - снимать ли план медленных запросов
+        max_records:    int      - сколько последних запросов хранить
+    '''
+    def __init__(self, database, slow_threshold=0.1, slow_log=None, n_plus_one=20, explain=True, max_records=100000):
+        self.database = database
+        self.slow_threshold = slow_threshold
+        self.n_plus_one = n_plus_one
+        self.explain_slow = explain
+        self.records = deque(maxlen=max_records)
+        self.slow = []
+        self.suspects = []
+        self.started_on = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._requests = 0
+
+        self.logger = logging.getLogger('web.sql')
+        if slow_log and not any(getattr(h, 'baseFilename', None) == os.path.abspath(slow_log) for h in self.logger.handlers):
+            handler = logging.FileHandler(slow_log, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+
+    def start(self):
+        self.started_on = datetime.now()
+        self.begin_scope('session')
+        self.database.query_hooks.append(self.hook)
+
+    def stop(self):
+        if self.hook in self.database.query_hooks:
+            self.database.query_hooks.remove(self.hook)
+        self.end_scope()
+
+    def begin_scope(self, name):
+        '''Начало области поиска N+1 (обычно http-запрос)'''
+        self._local.scope = name
+        self._local.shapes = Counter()
+        self._local.sites = defaultdict(set)
+
+    def end_scope(self):
+        '''Конец области: одинаковые по форме запросы, повторенные много раз, помечаются как N+1'''
+        shapes = getattr(self._local, 'shapes', None)
+        if not shapes:
+            return
+        for sql, count in shapes.items():
+            # управление транзакциями повторяется естественным образом
+            if sql.split(' ', 1)[0].upper() in ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE'):
+                continue
+            if count >= self.n_plus_one:
+                suspect = {
+                    'scope': self._local.scope,
+                    'shape': sql,
+                    'count': count,
+                    'sites': sorted(self._local.sites[sql]),
+                }
+                with self._lock:
+                    self.suspects.append(suspect)
+                self.logger.warning('N+1 в %s: %d раз %s (%s)', suspect['scope'], count, sql, ', '.join(map(str, suspect['sites'][:5])))
+        self._local.shapes = Counter()
+        self._local.sites = defaultdict(set)
+
+    def hook(self, sql, params, duration):
+        # запросы самого профилировщика (EXPLAIN) не учитываются
+        if getattr(self._local, 'busy', False):
+            return
+
+        site = call_site()
+        record = {
+            'sql': sql,
+            'shape': shape(sql),
+            'params': [str(p) for p in params or ()],
+            'duration': duration,
+            'site': site,
+            'scope': getattr(self._local, 'scope', None),
+        }
+        with self._lock:
+            self.records.append(record)
+
+        if hasattr(self._local, 'shapes'):
+            self._local.shapes[record['shape']] += 1
+            self._local.sites[record['shape']].add(site)
+
+        if duration >= self.slow_threshold:
+            if self.explain_slow:
+                record['plan'] = self.explain(sql, params)
+            with self._lock:
+                self.slow.append(record)
+            self.logger.info('медленный запрос %.1f мс в %s: %s %s%s',
+                             duration * 1000, site, sql, record['params'],
+                             ''.join('\n    ' + line for line in record.get('plan', [])))
+
+    def explain(self, sql, params):
+        '''План запроса (только для SELECT)'''
+        if not sql.lstrip().upper().startswith('SELECT'):
+            return []
+        if isinstance(self.database, pw.SqliteDatabase):
+            prefix = 'EXPLAIN QUERY PLAN '
+        else:
+            prefix = 'EXPLAIN '
+        self._local.busy = True
+        try:
+            cursor = self.database.execute_sql(prefix + sql, params)
+            return [' | '.join(map(str, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            return [f'EXPLAIN не удался: {e}']
+        finally:
+            self._local.busy = False
+
+    def init_app(self, app):
+        '''Области N+1 по http-запросам'''
+        @app.before_request
+        def begin_profiling():
+            with self._lock:
+                self._requests += 1
+                n = self._requests
+            self.begin_scope(f'{request.method} {request.full_path.rstrip("?")} #{n}')
+
+        @app.teardown_request
+        def end_profiling(exc):
+            self.end_scope()
+            self.begin_scope('session')
+
+    def dump(self):
+        with self._lock:
+            return {
+                'started_on': self.started_on.isoformat() if self.started_on else None,
+                'finished_on': datetime.now().isoformat(),
+                'slow_threshold': self.slow_threshold,
+                'records': list(self.records),
+                'slow': list(self.slow),
+                'suspects': list(self.suspects),
+            }
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.dump(), file, ensure_ascii=False, indent=1)
+
+
+@contextmanager
+def profiling(database, path, **kwargs):
+    '''Профилирует все запросы внутри контекста и сохраняет сессию в path'''
+    profiler = QueryProfiler(database, **kwargs)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.save(path)
+
+
+def report(path, top=15):
+    '''
+    Сводка по сохраненной сессии профилирования
+
+    Returns:
+        str
+    '''
+    with open(path, encoding='utf-8') as file:
+        session = json.load(file)
+
+    records = session['records']
+    total = sum(r['duration'] for r in records)
+    by_shape = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0, 'sites': Counter()})
+    for r in records:
+        s = by_shape[r['shape']]
+        s['count'] += 1
+        s['total'] += r['duration']
+        s['max'] = max(s['max'], r['duration'])
+        s['sites'][r['site']] += 1
+
+    lines = [
+        f"Сессия {session['started_on']} - {session['finished_on']}",
+        f'Запросов: {len(records)}, суммарно {total * 1000:.1f} мс, форм запросов: {len(by_shape)}',
+        '',
+        f'Топ-{top} по суммарному времени:',
+    ]
+    for sql, s in sorted(by_shape.items(), key=lambda x: -x[1]['total'])[:top]:
+        site, _ = s['sites'].most_common(1)[0]
+        lines.append(f"  {s['total'] * 1000:>10.1f} мс {s['count']:>7} раз  макс {s['max'] * 1000:>8.1f} мс  {site}")
+        lines.append(f'      {sql[:200]}')
+
+    lines += ['', f"Медленные запросы (> {session['slow_threshold'] * 1000:.0f} мс): {len(session['slow'])}"]
+    for r in sorted(session['slow'], key=lambda x: -x['duration'])[:top]:
+        lines.append(f"  {r['duration'] * 1000:>10.1f} мс  {r['site']}")
+        lines.append(f"      {r['sql'][:200]}")
+        lines += [f'      > {line}' for line in r.get('plan', [])]
+
+    lines += ['', f"Подозрения на N+1: {len(session['suspects'])}"]
+    for s in sorted(session['suspects'], key=lambda x: -x['count'])[:top]:
+        lines.append(f"  {s['count']:>7} раз в {s['scope']}  {', '.join(map(str, s['sites'][:5]))}")
+        lines.append(f"      {s['shape'][:200]}")
+
+    return '\n'.join(lines)
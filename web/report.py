@@ -0,0 +1,241 @@
+import os
+import re
+import csv
+import json
+import numpy as np
+import multiprocessing as mp
+from time import perf_counter
+from datetime import date, timedelta
+
+from config import STREAM_CHUNK
+from .models import AtmosphericMeasurement, MeasurementRegion, Substance, HealthPoint, \
+    SubstancesInclusionInHealthPoints, risk_distribution, ACUTE_W, CHRONIC_W, ACUTE_EPISODE, CHRONIC_EPISODE
+from .views import dataset, select_periods
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+# справочные данные отчета, загружаются в главном процессе до создания пула (у дочерних процессов общие страницы
+# памяти). Показания в пул передаются по регионам, см. build
+_DATA = None
+
+
+def load(start, end):
+    '''
+    Загружает справочные данные отчета: регионы, вещества, органы и их коэффициенты.
+    Показания читаются потоком по порциям регионов (AtmosphericMeasurement.stream)
+
+    Returns:
+        dict
+    '''
+    regions = list(MeasurementRegion.all().order_by(MeasurementRegion.id))
+    substances = list(Substance.all().order_by(Substance.id))
+    points = list(HealthPoint.possible_all().order_by(HealthPoint.id))
+
+    def attr(name):
+        return np.asarray([getattr(s, name) for s in substances], dtype=float)
+
+    return {
+        # те же даты [start, end), что и у cubes
+        'labels': [str(start + timedelta(days=i)) for i in range(max((end - start).days, 0))],
+        'regions': [(r.id, r.name) for r in regions],
+        'substances': [(s.id, s.formula) for s in substances],
+        'points': [(p.id, p.name) for p in points],
+        'region_models': regions,
+        'substance_models': substances,
+        'acute_rfc': attr('acute_rfc'),
+        'chronic_rfc': attr('chronic_rfc'),
+        'daily_pdk': attr('daily_pdk'),
+        'yearly_pdk': attr('yearly_pdk'),
+        'a': np.asarray([s.hazard_class.a if s.hazard_class else -3 for s in substances], dtype=float),
+        'b': np.asarray([s.hazard_class.b if s.hazard_class else 0 for s in substances], dtype=float),
+        'incidence': SubstancesInclusionInHealthPoints.matrix(substances, points),
+    }
+
+
+def plan(data):
+    '''
+    Матрица графиков отчета по одному региону: каждый орган (острый и хронический HI) + риски по каждому веществу
+
+    Returns:
+        list[tuple[str, int]] - (kind, индекс органа или вещества)
+    '''
+    tasks = []
+    for p in range(len(data['points'])):
+        tasks += [('acute hi', p), ('chronic hi', p)]
+    for s in range(len(data['substances'])):
+        tasks.append(('risk', s))
+    return tasks
+
+
+def chart(data, values, kind, r, o):
+    '''
+    График в формате /api
+
+    Args:
+        data:   dict - справочные данные (load)
+        values: dict - 'acute' и 'chronic' показания региона np.ndarray[вещество][дата]
+        kind:   str
+        r:      int  - индекс региона
+        o:      int  - индекс органа или вещества
+    '''
+    labels = data['labels']
+    region = data['regions'][r][1]
+
+    if kind in ('acute hi', 'chronic hi'):
+        type = kind.split()[0]
+        hq = np.nan_to_num(values[type]) / data[f'{type}_rfc'][:, None]
+        hi = data['incidence'][:, o] @ hq
+        n = ACUTE_EPISODE if type == 'acute' else CHRONIC_EPISODE
+        name = 'Острый' if type == 'acute' else 'Хронический'
+        effect = 'Острое влияние' if type == 'acute' else 'Хроническое влияние'
+        return {
+            'title': region + f' ({name} HI {data["points"][o][1]})',
+            'labels': labels,
+            'datasets': [dataset([1] * len(labels), 'Пороговое значение', 'gray', width=1, pradius=0),
+                         dataset(select_periods(hi, n).tolist(), effect, 'red'),
+                         dataset(hi.tolist(), f'{name} HI', 'blue')]
+        }
+
+    if kind == 'risk':
+        series = []
+        for type, pdk in (('acute', 'daily_pdk'), ('chronic', 'yearly_pdk')):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                prob = data['a'][o] + data['b'][o] * np.log(np.nan_to_num(values[type][o]) / data[pdk][o])
+            series.append(risk_distribution(prob).tolist())
+        return {
+            'title': region + ' (Индекс опасности)',
+            'labels': labels,
+            'datasets': [dataset(series[0], 'Острый risk', 'red'),
+                         dataset(series[1], 'Хронический risk', 'blue')]
+        }
+
+    raise ValueError(f'unexpected kind "{kind}"')
+
+
+def _init(data, out, formats):
+    global _DATA
+    if data is not None:
+        _DATA = data
+    _DATA['out'] = out
+    _DATA['formats'] = formats
+
+
+def _render(task):
+    '''Считает все графики одного региона и пишет их файлы (выполняется в дочернем процессе)'''
+    r, acute, chronic = task
+    values = {'acute': acute, 'chronic': chronic}
+    return [_write(_DATA, values, kind, r, o) for kind, o in plan(_DATA)]
+
+
+def _write(data, values, kind, r, o):
+    '''Считает один график и пишет его файлы'''
+    c = chart(data, values, kind, r, o)
+    option = data['points'][o][0] if kind.endswith('hi') else data['substances'][o][0]
+    name = re.sub(r'[^\w\-_\.]+', '_', f'{kind}_{data["regions"][r][0]}_{option}')
+    files = []
+
+    if 'csv' in data['formats']:
+        path = os.path.join(data['out'], name + '.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            writer.writerow(('Дата', *[d['label'] for d in c['datasets']]))
+            writer.writerows(zip(c['labels'], *[d['data'] for d in c['datasets']]))
+        files.append(os.path.basename(path))
+
+    if 'json' in data['formats']:
+        path = os.path.join(data['out'], name + '.json')
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(c, file, ensure_ascii=False)
+        files.append(os.path.basename(path))
+
+    return {
+        'kind': kind,
+        'region_id': data['regions'][r][0],
+        'option': option,
+        'title': c['title'],
+        'files': files,
+    }
+
+
+def peak_memory():
+    '''Пиковое потребление памяти главным и дочерними процессами в МБ (None если не поддерживается)'''
+    if resource is None:
+        return None
+    # на linux ru_maxrss в КБ, на macos в байтах
+    scale = 1 if os.uname().sysname == 'Darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return own / 2 ** 20, children / 2 ** 20
+
+
+def build(out, start=None, end=None, workers=None, formats=('csv', 'json'), chunk=STREAM_CHUNK):
+    '''
+    Строит отчет по всем регионам, органам и веществам в папку out.
+    Показания читаются порциями по chunk регионов: пока пул рисует одну порцию, загружается следующая,
+    поэтому память не растет с числом регионов
+
+    Args:
+        out:     str        - папка отчета (создается)
+        start:   date|str   - дата начала (по умолчанию старейшая дата в бд)
+        end:     date|str   - дата конца (по умолчанию новейшая дата в бд)
+        workers: int        - число процессов (по умолчанию число ядер)
+        formats: tuple[str] - 'csv' и/или 'json'
+        chunk:   int        - регионов в порции
+
+    Returns:
+        dict - сводка: число графиков, время, производительность, пиковая память
+    '''
+    global _DATA
+    start = date.fromisoformat(start) if isinstance(start, str) else start or AtmosphericMeasurement.min_date()
+    end = date.fromisoformat(end) if isinstance(end, str) else end or AtmosphericMeasurement.max_date()
+    os.makedirs(out, exist_ok=True)
+
+    t = perf_counter()
+    _DATA = load(start, end)
+    # модели нужны только главному процессу для чтения показаний
+    regions, substances = _DATA.pop('region_models'), _DATA.pop('substance_models')
+    loaded = perf_counter() - t
+
+    # при fork дочерние процессы получают данные без копирования, иначе они передаются каждому процессу один раз
+    if 'fork' in mp.get_all_start_methods():
+        ctx, initargs = mp.get_context('fork'), (None, out, formats)
+    else:
+        ctx, initargs = mp.get_context(), (_DATA, out, formats)
+
+    index = []
+    with ctx.Pool(workers, initializer=_init, initargs=initargs) as pool:
+        stream = AtmosphericMeasurement.stream(start, end, substances, regions, (ACUTE_W, CHRONIC_W), chunk)
+        offset, pending = 0, None
+        while True:
+            t_load = perf_counter()
+            part = next(stream, None)
+            loaded += perf_counter() - t_load
+            # следующая порция загружена, пока пул рисовал предыдущую - забираем ее результат
+            if pending is not None:
+                index += [x for charts in pending.get() for x in charts]
+            if part is None:
+                break
+            chunk_regions, _, (acute, chronic) = part
+            pending = pool.map_async(_render, [(offset + i, acute[i], chronic[i]) for i in range(len(chunk_regions))])
+            offset += len(chunk_regions)
+            del part, acute, chronic
+    elapsed = perf_counter() - t
+
+    index.sort(key=lambda x: (x['region_id'], x['kind'], x['option']))
+    summary = {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'charts': len(index),
+        # время чтения показаний (идет параллельно с отрисовкой предыдущей порции)
+        'load_seconds': round(loaded, 3),
+        'total_seconds': round(elapsed, 3),
+        'charts_per_second': round(len(index) / elapsed, 1) if elapsed else None,
+        'peak_memory_mb': peak_memory(),
+    }
+    with open(os.path.join(out, 'index.json'), 'w', encoding='utf-8') as file:
+        json.dump({**summary, 'charts': index}, file, ensure_ascii=False, indent=1)
+    return summary
@@ -0,0 +1,67 @@
+import os
+import sys
+
+from config import SERVER_HOST, SERVER_PORT, SERVER_WORKERS, SERVER_THREADS, SERVER_TIMEOUT
+from web import app
+from .models import db, reference
+from .spatial import station_index
+
+
+def preload():
+    '''
+    Загружает общее для всех запросов состояние до форка воркеров:
+    справочники веществ, органов и регионов и индекс станций.
+    После форка воркеры получают его копией страниц памяти, без своих запросов к бд.
+    '''
+    reference()
+    station_index()
+    # соединение главного процесса не должно достаться воркерам
+    if not db.is_closed():
+        db.close()
+
+
+def default_workers():
+    '''Число воркеров по умолчанию: 2 * ядра + 1'''
+    return 2 * (os.cpu_count() or 1) + 1
+
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS, threads=SERVER_THREADS,
+          timeout=SERVER_TIMEOUT):
+    '''
+    Запускает приложение под gunicorn с предзагрузкой и форком воркеров
+
+    Планировщик задач работает только в главном процессе (его потоки не переживают форк),
+    метрики и кэши у каждого воркера свои.
+
+    Args:
+        host:    str
+        port:    int
+        workers: int - число процессов (по умолчанию 2 * ядра + 1)
+        threads: int - число потоков в каждом процессе
+        timeout: int - сколько секунд может обрабатываться запрос до перезапуска воркера
+    '''
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit('Для serve нужен gunicorn (pip install gunicorn), под windows используйте app.run()')
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f'{host}:{port}',
+                'workers': workers or default_workers(),
+                'threads': threads,
+                'worker_class': 'gthread' if threads > 1 else 'sync',
+                'timeout': timeout,
+                'preload_app': True,
+                'pre_fork': lambda server, worker: db.close(),
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            app.config['PREFORKED'] = True
+            preload()
+            return app
+
+    Application().run()
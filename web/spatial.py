@@ -0,0 +1,247 @@
+import heapq
+import threading
+import numpy as np
+from datetime import date
+
+from config import POINT_NEIGHBOURS, POINT_IDW_POWER, POINT_CELL, POINT_CACHE_SIZE, POINT_CACHE_TTL
+from .cache import LRUCache
+from .models import AtmosphericMeasurement, MeasurementRegion, Substance, HealthPoint, \
+    SubstancesInclusionInHealthPoints, risk_distribution, data_generation, ACUTE_W, CHRONIC_W
+
+
+EARTH_RADIUS = 6371.0
+
+
+def to_xyz(lat, lng):
+    '''Широта/долгота в градусах -> точки на единичной сфере'''
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lng = np.radians(np.asarray(lng, dtype=float))
+    return np.stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)], axis=-1)
+
+
+def chord_to_km(chord):
+    '''Длина хорды единичной сферы -> расстояние по поверхности земли в км'''
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+
+class KDTree:
+    '''
+    KD-дерево для поиска k ближайших точек
+
+    Args:
+        points:    np.ndarray[точка][координата]
+        leaf_size: int - максимальное число точек в листе
+    '''
+    def __init__(self, points, leaf_size=8):
+        self.points = np.asarray(points, dtype=float).reshape(len(points), -1)
+        self.leaf_size = leaf_size
+        self.root = self._build(np.arange(len(self.points)), 0)
+
+    def _build(self, idx, depth):
+        if len(idx) <= self.leaf_size:
+            return idx
+        axis = depth % self.points.shape[1]
+        idx = idx[np.argsort(self.points[idx, axis])]
+        mid = len(idx) // 2
+        return (axis, self.points[idx[mid], axis], self._build(idx[:mid], depth + 1), self._build(idx[mid:], depth + 1))
+
+    def query(self, point, k=1):
+        '''
+        k ближайших точек
+
+        Returns:
+            tuple[np.ndarray[int], np.ndarray[float]] - индексы точек и расстояния до них (по возрастанию)
+        '''
+        point = np.asarray(point, dtype=float)
+        heap = []  # (-расстояние, индекс), на вершине самая дальняя из найденных
+
+        def visit(node):
+            if isinstance(node, np.ndarray):
+                for i, d in zip(node, np.linalg.norm(self.points[node] - point, axis=1)):
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-d, i))
+                    elif d < -heap[0][0]:
+                        heapq.heapreplace(heap, (-d, i))
+                return
+            axis, split, left, right = node
+            diff = point[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near)
+            if len(heap) < k or abs(diff) < -heap[0][0]:
+                visit(far)
+
+        if len(self.points):
+            visit(self.root)
+        found = sorted((-d, i) for d, i in heap)
+        return np.asarray([i for _, i in found], dtype=int), np.asarray([d for d, _ in found])
+
+
+class StationIndex:
+    '''
+    Пространственный индекс станций измерения
+
+    Args:
+        regions: list[MeasurementRegion]
+    '''
+    def __init__(self, regions):
+        self.regions = list(regions)
+        self.tree = KDTree(to_xyz([x.lat for x in self.regions], [x.lng for x in self.regions]))
+
+    def nearest(self, lat, lng, k=POINT_NEIGHBOURS):
+        '''
+        k ближайших станций
+
+        Returns:
+            list[tuple[MeasurementRegion, float]] - станции и расстояния до них в км
+        '''
+        idx, chord = self.tree.query(to_xyz(lat, lng), min(k, len(self.regions)))
+        return [(self.regions[i], float(d)) for i, d in zip(idx, chord_to_km(chord))]
+
+
+# (поколение данных, индекс)
+_index = None
+_index_lock = threading.Lock()
+_cache = LRUCache('point', POINT_CACHE_SIZE, POINT_CACHE_TTL)
+
+
+def station_index():
+    '''Индекс станций, перестраивается при смене поколения данных (новые станции после загрузки)'''
+    global _index
+    generation = data_generation()
+    with _index_lock:
+        if _index is None or _index[0] != generation:
+            if _index is not None:
+                # соседи ячеек могли поменяться
+                _cache.clear()
+            _index = (generation, StationIndex(MeasurementRegion.all()))
+        return _index[1]
+
+
+def reset_station_index():
+    '''Сбрасывает индекс станций и кеш значений (после изменения списка станций)'''
+    global _index
+    with _index_lock:
+        _index = None
+    _cache.clear()
+
+
+def cell(lat, lng):
+    '''Ячейка сетки, в которую попадает точка, и ее центр'''
+    i, j = int(np.floor(lat / POINT_CELL)), int(np.floor(lng / POINT_CELL))
+    return (i, j), ((i + 0.5) * POINT_CELL, (j + 0.5) * POINT_CELL)
+
+
+def idw(values, distances, power=POINT_IDW_POWER):
+    '''
+    Обратно-взвешенное по расстоянию среднее, пропуски (nan) не учитываются
+
+    Args:
+        values:    np.ndarray[станция][дата]
+        distances: np.ndarray[станция] - расстояния в км
+
+    Returns:
+        np.ndarray[дата] - nan если ни у одной станции нет значения
+    '''
+    distances = np.asarray(distances, dtype=float)
+    # точка совпала со станцией - берется значение станции
+    if (distances == 0).any():
+        weights = (distances == 0).astype(float)
+    else:
+        weights = 1 / distances ** power
+    weights = np.broadcast_to(weights[:, None], values.shape)
+    valid = ~np.isnan(values)
+    total = np.where(valid, weights, 0).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(valid, values * weights, 0).sum(axis=0) / total
+
+
+def _series(kind, option, start, end, regions):
+    '''Ряды по станциям: даты и np.ndarray[станция][ряд][дата]'''
+    if kind in ('acute', 'chronic'):
+        substance = Substance.get_or_none(id=option)
+        if substance is None:
+            return None
+        w = ACUTE_W if kind == 'acute' else CHRONIC_W
+        x, c = AtmosphericMeasurement.cube(start, end, substance, regions, w)
+        return x, c[:, :, :], [substance.formula]
+
+    if kind in ('acute hi', 'chronic hi'):
+        point = HealthPoint.get_or_none(id=option)
+        if point is None:
+            return None
+        substances = [x.substance for x in SubstancesInclusionInHealthPoints.all_for_health_point(point)]
+        type = kind.split()[0]
+        w = ACUTE_W if type == 'acute' else CHRONIC_W
+        rfc = np.asarray([x.acute_rfc if type == 'acute' else x.chronic_rfc for x in substances])
+        x, c = AtmosphericMeasurement.cube(start, end, substances, regions, w)
+        # HI = сумма HQ = C / RfC, пропуски считаются нулями
+        hi = np.nansum(c / rfc[None, :, None], axis=1)
+        return x, hi[:, None, :], [f'HI {point}']
+
+    if kind == 'risk':
+        substance = Substance.get_or_none(id=option)
+        if substance is None:
+            return None
+        hc = substance.hazard_class
+        a, b = (hc.a, hc.b) if hc else (-3, 0)
+        series = []
+        for w, pdk in ((ACUTE_W, substance.daily_pdk), (CHRONIC_W, substance.yearly_pdk)):
+            x, c = AtmosphericMeasurement.cube(start, end, substance, regions, w)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                prob = a + b * np.log(np.nan_to_num(c[:, 0, :]) / pdk)
+            series.append(risk_distribution(prob))
+        return x, np.stack(series, axis=1), ['Острый risk', 'Хронический risk']
+
+    return None
+
+
+def point_chart(kind, lat, lng, option, start=None, end=None, k=POINT_NEIGHBOURS, power=POINT_IDW_POWER):
+    '''
+    Ряд значений в произвольной точке, интерполированный по k ближайшим станциям.
+    Значения считаются для центра ячейки сетки POINT_CELL и кешируются по ячейке до смены поколения данных.
+
+    Args:
+        kind:   str       - 'acute', 'chronic', 'acute hi', 'chronic hi', 'risk'
+        lat:    float     - широта
+        lng:    float     - долгота
+        option: int|str   - id вещества или органа
+        start:  date|str  - дата начала (по умолчанию старейшая дата в бд)
+        end:    date|str  - дата конца (по умолчанию новейшая дата в бд)
+
+    Returns:
+        dict|None - данные в формате графика
+    '''
+    start = date.fromisoformat(start) if isinstance(start, str) else start or AtmosphericMeasurement.min_date()
+    end = date.fromisoformat(end) if isinstance(end, str) else end or AtmosphericMeasurement.max_date()
+
+    key, (clat, clng) = cell(lat, lng)
+    generation = data_generation()
+
+    def compute():
+        stations = station_index().nearest(clat, clng, k)
+        if not stations:
+            return None
+        regions = [region for region, _ in stations]
+        distances = np.asarray([d for _, d in stations])
+        res = _series(kind, option, start, end, regions)
+        if res is None:
+            return None
+        x, values, labels = res
+
+        datasets = []
+        for i, label in enumerate(labels):
+            y = idw(values[:, i, :], distances, power)
+            datasets.append({'label': label, 'data': [None if np.isnan(v) else float(v) for v in y]})
+
+        weights = 1 / np.maximum(distances, 1e-9) ** power
+        return {
+            'title': f'{clat:.4f}, {clng:.4f} ({kind})',
+            'lat': clat,
+            'lng': clng,
+            'labels': list(map(str, x)),
+            'datasets': datasets,
+            'stations': [{'id': region.id, 'name': region.name, 'distance': round(d, 3), 'weight': float(wt)}
+                         for (region, d), wt in zip(stations, weights / weights.sum())],
+        }
+
+    return _cache.get_or_compute((generation, key, kind, str(option), start, end, k, power), compute)
@@ -1,9 +1,15 @@
+import smtplib
 from datetime import datetime, timedelta
+from flask_mail import Message, BadHeaderError
 
 
-from web import scheduler, SCRAPING_INTENSITY, CLEARING_INTENSITY
+from web import scheduler, mail, SCRAPING_INTENSITY, CLEARING_INTENSITY, EXPORT_CLEARING_INTENSITY, \
+    MAIL_SENDING_INTENSITY, MAIL_BATCH_SIZE, MAIL_MAX_ATTEMPTS, MAIL_RETRY_DELAY
 from myparser import load_data
-from .models import Tokens, AtmosphericMeasurement
+from .views import warm_charts
+from .models import Tokens, AtmosphericMeasurement, MailOutbox
+from .metrics import timed_job
+from . import exports
 
 
 def clearing_tokens():
@@ -12,6 +18,42 @@ def clearing_tokens():
             Tokens.delete_by_id(token)
 
 
+def clearing_outbox():
+    MailOutbox.delete().where(MailOutbox.sent_on < datetime.now() - timedelta(seconds=CLEARING_INTENSITY)).execute()
+
+
+def clearing_exports():
+    '''Удаляет истекшие выгрузки и их файлы'''
+    exports.clear()
+
+
+def sending_mail():
+    '''Отправляет накопившиеся письма пачкой через одно smtp-соединение'''
+    batch = list(MailOutbox.pending(MAIL_BATCH_SIZE, MAIL_MAX_ATTEMPTS))
+    if not batch:
+        return
+
+    with scheduler.app.app_context():
+        try:
+            with mail.connect() as conn:
+                while batch:
+                    letter = batch[0]
+                    msg = Message(subject=letter.subject, html=letter.html, recipients=[letter.recipient])
+                    try:
+                        conn.send(msg)
+                    # ошибки конкретного письма не должны мешать остальным
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                            smtplib.SMTPDataError, BadHeaderError) as e:
+                        letter.mark_failed(e, MAIL_RETRY_DELAY)
+                    else:
+                        letter.mark_sent()
+                    batch.pop(0)
+        except Exception as e:
+            # соединение не установилось или оборвалось - откладываем то, что не успели отправить
+            for letter in batch:
+                letter.mark_failed(e, MAIL_RETRY_DELAY)
+
+
 def parse_data():
     # now = datetime.now().date()
     # if now == AtmosphericMeasurement.max_date():
@@ -27,19 +69,43 @@ def parse_data():
         load_data(now)
     load_data(AtmosphericMeasurement.min_date())
 
+    # под serve кеши прогревают сами воркеры (ensure_warm), кеш главного процесса запросы не обслуживает
+    if not scheduler.app.config.get('PREFORKED'):
+        warm_charts()
     
 
 # автоматическая чистка бд
 scheduler.add_job(
     id=clearing_tokens.__name__,
-    func=clearing_tokens,
+    func=timed_job(clearing_tokens),
     trigger='interval',
     seconds=CLEARING_INTENSITY)
 
+# автоматическая чистка отправленных писем
+scheduler.add_job(
+    id=clearing_outbox.__name__,
+    func=timed_job(clearing_outbox),
+    trigger='interval',
+    seconds=CLEARING_INTENSITY)
+
+# автоматическая чистка выгрузок
+scheduler.add_job(
+    id=clearing_exports.__name__,
+    func=timed_job(clearing_exports),
+    trigger='interval',
+    seconds=EXPORT_CLEARING_INTENSITY)
+
+# автоматическая отправка писем
+scheduler.add_job(
+    id=sending_mail.__name__,
+    func=timed_job(sending_mail),
+    trigger='interval',
+    seconds=MAIL_SENDING_INTENSITY)
+
 # автоматический парсинг
 scheduler.add_job(
     id=parse_data.__name__,
-    func=parse_data,
+    func=timed_job(parse_data),
     trigger='interval',
     seconds=SCRAPING_INTENSITY
-)
\ No newline at end of file
+)
@@ -1,14 +1,31 @@
+import os
 import re
 import csv
+import bisect
+import threading
+import peewee as pw
 from io import StringIO, BytesIO
+from time import monotonic
+from collections import Counter
 from flask import *
-from datetime import date
-from flask_mail import Message
+from datetime import date, datetime
 from urllib.parse import urljoin
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from web import app, mail
+from web import app, POINT_NEIGHBOURS, CHART_CACHE_SIZE, CHART_WARM_LIMIT, CHART_STATS_FLUSH, CORRELATION_MIN_PERIODS, \
+    ADMISSION_CAPACITY, ADMISSION_FREE, ADMISSION_QUEUE, ADMISSION_TIMEOUT, ADMISSION_PER_USER, EXPORT_SYNC_LIMIT
 from .models import *
+from .models import _lookup
+from .cache import LRUCache
+from .admission import AdmissionControl, Rejected, estimate
+from .windows import parse_window
+from .compression import Payload, attachment
+from .metrics import span, REGISTRY
+from .spatial import point_chart
+from .episodes import episode_mask, health_episodes
+from .correlation import correlation
+from .impact import impact
+from . import exports
 
 
 def ffield(label, name, type, error_feedbacks=None):
@@ -98,10 +115,7 @@ def signup():
             user.signin(session)
             token = Tokens.new(user)
             url = urljoin(request.base_url, url_for('verify', token=token))
-            msg = Message(html=render_template(
-                'verification_mail.html', url=url))
-            msg.add_recipient(user.email)
-            mail.send(msg)
+            MailOutbox.enqueue(user.email, render_template('verification_mail.html', url=url))
 
             return render_verify('Письмо с ссылкой для подтверждения было выслано вам на почту.', session)
 
@@ -175,6 +189,7 @@ def monitoring():
         session=session,
         regions=MeasurementRegion.all(),
         options=options,
+        groups=RegionGroup.all().order_by(RegionGroup.name),
         min_date=AtmosphericMeasurement.min_date(),
         max_date=AtmosphericMeasurement.max_date()
     )
@@ -182,10 +197,170 @@ def monitoring():
 
 @app.route('/download/<kind>/<region>/<option>/<start>/<end>')
 def download(kind, region, option, start, end):
-    if Users.from_session(session) is None:
+    with span('auth', db=True):
+        user = Users.from_session(session)
+    if user is None:
+        return Response(status=401)
+
+    agg = request.args.get('agg', 'mean')
+    window = request.args.get('window')
+    generation = DataGeneration.current()
+    try:
+        # тяжелый график, которого нет в кеше, считается фоновой выгрузкой, а не в запросе
+        if (chart_cost(kind, region, option, start, end, window) > EXPORT_SYNC_LIMIT
+                and _charts.get(chart_key(kind, region, option, start, end, agg, generation, window)) is None):
+            return start_export(user, kind, region, option, start, end, agg, window, generation)
+
+        with span('compute'):
+            chart = chart_entry(kind, region, option, start, end, agg, generation, user.id, window)
+    except ValueError:
+        return Response(status=400)
+    if not chart.data:
+        return Response(status=400)
+
+    with span('serialize'):
+        return chart.payload('csv', lambda: csv_payload(chart.data)).response()
+
+
+@app.route('/exports', methods=['POST'])
+def create_export():
+    '''
+    Ставит выгрузку графика в csv в фоновую очередь. Одинаковая незавершенная или готовая выгрузка
+    не ставится повторно, возвращается она же
+
+    Params (форма или json):
+        kind, region, option, start, end, agg, window - как у /download
+
+    Ответ 202 (200 если выгрузка уже готова) со статусом выгрузки (см. /exports/<id>), Location - адрес статуса
+    '''
+    with span('auth', db=True):
+        user = Users.from_session(session)
+    if user is None:
+        return Response(status=401)
+
+    params = request.get_json(silent=True) or request.form
+    try:
+        return start_export(user, params.get('kind'), params.get('region'), params.get('option'),
+                            params.get('start'), params.get('end'), params.get('agg') or 'mean', params.get('window'),
+                            DataGeneration.current())
+    except ValueError:
+        return Response(status=400)
+
+
+@app.route('/exports/<id>')
+def export_status(id):
+    '''
+    Статус выгрузки
+
+    Ответ:
+        id       - id выгрузки
+        status   - 'pending', 'running', 'done' или 'failed'
+        progress - доля выполненной работы от 0 до 1
+        position - сколько выгрузок в очереди впереди (для 'pending')
+        error    - почему выгрузка не удалась (для 'failed')
+        size     - размер файла в байтах (для 'done')
+        expires  - до какого времени хранится результат
+        file     - адрес файла (для 'done')
+    '''
+    with span('auth', db=True):
+        user = Users.from_session(session)
+    if user is None:
+        return Response(status=401)
+    if not (job := live_export(id)):
+        return Response(status=404)
+    # поставивший выгрузку воркер мог завершиться, не начав ее
+    exports.revive(job, export_chart)
+    return jsonify(export_state(job))
+
+
+@app.route('/exports/<id>/file')
+def export_file(id):
+    '''Файл готовой выгрузки (с поддержкой Range и условных запросов)'''
+    with span('auth', db=True):
+        user = Users.from_session(session)
+    if user is None:
         return Response(status=401)
+    if not (job := live_export(id)) or job.status != 'done' or not os.path.isfile(exports.path(job.id)):
+        return Response(status=404)
+    return send_file(os.path.abspath(exports.path(job.id)), mimetype='text/csv', as_attachment=True,
+                     download_name=job.name, conditional=True, etag=job.id, max_age=0)
+
+
+def live_export(id):
+    '''Выгрузка id, если она есть и не истекла'''
+    job = ExportJob.get_or_none(id=id)
+    if job is None or (job.expires_on and job.expires_on < datetime.now()):
+        return None
+    return job
+
+
+def export_state(job):
+    '''Статус выгрузки для ответа клиенту'''
+    state = {
+        'id': job.id,
+        'status': job.status,
+        'progress': round(job.progress, 2),
+        'expires': job.expires_on.isoformat(timespec='seconds') if job.expires_on else None,
+    }
+    if job.status == 'pending':
+        state['position'] = job.position()
+    elif job.status == 'failed':
+        state['error'] = job.error
+    elif job.status == 'done':
+        state['size'] = job.size
+        state['file'] = url_for('export_file', id=job.id)
+    return state
 
-    data = make_chart(kind, region, option, start, end)
+
+def start_export(user, kind, region, option, start, end, agg, window, generation):
+    '''
+    Ставит выгрузку графика (или находит такую же) и отвечает ее статусом
+
+    Raises:
+        ValueError - неизвестный вид графика, регион, опция, неверные даты или окно
+    '''
+    window = parse_window(window)
+    if kind not in ('acute', 'chronic', 'acute hi', 'chronic hi', 'risk') or (window and kind == 'risk'):
+        raise ValueError(f'unexpected export of "{kind}"')
+    if not chart_cost(kind, region, option, start, end, window):
+        raise ValueError('unknown region or option')
+    aggregate(np.zeros((1, 1)), agg)
+
+    job, _ = exports.submit(export_chart, user.id, kind, str(region), str(option), start or '', end or '', agg,
+                            str(window or ''), generation)
+    response = jsonify(export_state(job))
+    response.status_code = 200 if job.status == 'done' else 202
+    response.headers['Location'] = url_for('export_status', id=job.id)
+    return response
+
+
+def export_chart(job, progress):
+    '''
+    Считает выгрузку в потоке пула выгрузок. Допуск по стоимости не нужен: параллельность ограничена пулом.
+    Результат попадает и в кеш графиков, как у /download
+
+    Returns:
+        tuple[str, bytes] - имя файла и csv
+    '''
+    def compute():
+        return CachedChart(make_chart(job.kind, job.region, job.option, job.start, job.end, job.agg, job.window))
+
+    progress(0.05)
+    key = chart_key(job.kind, job.region, job.option, job.start, job.end, job.agg, job.generation, job.window)
+    chart = _charts.get_or_compute(key, compute)
+    if not chart.data:
+        raise ValueError('nothing to export')
+    progress(0.9)
+    return csv_name(chart.data), chart.payload('csv', lambda: csv_payload(chart.data)).body
+
+
+def csv_name(data):
+    '''Имя csv файла графика'''
+    return re.sub(r'[^\w\-_\.]+', '_', f"{data['title']}.csv")
+
+
+def csv_payload(data):
+    '''График в виде csv файла для скачивания'''
     header = ('Дата', *[dataset['label'] for dataset in data['datasets']])
     body = zip(data['labels'], *[dataset['data']
                for dataset in data['datasets']])
@@ -195,11 +370,7 @@ def download(kind, region, option, start, end):
     writer.writerows([header])
     writer.writerows(body)
 
-    file.seek(0)
-    return send_file(BytesIO(file.read().encode('utf-8', 'replace')),
-                     mimetype='text/csv',
-                     as_attachment=True,
-                     download_name=re.sub(r'[^\w\-_\.]+', '_', f"{data['title']}.csv"))
+    return Payload(file.getvalue().encode('utf-8', 'replace'), 'text/csv', {'Content-Disposition': attachment(csv_name(data))})
 
 
 def dataset(data, label, color, width=2, pradius=0.1):
@@ -215,30 +386,78 @@ def dataset(data, label, color, width=2, pradius=0.1):
 
 
 def select_periods(data, n, threshold=1):
-    exc = data >= threshold
-    exc_idx  = np.where(np.convolve(exc, np.ones(n), mode='same') == n)[0] - int(np.ceil(n / 2))
-    exc_seq = np.concatenate([exc_idx + i for i in range(n + 2)])
-    exc_seq = exc_seq[exc_seq < len(data)]
-    y = np.asarray([None] * len(data))
-    y[exc_seq] = data[exc_seq]
+    '''Показания в эпизодах превышения threshold длиной не меньше n дней, остальные дни None'''
+    data = np.asarray(data, dtype=float)
+    mask = episode_mask(data, n, threshold)
+    y = np.full(len(data), None, dtype=object)
+    y[mask] = data[mask].tolist()
     return y
 
 
-def make_chart(kind, region, option, start, end):
+def resolve_region(region):
+    '''
+    Регион или группа регионов
+
+    Args:
+        region: int|str|MeasurementRegion - id региона или "g<id>" для группы регионов
+
+    Returns:
+        tuple[str, bool, list[MeasurementRegion]]|None - название, группа ли это, регионы
+    '''
+    if isinstance(region, MeasurementRegion):
+        return region.name, False, [region]
+
+    if isinstance(region, str) and region.startswith('g'):
+        group = RegionGroup.get_or_none(id=region[1:]) if region[1:].isdigit() else None
+        regions = list(group.members()) if group else None
+        return (group.name, True, regions) if regions else None
+
+    region = _lookup('regions', region)
+    return (region.name, False, [region]) if region else None
+
+
+def fold(chunks, agg='mean'):
+    '''
+    Свертка по регионам рядов, которые приходят порциями регионов (см. AtmosphericMeasurement.stream):
+    в памяти только текущая порция и накопленная свертка, а не кубы всех регионов группы
+
+    Args:
+        chunks: iterable[tuple[np.ndarray[дата], list[np.ndarray[регион][дата]]]] - даты и ряды порции
+        agg:    str - свертка (см. aggregate)
+
+    Returns:
+        tuple[list[str], list[list[float|None]]] - даты и свернутые ряды (None где нет показаний)
+    '''
+    x, folds = [], None
+    for x, values in chunks:
+        if folds is None:
+            folds = [RunningAggregate(agg) for _ in values]
+        for f, v in zip(folds, values):
+            f.add(v)
+    return list(map(str, x)), [[None if np.isnan(v) else float(v) for v in f.result(len(x))] for f in folds]
+
+
+def make_chart(kind, region, option, start, end, agg='mean', window=None):
 
-    if isinstance(region, (int, str)):
-        region = MeasurementRegion.get_or_none(id=region)
-        if not region:
-            return None
+    # окно усреднения вместо стандартного для вида графика (среднесуточного или среднегодового)
+    window = parse_window(window)
+    if window and kind == 'risk':
+        raise ValueError('window is not supported for risk')
+
+    if not (resolved := resolve_region(region)):
+        return None
+    name, is_group, region = resolved
+    if is_group:
+        name += f' [{agg}]'
 
     if kind in ('acute hi', 'chronic hi'):
         if isinstance(option, (int, str)):
-            hp = HealthPoint.get(id=option)
-            substance = [
-                x.substance for x in SubstancesInclusionInHealthPoints.all_for_health_point(hp)]
+            if not (hp := _lookup('points', option)):
+                return None
+            substance = reference()['point_substances'][hp.id]
     else:
         if isinstance(option, (int, str)):
-            if not (substance := Substance.get_or_none(id=option)):
+            if not (substance := _lookup('substances', option)):
                 return None
 
     if not start:
@@ -252,38 +471,35 @@ def make_chart(kind, region, option, start, end):
         end = date.fromisoformat(end)
 
     if kind == 'acute':
-        c = AtmosphericMeasurement.C(start, end, substance, region, w=ACUTE_W)
-        x = list(map(str, c[0, 0, :, 0]))
+        x, (y1, ) = fold(((x, [c[:, 0]]) for _, x, (c, ) in AtmosphericMeasurement.stream(
+            start, end, substance, region, (window or ACUTE_W, ))), agg)
         y0 = [substance.daily_pdk] * len(x)
-        y1 = c[0, 0, :, 1].tolist()
         data = {
-            'title': region.name + f' (Среднесуточные {substance.formula})',
+            'title': name + (f' (Окно {window} {substance.formula})' if window else f' (Среднесуточные {substance.formula})'),
             'labels': x,
             'datasets': [dataset(y0, 'ПДК', 'red', width=1, pradius=0),
                          dataset(y1, substance.formula, 'blue')]
         }
 
     elif kind == 'chronic':
-        c = AtmosphericMeasurement.C(start, end, substance, region, w=CHRONIC_W)
-        x = list(map(str, c[0, 0, :, 0]))
+        x, (y1, ) = fold(((x, [c[:, 0]]) for _, x, (c, ) in AtmosphericMeasurement.stream(
+            start, end, substance, region, (window or CHRONIC_W, ))), agg)
         y0 = [substance.yearly_pdk] * len(x)
-        y1 = c[0, 0, :, 1].tolist()
         data = {
-            'title': region.name + f' (Среднегодовые {substance.formula})',
+            'title': name + (f' (Окно {window} {substance.formula})' if window else f' (Среднегодовые {substance.formula})'),
             'labels': x,
             'datasets': [dataset(y0, 'ПДК', 'red', width=1, pradius=0),
                          dataset(y1, substance.formula, 'blue')]
         }
 
     elif kind == 'acute hi':
-        acute_hi = AtmosphericMeasurement.HI('acute', start, end, substance, region)
-        x = list(map(str, acute_hi[0, :, 0]))
+        x, (y1, ) = fold(((x, [hi[:, 0]]) for _, x, hi in AtmosphericMeasurement.stream_HI(
+            'acute', start, end, hp, region, window)), agg)
         y0 = [1] * len(x)
-        y1 = acute_hi[0, :, 1].tolist()
-        y2 = select_periods( acute_hi[0, :, 1], 5).tolist()
+        y2 = select_periods(np.asarray(y1, dtype=float), ACUTE_EPISODE).tolist()
 
         data = {
-            'title': region.name + f' (Острый HI {hp})',
+            'title': name + (f' (Острый HI {hp}, окно {window})' if window else f' (Острый HI {hp})'),
             'labels': x,
             'datasets': [dataset(y0, 'Пороговое значение', 'gray', width=1, pradius=0),
                          dataset(y2, 'Острое влияние', 'red'),
@@ -291,14 +507,13 @@ def make_chart(kind, region, option, start, end):
         }
 
     elif kind == 'chronic hi':
-        chronic_hi = AtmosphericMeasurement.HI('chronic', start, end, substance, region)
-        x = list(map(str, chronic_hi[0, :, 0]))
+        x, (y1, ) = fold(((x, [hi[:, 0]]) for _, x, hi in AtmosphericMeasurement.stream_HI(
+            'chronic', start, end, hp, region, window)), agg)
         y0 = [1] * len(x)
-        y1 = chronic_hi[0, :, 1].tolist()
-        y2 = select_periods(chronic_hi[0, :, 1], 90).tolist()
+        y2 = select_periods(np.asarray(y1, dtype=float), CHRONIC_EPISODE).tolist()
 
         data = {
-            'title': region.name + f' (Хронический HI {hp})',
+            'title': name + (f' (Хронический HI {hp}, окно {window})' if window else f' (Хронический HI {hp})'),
             'labels': x,
             'datasets': [dataset(y0, 'Пороговое значение', 'gray', width=1, pradius=0),
                          dataset(y2, 'Хроническое влияние', 'red'),
@@ -306,14 +521,20 @@ def make_chart(kind, region, option, start, end):
         }
 
     elif kind == 'risk':
-        acute_risk = AtmosphericMeasurement.risk('acute', start, end, substance, region)
-        chronic_risk = AtmosphericMeasurement.risk('chronic', start, end, substance, region)
-        x = list(map(str, acute_risk[0, 0, :, 0]))
-        y0 = acute_risk[0, 0, :, 1].tolist()
-        y1 = chronic_risk[0, 0, :, 1].tolist()
+        # оба окна по одной выборке на порцию, risk = таблица распределения от a + b * ln(C / ПДК)
+        hc = substance.hazard_class
+        a, b = (hc.a, hc.b) if hc else (-3, 0)
+
+        def risks(c, pdk):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return risk_distribution(a + b * np.log(np.nan_to_num(c[:, 0]) / pdk))
+
+        x, (y0, y1) = fold(((x, [risks(acute, substance.daily_pdk), risks(chronic, substance.yearly_pdk)])
+                            for _, x, (acute, chronic) in AtmosphericMeasurement.stream(
+                                start, end, substance, region, (ACUTE_W, CHRONIC_W))), agg)
 
         data = {
-            'title': region.name + f' (Индекс опасности)',
+            'title': name + f' (Индекс опасности)',
             'labels': x,
             'datasets': [dataset(y0, 'Острый risk', 'red'),
                          dataset(y1, 'Хронический risk', 'blue')]
@@ -325,30 +546,618 @@ def make_chart(kind, region, option, start, end):
     return data
 
 
+def chart_lookback(kind):
+    '''Сколько дней перед новыми данными могут измениться на графике (эпизоды превышения)'''
+    return {'acute hi': ACUTE_EPISODE - 1, 'chronic hi': CHRONIC_EPISODE - 1}.get(kind, 0)
+
+
+def make_delta(kind, region, option, since, start, end, agg='mean', window=None):
+    '''
+    Точки графика после since. Скользящие средние считаются с учетом дней до since,
+    дни перед since, которые могли измениться (эпизоды превышения), пересчитываются и тоже отдаются
+
+    Returns:
+        dict|None - данные в формате make_chart и replace_from - дата, начиная с которой клиент заменяет свои точки
+    '''
+    lookback = chart_lookback(kind)
+    keep_from = since + timedelta(days=1 - lookback)
+    # чтобы эпизоды на границе посчитались верно, берем еще lookback дней
+    calc_start = keep_from - timedelta(days=lookback)
+    if start:
+        start = date.fromisoformat(start)
+        keep_from = max(keep_from, start)
+        calc_start = max(calc_start, start)
+
+    data = make_chart(kind, region, option, calc_start.isoformat(), end, agg, window)
+    if not data:
+        return None
+
+    i = bisect.bisect_left(data['labels'], keep_from.isoformat())
+    data['labels'] = data['labels'][i:]
+    for d in data['datasets']:
+        d['data'] = d['data'][i:]
+    data['replace_from'] = keep_from.isoformat()
+    return data
+
+
+_charts = LRUCache('chart', CHART_CACHE_SIZE)
+_access = Counter()
+_access_lock = threading.Lock()
+_access_flushed = monotonic()
+_warm_lock = threading.Lock()
+_warmed_generation = 0
+
+
+_admission = AdmissionControl(ADMISSION_CAPACITY, ADMISSION_QUEUE, ADMISSION_TIMEOUT, ADMISSION_PER_USER, ADMISSION_FREE)
+
+
+@app.errorhandler(Rejected)
+def rejected(e):
+    return Response(status=e.status, headers={'Retry-After': str(e.retry_after)})
+
+
+def chart_cost(kind, region, option, start, end, window=None):
+    '''
+    Оценка стоимости make_chart до вычисления (см. admission.estimate)
+
+    Returns:
+        float - 0 если график не построится (неизвестный регион или опция)
+    '''
+    if not (resolved := resolve_region(region)):
+        return 0
+    substances = 1
+    if kind in ('acute hi', 'chronic hi'):
+        if not (hp := _lookup('points', option)):
+            return 0
+        substances = len(reference()['point_substances'][hp.id])
+    start = date.fromisoformat(start) if start else AtmosphericMeasurement.min_date()
+    end = date.fromisoformat(end) if end else AtmosphericMeasurement.max_date()
+    return estimate(kind, substances, len(resolved[2]), (end - start).days, parse_window(window))
+
+
+def admit(cost, user=None):
+    '''Допуск тяжелого вычисления текущего запроса (Rejected превращается в 429/503 с Retry-After)'''
+    route = request.url_rule.rule if has_request_context() and request.url_rule else 'background'
+    return _admission.admit(cost, user, route)
+
+
+class CachedChart:
+    '''
+    График в кеше и готовые (в том числе сжатые) тела ответов по нему
+
+    Fields:
+        data: dict|None - результат make_chart
+    '''
+    def __init__(self, data):
+        self.data = data
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def payload(self, name, render):
+        '''Тело ответа name, при первом обращении строится render() -> Payload'''
+        with self._lock:
+            if name not in self._payloads:
+                self._payloads[name] = render()
+            return self._payloads[name]
+
+
+def chart_entry(kind, region, option, start, end, agg, generation, user=None, window=None):
+    '''
+    make_chart с кешем по поколению данных: новые данные дают новые ключи, старые вытесняются.
+    Одновременные одинаковые запросы ждут одно вычисление, само вычисление проходит допуск по стоимости
+
+    Returns:
+        CachedChart
+
+    Raises:
+        Rejected - сервер перегружен тяжелыми запросами
+    '''
+    def compute():
+        with admit(chart_cost(kind, region, option, start, end, window), user):
+            return CachedChart(make_chart(kind, region, option, start, end, agg, window))
+
+    return _charts.get_or_compute(chart_key(kind, region, option, start, end, agg, generation, window), compute)
+
+
+def chart_key(kind, region, option, start, end, agg, generation, window=None):
+    '''Ключ графика в кеше'''
+    return (generation, kind, str(region), str(option), start or '', end or '', agg, str(parse_window(window) or ''))
+
+
+def cached_chart(kind, region, option, start, end, agg, generation, user=None):
+    '''
+    График из кеша (см. chart_entry)
+
+    Returns:
+        dict|None - копия графика (верхний уровень можно дополнять)
+    '''
+    data = chart_entry(kind, region, option, start, end, agg, generation, user).data
+    return dict(data) if data else data
+
+
+def reset_chart_cache():
+    '''Очищает кеш графиков'''
+    _charts.clear()
+
+
+def flush_access():
+    '''
+    Сохраняет накопленную статистику запросов графиков в бд. Если бд не ответила (например, занята другим
+    процессом), статистика остается в памяти до следующего раза
+    '''
+    global _access_flushed
+    with _access_lock:
+        counts = dict(_access)
+        _access.clear()
+        _access_flushed = monotonic()
+    if not counts:
+        return
+    try:
+        ChartAccess.record(counts)
+    except pw.DatabaseError as e:
+        app.logger.warning('статистика запросов графиков не сохранена: %s', e)
+        with _access_lock:
+            _access.update(counts)
+
+
+def record_access(kind, region, option, agg):
+    '''
+    Учитывает запрос графика, в бд статистика сбрасывается не чаще раза в CHART_STATS_FLUSH секунд
+    в фоновом потоке, чтобы запись в бд не задерживала и не ломала запрос
+    '''
+    global _access_flushed
+    with _access_lock:
+        _access[(kind, str(region), str(option), agg)] += 1
+        due = monotonic() - _access_flushed >= CHART_STATS_FLUSH
+        if due:
+            # следующий запрос не запустит второй сброс, пока идет этот
+            _access_flushed = monotonic()
+    if due:
+        threading.Thread(target=_flush_access_background, name='flush-access', daemon=True).start()
+
+
+def _flush_access_background():
+    try:
+        flush_access()
+    finally:
+        # у потока свое соединение sqlite
+        if not db.is_closed():
+            db.close()
+
+
+def warm_charts(limit=CHART_WARM_LIMIT, generation=None):
+    '''
+    Прогревает кеш самыми запрашиваемыми графиками за весь период (так их открывает /monitoring)
+
+    Args:
+        limit:      int - сколько графиков посчитать
+        generation: int - поколение данных (по умолчанию текущее)
+
+    Returns:
+        int - число прогретых графиков
+    '''
+    global _warmed_generation
+    flush_access()
+    if generation is None:
+        generation = DataGeneration.current()
+    with _warm_lock:
+        _warmed_generation = max(_warmed_generation, generation)
+
+    start, end = AtmosphericMeasurement.min_date(), AtmosphericMeasurement.max_date()
+    if start is None:
+        return 0
+    warmed = 0
+    for x in ChartAccess.top(limit):
+        try:
+            if cached_chart(x.kind, x.region, x.option, start.isoformat(), end.isoformat(), x.agg, generation):
+                warmed += 1
+        except ValueError:
+            pass
+        except Rejected:
+            # сервер занят запросами пользователей, остальное посчитается по запросу
+            break
+    return warmed
+
+
+def ensure_warm(generation):
+    '''
+    Прогревает кеш в фоновом потоке, если этот процесс еще не видел поколение generation.
+    Нужно воркерам serve: загрузка данных идет в главном процессе, а кеши у каждого воркера свои
+    '''
+    global _warmed_generation
+    with _warm_lock:
+        if generation <= _warmed_generation:
+            return
+        _warmed_generation = generation
+
+    def warm():
+        with ChartAccess._meta.database.connection_context():
+            warm_charts(generation=generation)
+
+    threading.Thread(target=warm, name='warm_charts', daemon=True).start()
+
+
 @app.route('/api')
 def api():
     '''
     Params:
         start        - левая дата в iso формате (YYYY-MM-DD). По умолчанию старейшая дата в бд.
         end          - правая дата в iso формате (YYYY-MM-DD). По умолчанию новейшая дата в бд.
-        region_id    - id региона
+        region_id    - id региона (или "g<id>" для группы регионов)
+        group_id     - id группы регионов (вместо region_id)
+        agg          - свертка по регионам группы ('mean', 'min', 'max', 'median', 'p95' и т.п.). По умолчанию 'mean'.
         option       - опция (id вещества или органа)
         kind         - тип данных ('acute', 'chronic', 'acute hi', 'chronic hi', 'risk')
+        since        - вернуть только точки после этой даты (YYYY-MM-DD)
+        cursor       - курсор из предыдущего ответа (вместо since). Если с тех пор изменились
+                       данные до даты курсора, возвращается полный график (full=true)
+        window       - окно усреднения вместо стандартного: длина в днях ('7d', '2w', '1y', '48h' - только кратные
+                       суткам, данные суточные) и вид через двоеточие ('mean', 'ewma', 'max'). Не для 'risk'
+
+    Ответ дополнительно содержит cursor для следующего запроса, full и (для неполных ответов)
+    replace_from - дата, начиная с которой клиент заменяет свои точки полученными.
 
     Пример:
         /api?region_id=13&substance_id=8
+        /api?group_id=2&agg=p95&kind=acute&option=3
+        /api?region_id=13&option=8&kind=acute&cursor=42:2023-05-01
+        /api?region_id=13&option=8&kind=acute&window=30d:ewma
     '''
-    if Users.from_session(session) is None:
+    with span('auth', db=True):
+        user = Users.from_session(session)
+    if user is None:
         return Response(status=401)
 
     start = request.args.get('start')
     end = request.args.get('end')
     region = request.args.get('region_id')
+    if request.args.get('group_id'):
+        region = 'g' + request.args['group_id']
     option = request.args.get('option')
     kind = request.args.get('kind')
+    agg = request.args.get('agg', 'mean')
+    since = request.args.get('since')
+    cursor = request.args.get('cursor')
+    window = request.args.get('window')
+    generation = DataGeneration.current()
+    ensure_warm(generation)
+
+    try:
+        if cursor:
+            cursor_generation, since = cursor.split(':', 1)
+            since = date.fromisoformat(since) if since else None
+            # с момента выдачи курсора поменялись уже отданные дни - нужен полный график
+            changed = DataGeneration.changed_since(int(cursor_generation))
+            if since and changed is not None and changed <= since:
+                since = None
+        else:
+            since = date.fromisoformat(since) if since else None
+
+        with span('compute'):
+            if since:
+                with admit(chart_cost(kind, region, option, max(since.isoformat(), start or ''), end, window), user.id):
+                    data = make_delta(kind, region, option, since, start, end, agg, window)
+            else:
+                chart = chart_entry(kind, region, option, start, end, agg, generation, user.id, window)
+                data = chart.data
+    except ValueError:
+        return Response(status=400)
+    if not data:
+        return Response(status=400)
+
+    # прогреваются только графики со стандартными окнами
+    if not window:
+        record_access(kind, region, option, agg)
+    last = data['labels'][-1] if data['labels'] else (since.isoformat() if since else '')
+    with span('serialize'):
+        if since:
+            return jsonify(dict(data, full=False, cursor=f'{generation}:{last}'))
+        # полный график сериализуется и сжимается один раз на запись кеша
+        return chart.payload('api', lambda: Payload(
+            jsonify(dict(data, full=True, cursor=f'{generation}:{last}')).get_data(), 'application/json')).response()
+
+
+@app.route('/api/point')
+def api_point():
+    '''
+    Значения в произвольной точке, интерполированные по ближайшим станциям
+
+    Params:
+        lat, lng     - координаты точки
+        start        - левая дата в iso формате (YYYY-MM-DD). По умолчанию старейшая дата в бд.
+        end          - правая дата в iso формате (YYYY-MM-DD). По умолчанию новейшая дата в бд.
+        option       - опция (id вещества или органа)
+        kind         - тип данных ('acute', 'chronic', 'acute hi', 'chronic hi', 'risk')
+        k            - число ближайших станций (по умолчанию POINT_NEIGHBOURS)
+
+    Пример:
+        /api/point?lat=52.28&lng=104.30&kind=acute&option=3
+    '''
+    with span('auth', db=True):
+        user = Users.from_session(session)
+    if user is None:
+        return Response(status=401)
+
+    try:
+        lat = float(request.args['lat'])
+        lng = float(request.args['lng'])
+        k = int(request.args.get('k', POINT_NEIGHBOURS))
+        start = request.args.get('start')
+        end = request.args.get('end')
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180 and k > 0):
+            raise ValueError
+        with span('compute'):
+            data = point_chart(request.args.get('kind'), lat, lng, request.args.get('option'), start, end, k)
+    except (KeyError, ValueError):
+        return Response(status=400)
 
-    data = make_chart(kind, region, option, start, end)
     if not data:
         return Response(status=400)
-    else:
+    with span('serialize'):
         return jsonify(data)
+
+
+@app.route('/api/correlation')
+def api_correlation():
+    '''
+    Корреляции и число дней совместного превышения пдк между регионами или между веществами
+
+    Params:
+        start        - левая дата в iso формате (YYYY-MM-DD). По умолчанию старейшая дата в бд.
+        end          - правая дата в iso формате (YYYY-MM-DD). По умолчанию новейшая дата в бд.
+        axis         - 'regions' (регионы между собой по веществу option) или 'substances' (вещества между собой
+                       в регионе region_id). По умолчанию 'regions'
+        option       - id вещества (для axis=regions)
+        region_id    - id региона или "g<id>" группы (для axis=regions - ограничивает регионы, по умолчанию все;
+                       для axis=substances - обязателен, показания группы сворачиваются agg)
+        agg          - свертка по регионам группы. По умолчанию 'mean'.
+        kind         - 'acute' (среднесуточные) или 'chronic' (среднегодовые). По умолчанию 'acute'
+        method       - 'pearson' или 'spearman'. По умолчанию 'pearson'
+        min_periods  - минимум общих дней для коэффициента (иначе null). По умолчанию 30
+
+    Пример:
+        /api/correlation?option=3&region_id=g2&method=spearman
+        /api/correlation?axis=substances&region_id=13&kind=chronic
+    '''
+    with span('auth', db=True):
+        user = Users.from_session(session)
+    if user is None:
+        return Response(status=401)
+
+    try:
+        start = request.args.get('start')
+        start = date.fromisoformat(start) if start else AtmosphericMeasurement.min_date()
+        end = request.args.get('end')
+        end = date.fromisoformat(end) if end else AtmosphericMeasurement.max_date()
+        axis = request.args.get('axis', 'regions')
+
+        regions = None
+        if request.args.get('region_id'):
+            if not (resolved := resolve_region(request.args['region_id'])):
+                return Response(status=400)
+            regions = resolved[2]
+        elif axis == 'substances':
+            return Response(status=400)
+
+        if axis == 'regions':
+            if not (substance := _lookup('substances', request.args.get('option'))):
+                return Response(status=400)
+            substances = [substance]
+        else:
+            substances = list(reference()['substances'].values())
+
+        regions = regions or list(reference()['regions'].values())
+        kind = request.args.get('kind', 'acute')
+        cost = estimate(kind, len(substances), len(regions), (end - start).days)
+        with span('compute'):
+            data = correlation(
+                axis,
+                kind,
+                start,
+                end,
+                regions,
+                substances,
+                request.args.get('method', 'pearson'),
+                request.args.get('agg', 'mean'),
+                request.args.get('min_periods', CORRELATION_MIN_PERIODS, type=int),
+                guard=lambda: admit(cost, user.id))
+    except ValueError:
+        return Response(status=400)
+
+    with span('serialize'):
+        return jsonify(data)
+
+
+@app.route('/api/impact')
+def api_impact():
+    '''
+    Влияние на органы: HI всех органов во всех регионах и сводка для тепловой карты регион x орган
+
+    Params:
+        start        - левая дата в iso формате (YYYY-MM-DD). По умолчанию старейшая дата в бд.
+        end          - правая дата в iso формате (YYYY-MM-DD). По умолчанию новейшая дата в бд.
+        region_id    - id региона или "g<id>" группы (по умолчанию все регионы)
+        kind         - 'acute hi' или 'chronic hi'. По умолчанию 'acute hi'
+        threshold    - пороговое значение HI для сводки (по умолчанию 1)
+        cube         - 0, чтобы не включать в ответ куб [регион][орган][дата] (только сводка)
+
+    Ответ: regions, health_points, labels (даты), summary (max, mean, last, days_above, share_above -
+    матрицы [регион][орган]) и cube.
+
+    Пример:
+        /api/impact?kind=chronic hi&region_id=g2&cube=0
+    '''
+    with span('auth', db=True):
+        user = Users.from_session(session)
+    if user is None:
+        return Response(status=401)
+
+    try:
+        start = request.args.get('start')
+        start = date.fromisoformat(start) if start else AtmosphericMeasurement.min_date()
+        end = request.args.get('end')
+        end = date.fromisoformat(end) if end else AtmosphericMeasurement.max_date()
+
+        regions = list(reference()['regions'].values())
+        if request.args.get('region_id'):
+            if not (resolved := resolve_region(request.args['region_id'])):
+                return Response(status=400)
+            regions = resolved[2]
+
+        kind = request.args.get('kind', 'acute hi')
+        if kind not in ('acute hi', 'chronic hi'):
+            return Response(status=400)
+        threshold = float(request.args.get('threshold', 1))
+    except ValueError:
+        return Response(status=400)
+
+    points = list(HealthPoint.possible_all())
+    substances = len({x.id for p in points for x in reference()['point_substances'].get(p.id, ())})
+    cost = estimate(kind, substances, len(regions), (end - start).days)
+
+    with span('compute'):
+        data = impact(kind.split()[0], start, end, regions, points, threshold, request.args.get('cube') != '0',
+                      guard=lambda: admit(cost, user.id))
+
+    with span('serialize'):
+        return jsonify(data)
+
+
+@app.route('/api/episodes')
+def api_episodes():
+    '''
+    Эпизоды превышения HI (начало, конец, длительность, пик, площадь над порогом)
+
+    Params:
+        start        - левая дата в iso формате (YYYY-MM-DD). По умолчанию старейшая дата в бд.
+        end          - правая дата в iso формате (YYYY-MM-DD). По умолчанию новейшая дата в бд.
+        region_id    - id региона или "g<id>" группы (по умолчанию все регионы)
+        option       - id органа (по умолчанию все)
+        kind         - 'acute hi' или 'chronic hi' (по умолчанию оба)
+        threshold    - пороговое значение HI (по умолчанию 1)
+        min_length   - минимальная длительность эпизода в днях (по умолчанию 5 для острого и 90 для хронического)
+        format       - 'json' или 'csv'
+
+    Пример:
+        /api/episodes?kind=acute hi&region_id=g2&format=csv
+    '''
+    with span('auth', db=True):
+        user = Users.from_session(session)
+    if user is None:
+        return Response(status=401)
+
+    try:
+        start = request.args.get('start')
+        start = date.fromisoformat(start) if start else AtmosphericMeasurement.min_date()
+        end = request.args.get('end')
+        end = date.fromisoformat(end) if end else AtmosphericMeasurement.max_date()
+
+        regions = None
+        if request.args.get('region_id'):
+            if not (resolved := resolve_region(request.args['region_id'])):
+                return Response(status=400)
+            regions = resolved[2]
+
+        points = None
+        if request.args.get('option'):
+            if not (points := HealthPoint.get_or_none(id=request.args['option'])):
+                return Response(status=400)
+
+        kinds = ('acute hi', 'chronic hi')
+        if request.args.get('kind'):
+            if request.args['kind'] not in kinds:
+                return Response(status=400)
+            kinds = (request.args['kind'], )
+
+        threshold = float(request.args.get('threshold', 1))
+        min_length = request.args.get('min_length', type=int)
+    except ValueError:
+        return Response(status=400)
+
+    point_ids = [points.id] if points else [x.id for x in HealthPoint.possible_all()]
+    substances = len({x.id for p in point_ids for x in reference()['point_substances'].get(p, ())})
+    regions_count = len(regions) if regions else len(reference()['regions'])
+    cost = sum(estimate(kind, substances, regions_count, (end - start).days) for kind in kinds)
+
+    with span('compute'), admit(cost, user.id):
+        episodes = health_episodes(start, end, regions, points, kinds, threshold, min_length)
+
+    with span('serialize'):
+        if request.args.get('format') == 'csv':
+            header = ('region_id', 'region', 'health_point_id', 'health_point', 'kind', 'start', 'end', 'duration', 'peak', 'area')
+            file = StringIO()
+            writer = csv.writer(file, lineterminator='\n')
+            writer.writerow(header)
+            writer.writerows([x[k] for k in header] for x in episodes)
+            file.seek(0)
+            return send_file(BytesIO(file.read().encode('utf-8', 'replace')),
+                             mimetype='text/csv',
+                             as_attachment=True,
+                             download_name=f'episodes_{start}_{end}.csv')
+        return jsonify(episodes)
+
+
+@app.route('/api/summary')
+def api_summary():
+    '''
+    Сводки измерений по месяцам или годам (из заранее посчитанных таблиц)
+
+    Params:
+        region_id    - id региона
+        option       - id вещества (по умолчанию все)
+        period       - 'month' или 'year' (по умолчанию 'month')
+        start        - левая дата в iso формате (YYYY-MM-DD)
+        end          - правая дата в iso формате (YYYY-MM-DD)
+
+    Пример:
+        /api/summary?region_id=13&option=8&period=year
+    '''
+    with span('auth', db=True):
+        user = Users.from_session(session)
+    if user is None:
+        return Response(status=401)
+
+    period = request.args.get('period', 'month')
+    if period not in MeasurementRollup.PERIODS or not request.args.get('region_id'):
+        return Response(status=400)
+
+    mr = MeasurementRollup
+    q = (
+        mr
+        .select(mr, Substance)
+        .join(Substance)
+        .where((mr.region == request.args['region_id']) & (mr.period == period))
+        .order_by(mr.substance, mr.period_start)
+    )
+    try:
+        if request.args.get('option'):
+            q = q.where(mr.substance == int(request.args['option']))
+        if request.args.get('start'):
+            q = q.where(mr.period_start >= mr.bounds(period, date.fromisoformat(request.args['start']))[0])
+        if request.args.get('end'):
+            q = q.where(mr.period_start <= date.fromisoformat(request.args['end']))
+    except ValueError:
+        return Response(status=400)
+
+    with span('serialize'):
+        return jsonify([{
+            'substance_id': x.substance.id,
+            'substance': x.substance.formula,
+            'period': x.period,
+            'period_start': x.period_start.isoformat(),
+            'count': x.count,
+            'mean': x.mean,
+            'p95': x.p95,
+            'max': x.max,
+            'days_above_pdk': x.days_above_pdk,
+            'daily_pdk': x.substance.daily_pdk,
+            'yearly_pdk': x.substance.yearly_pdk,
+            # среднее за год в долях среднегодового пдк
+            'mean_to_yearly_pdk': x.mean / x.substance.yearly_pdk if x.period == 'year' else None,
+        } for x in q])
+
+
+@app.route('/metrics')
+def metrics():
+    '''Метрики в текстовом формате prometheus'''
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
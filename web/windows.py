@@ -0,0 +1,142 @@
+import re
+import numpy as np
+from collections import namedtuple
+
+
+# единицы длины окна в днях (данные суточные, поэтому часы допускаются только кратные суткам)
+UNITS = {'d': 1, 'w': 7, 'y': 365}
+KINDS = ('mean', 'ewma', 'max')
+# сколько длин окна EWMA загружать до начала периода: вес более старых дней меньше 0.25%
+EWMA_SPAN = 3
+
+_spec = re.compile(r'^(\d+)([hdwy]?)(?::(\w+))?$')
+
+
+class Window(namedtuple('Window', 'days kind')):
+    '''
+    Окно усреднения
+
+    Fields:
+        days: int - длина окна в днях
+        kind: str - 'mean' (скользящее среднее), 'ewma' (экспоненциальное, alpha = 2 / (days + 1)) или 'max'
+    '''
+    @property
+    def lookback(self):
+        '''Сколько дней до начала периода нужно загрузить'''
+        return self.days * EWMA_SPAN if self.kind == 'ewma' and self.days > 1 else self.days
+
+    def __str__(self):
+        return f'{self.days}d:{self.kind}'
+
+
+def parse_window(spec, default=None):
+    '''
+    Окно усреднения из параметра запроса
+
+    Args:
+        spec:    str|int|Window - '7d', '30d:ewma', '1y:max', '48h' или число дней (по умолчанию mean)
+        default: Window         - окно, если spec пустой
+
+    Returns:
+        Window
+
+    Raises:
+        ValueError - неверная запись, окно короче суток или неизвестный вид
+    '''
+    if spec is None or spec == '':
+        return default
+    if isinstance(spec, Window):
+        return spec
+    if isinstance(spec, int):
+        days, kind = spec, 'mean'
+    else:
+        if not (m := _spec.match(str(spec).strip().lower())):
+            raise ValueError(f'unexpected window "{spec}", use e.g. "7d", "30d:ewma", "1y:max"')
+        n, unit, kind = int(m[1]), m[2] or 'd', m[3] or 'mean'
+        if unit == 'h':
+            if n % 24:
+                raise ValueError(f'window "{spec}" is shorter than the daily resolution of the data')
+            days = n // 24
+        else:
+            days = n * UNITS[unit]
+    if days < 1:
+        raise ValueError(f'window "{spec}" must be at least one day')
+    if kind not in KINDS:
+        raise ValueError(f'unexpected window kind "{kind}", use {", ".join(KINDS)}')
+    return Window(days, kind)
+
+
+def rolling_mean(sums, counts, w):
+    '''Среднее по дням с показаниями в окне w по кумулятивным суммам показаний и числа дней (с нулем в начале)'''
+    n = sums.shape[-1] - 1
+    lo = np.maximum(np.arange(1, n + 1) - w, 0)
+    total = sums[..., 1:] - sums[..., lo]
+    count = counts[..., 1:] - counts[..., lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+
+def rolling_max(values, mask, w):
+    '''
+    Максимум по дням с показаниями в окне w за O(n) независимо от w (van Herk / Gil-Werman):
+    ряд режется на блоки длины w, максимум окна - это максимум суффикса одного блока и префикса следующего
+    '''
+    n = values.shape[-1]
+    a = np.where(mask, values, -np.inf)
+    pad = -n % w
+    a = np.concatenate([a, np.full(a.shape[:-1] + (pad,), -np.inf)], axis=-1)
+    blocks = a.reshape(a.shape[:-1] + (-1, w))
+    prefix = np.maximum.accumulate(blocks, axis=-1).reshape(a.shape)[..., :n]
+    suffix = np.maximum.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1].reshape(a.shape)[..., :n]
+
+    result = prefix.copy()
+    if n >= w:
+        result[..., w - 1:] = np.maximum(suffix[..., :n - w + 1], prefix[..., w - 1:])
+    result[np.isneginf(result)] = np.nan
+    return result
+
+
+def rolling_ewma(values, mask, w):
+    '''
+    Экспоненциальное среднее с учетом пропусков: вес дня убывает с каждым календарным днем,
+    пропущенные дни в сумму не входят, сумма нормируется на вес дней с показаниями
+    '''
+    alpha = 2 / (w + 1)
+    weighted = alpha * values * mask
+    present = alpha * mask
+    s = np.zeros(values.shape[:-1])
+    weight = np.zeros(values.shape[:-1])
+    result = np.empty(values.shape)
+    for t in range(values.shape[-1]):
+        s = s * (1 - alpha) + weighted[..., t]
+        weight = weight * (1 - alpha) + present[..., t]
+        result[..., t] = s / np.where(weight > 0, weight, np.nan)
+    return result
+
+
+def rolling(values, mask, windows):
+    '''
+    Все окна по одному загруженному ряду за один проход: кумулятивные суммы для средних считаются один раз
+
+    Args:
+        values:  np.ndarray[...][дата] - показания (нули там, где их нет)
+        mask:    np.ndarray[...][дата] - есть ли показание
+        windows: list[Window]
+
+    Returns:
+        list[np.ndarray[...][дата]] - значения окна, заканчивающегося в каждый день (nan если в окне нет показаний)
+    '''
+    sums = counts = None
+    result = []
+    for window in windows:
+        if window.kind == 'mean':
+            if sums is None:
+                zero = np.zeros(values.shape[:-1] + (1,))
+                sums = np.concatenate([zero, np.cumsum(values, axis=-1)], axis=-1)
+                counts = np.concatenate([zero, np.cumsum(mask, axis=-1)], axis=-1)
+            result.append(rolling_mean(sums, counts, window.days))
+        elif window.kind == 'max':
+            result.append(rolling_max(values, mask, window.days))
+        else:
+            result.append(rolling_ewma(values, mask, window.days))
+    return result